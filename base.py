@@ -2,12 +2,60 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from copy import deepcopy
+import time
 import tf_helper as helper
 import tensorflow as tf
 import layers as ly
 import pdb
 
+def _float_tensor_keys(product):
+    return sorted(key for key, val in product.items() if isinstance(val, tf.Tensor) and val.dtype.is_floating)
+
+
+def recompute_layer(layer_fn, inputs, layer_params, **kwargs):
+    '''
+    Call layer_fn(inputs, layer_params, **kwargs) without keeping its intermediate activations for backprop:
+    they are recomputed from the layer's float inputs during the backward pass (tf.contrib.layers.recompute_grad).
+    The layer must be deterministic, so random layers (dropout) can't be recomputed.
+    '''
+    if 'dropout' in layer_fn.__name__ or layer_params.get('dropout', 0.) > 0.:
+        raise ValueError("layer %s is random and can't be recomputed" % layer_fn.__name__)
+    keys = _float_tensor_keys(inputs)
+    forward = {}
+    def fn(*tensors):
+        out = layer_fn(dict(inputs, **dict(zip(keys, tensors))), layer_params, **kwargs)
+        if not forward:#first call builds the forward pass; later calls are the recomputation
+            forward['out'], forward['keys'] = out, _float_tensor_keys(out)
+        return tuple(out[key] for key in forward['keys'])
+    tensors = tf.contrib.layers.recompute_grad(fn)(*[inputs[key] for key in keys])
+    return dict(forward['out'], **dict(zip(forward['keys'], tensors)))
+
+
+_LAYER_PLANS = {}#compiled layer plans, keyed by the structure of (layers, layer_defaults)
+
+def compile_layers(layers, layer_defaults):
+    '''
+    Resolve a list of layer dictionaries into a plan of (type, layer function, recompute, params) tuples.
+    Plans are cached, so models sharing an architecture (encoder train/EMA copies, repeated trials) resolve it once.
+    '''
+    try:
+        key = helper.structure_key((layers, layer_defaults))
+    except helper.UnkeyableError:#configs that can't be compared by value are not cached
+        key = None
+    if key is None or key not in _LAYER_PLANS:
+        plan = []
+        for layer in layers:
+            if not hasattr(ly, layer['type']):#see if a method in the module layers.py with this layer type exists
+                print("layer type %s doesn't exist!" % (layer['type']))
+                raise KeyError(layer['type'])
+            layer_params = dict((k, v) for k, v in layer.items() if k not in ('type', 'recompute'))#type is not used when passing layer keywords to the actual method in the layers.py module
+            plan.append((layer['type'], getattr(ly, layer['type']), layer.get('recompute', False), layer_params))
+        if key is None:
+            return tuple(plan)
+        _LAYER_PLANS[key] = tuple(plan)
+    return _LAYER_PLANS[key]
+
+
 class Model(object): #constructs a series of connected layers from layers.py from the given list of dictionaries.
     
     def __init__(self, **kwargs):
@@ -42,6 +90,7 @@ class Model(object): #constructs a series of connected layers from layers.py fro
             for key, val in self._layer_defaults[layer['type']].items():
                 if key not in layer:
                     layer[key] = val             
+        self._plan = compile_layers(self._layers, self._layer_defaults)
     
     def get_output(self, inputs, reuse=None, verbose=None, is_training=True, getter=None):
         self._inputs = inputs
@@ -53,19 +102,21 @@ class Model(object): #constructs a series of connected layers from layers.py fro
             helper.print_dims(prefix="input: ", **new_product)
         all_layers_returned = self.get_attr("all_layers_returned", False)
         scope = self.get_attr("_scope", "prediction")
-        with tf.variable_scope(scope, reuse=reuse, custom_getter=getter):#construct the neural network from the self._layers list of layers
-            for l, layer in enumerate(self._layers):
-                if hasattr(ly, layer['type']):#see if a method in the module layers.py with this layer type exists
-                    with tf.variable_scope(str(l)) as l_scope:
-                        layer_params = deepcopy(layer)
-                        del layer_params['type'] #because type is not used when passing layer keywords to the actual method in the layers.py module
-                        new_product = getattr(ly, layer['type'])(new_product, layer_params, verbose=self._verbose, scope=l_scope, is_training=is_training)#get the output of the layer by calling the appropriate method in layers.py
-                        if verbose > 0:
-                            helper.print_dims(prefix="layer "+str(l)+" ("+layer['type']+") ", **new_product)
-                else:
-                    print("layer type %s doesn't exist!" % (layer['type']))
-                    raise
+        t0 = time.time()
+        with tf.variable_scope(scope, reuse=reuse, custom_getter=getter):#construct the neural network from the compiled layer plan
+            for l, (layer_type, layer_fn, recompute, params) in enumerate(self._plan):
+                layer_params = dict(params)#layers get their own copy of the (shared, cached) parameters
+                with tf.variable_scope(str(l), use_resource=True if recompute else None) as l_scope:#recompute_grad needs resource variables
+                    helper.register_layer_scope("%s/%d (%s)" % (scope, l, layer_type))#for per-layer profiles of the ops in this name scope
+                    if recompute:
+                        new_product = recompute_layer(layer_fn, new_product, layer_params, verbose=self._verbose, scope=l_scope, is_training=is_training)
+                    else:
+                        new_product = layer_fn(new_product, layer_params, verbose=self._verbose, scope=l_scope, is_training=is_training)#get the output of the layer by calling the appropriate method in layers.py
+                    if verbose > 0:
+                        helper.print_dims(prefix="layer "+str(l)+" ("+layer_type+") ", **new_product)
                 if all_layers_returned:products.append(new_product)
+        if verbose > 0:
+            print("built %s in %.2fs" % (scope, time.time() - t0))
             
         if not all_layers_returned:
                 products = new_product
@@ -0,0 +1,1005 @@
+from __future__ import print_function
+'''
+Micro-benchmarks and consistency checks for the sparse exchangeable layers.
+
+Each benchmark builds its graph on synthetic data of the size used by the configs in
+sparse_factorized_autoencoder.py and runs in a fresh process, so that the reported peak RSS
+belongs to that variant only. Usage:
+
+    python benchmark_sparse.py broadcast --nnz 500000 --units 220
+'''
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from base import Model
+from layers import leaky_relu
+from sparse_util import *
+
+# (N, M, nnz per minibatch) of the training configs in sparse_factorized_autoencoder.py
+CONFIGS = {'movielens-100k':(943, 1682, 75000),
+           'movielens-1M':(800, 1300, 110000),
+           'netflix/6m':(1100, 1100, 300000),
+           }
+
+
+def random_mask_indices(N, M, nnz, seed=0):
+    """Return nnz distinct (row, col) pairs of an N x M matrix, sorted row-major."""
+    rng = np.random.RandomState(seed)
+    nnz = min(nnz, N * M)
+    flat = np.unique(rng.randint(0, N * M, size=int(nnz * 1.2), dtype=np.int64))
+    flat = np.sort(rng.choice(flat, size=min(nnz, flat.shape[0]), replace=False))
+    return np.stack(np.unravel_index(flat, (N, M)), axis=1).astype(np.int32)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def time_fetches(sess, fetches, feed_dict, n_iter=10):
+    """Mean wall time per sess.run after one warm-up run."""
+    sess.run(fetches, feed_dict=feed_dict)
+    begin = time.time()
+    for _ in range(n_iter):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - begin) / n_iter
+
+
+def _run_and_report(fn, args):
+    out = fn(*args)
+    out['peak_rss_mb'] = peak_rss_mb()
+    return out
+
+
+def run_isolated(fn, *args):
+    """Run fn(*args) in a fresh process and return its result dict with the peak RSS added."""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_run_and_report, (fn, args))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_table(rows, columns):
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(["{:.4g}".format(row[c]) if isinstance(row[c], float) else str(row[c]) for c in columns]))
+
+
+##### broadcast add #####
+
+def broadcast_add_expanded(x_values, y, mask_indices, num_features, broadcast_axis=None):
+    """The previous sparse_tensor_broadcast_dense_add, which builds [nnz*num_features, 3] indices."""
+    inds = expand_tensor_indices(mask_indices, num_features)
+    num_vals = tf.shape(inds)[0]
+    if broadcast_axis is None:
+        vals = tf.reshape(x_values, shape=[-1,num_features])
+        return tf.reshape(tf.add(vals, y), shape=[-1])
+    temp_inds = tf.strided_slice(inds, begin=[0,0], end=[num_vals,2], strides=[num_features,1])
+    temp_inds = tf.slice(temp_inds, begin=[0,1-broadcast_axis], size=[-1,1])
+    new_vals = tf.gather_nd(tf.reshape(y, shape=[-1,num_features]), temp_inds)
+    vals = tf.reshape(x_values, shape=[-1,num_features]) + new_vals
+    return tf.reshape(vals, shape=[num_vals])
+
+
+def _broadcast(variant, N, M, nnz, units, n_iter):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    with tf.Graph().as_default():
+        x = tf.constant(np.random.randn(mask_indices_.shape[0] * units).astype(np.float32))
+        mask_indices = tf.placeholder(tf.int32, shape=[None, 2])
+        y_0 = tf.constant(np.random.randn(1, M, units).astype(np.float32))
+        y_1 = tf.constant(np.random.randn(N, 1, units).astype(np.float32))
+        if variant == 'expanded':
+            add = broadcast_add_expanded
+        else:
+            add = sparse_tensor_broadcast_dense_add
+        out = add(x, y_0, mask_indices, units, broadcast_axis=0)
+        out = add(out, y_1, mask_indices, units, broadcast_axis=1)
+        grad = tf.gradients(tf.reduce_sum(out * out), [x])[0]
+        with tf.Session() as sess:
+            feed = {mask_indices:mask_indices_}
+            out_ = sess.run(out, feed_dict=feed)
+            step = time_fetches(sess, [out, grad], feed, n_iter)
+    return {'variant':variant, 'nnz':mask_indices_.shape[0], 'units':units, 'step_s':step, 'out':out_}
+
+
+def bench_broadcast(args):
+    """Compare the gather-based broadcast add with the expanded-index version it replaced."""
+    rows = [run_isolated(_broadcast, v, args.N, args.M, args.nnz or 300000, args.units, args.iters) for v in ['expanded', 'gather']]
+    err = np.max(np.abs(rows[0]['out'] - rows[1]['out']))
+    print_table(rows, ['variant', 'nnz', 'units', 'step_s', 'peak_rss_mb'])
+    print("max abs difference: %g" % err)
+    assert err < 1e-5
+
+
+##### matrix_sparse stacks #####
+
+def stack_layers(n_layers, units, out_units=1, **layer_params):
+    layers = [dict({'type':'matrix_sparse', 'units':units}, **layer_params) for _ in range(n_layers)]
+    layers.append(dict({'type':'matrix_sparse', 'units':out_units, 'activation':None}, **layer_params))
+    return layers
+
+
+def stack_defaults():
+    return {'matrix_sparse':{'activation':tf.nn.relu,
+                             'pool_mode':'mean',
+                             'kernel_initializer':tf.random_normal_initializer(0, .01),
+                             },
+            'matrix_pool_sparse':{'pool_mode':'mean'},
+            'channel_dropout_sparse':{'rate':.5},
+            'matrix_dropout_sparse':{'rate':.05},
+            }
+
+
+def build_stack(layers, N, M, scope="stack", reuse=None, rows_sorted=False):
+    """Build a Model from layers on fresh placeholders and return them with a squared-error loss."""
+    mat_values = tf.placeholder(tf.float32, shape=[None], name='mat_values')
+    mask_indices = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices')
+    plan = SparseIndexPlan(mask_indices, [N,M], rows_sorted=rows_sorted)
+    model = Model(layers=layers, layer_defaults=stack_defaults(), scope=scope, verbose=0)
+    out = model.get_output({'input':mat_values, 'mask_indices':mask_indices, 'plan':plan, 'units':1, 'shape':[N,M]}, reuse=reuse)['input']
+    loss = tf.reduce_mean((out - mat_values)**2)
+    return mat_values, mask_indices, out, loss
+
+
+def _train_stack(layers, N, M, nnz, n_iter, rows_sorted=False, lazy=False):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    mat_values_ = np.random.randint(1, 6, size=mask_indices_.shape[0]).astype(np.float32)
+    with tf.Graph().as_default():
+        mat_values, mask_indices, out, loss = build_stack(layers, N, M, rows_sorted=rows_sorted)
+        loss += sum(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
+        opt = tf.contrib.opt.LazyAdamOptimizer(1e-4) if lazy else tf.train.AdamOptimizer(1e-4)
+        train_step = opt.minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            step = time_fetches(sess, [train_step, loss], {mat_values:mat_values_, mask_indices:mask_indices_}, n_iter)
+    return {'nnz':mask_indices_.shape[0], 'step_s':step}
+
+
+def check_fused(N=50, M=40, nnz=600, units=8):
+    """Max abs difference between the fused and the unfused matrix_sparse outputs and gradients."""
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    mat_values_ = np.random.randn(mask_indices_.shape[0]).astype(np.float32)
+    with tf.Graph().as_default():
+        mat_values, mask_indices, out, _ = build_stack(stack_layers(1, units), N, M)
+        layers = stack_layers(1, units, fused=True)
+        model = Model(layers=layers, layer_defaults=stack_defaults(), scope="stack", verbose=0)
+        out_fused = model.get_output({'input':mat_values, 'mask_indices':mask_indices, 'units':1, 'shape':[N,M]}, reuse=True)['input']
+        params = tf.trainable_variables()
+        grads = tf.gradients(tf.reduce_sum(tf.sin(out)), [mat_values] + params)
+        grads_fused = tf.gradients(tf.reduce_sum(tf.sin(out_fused)), [mat_values] + params)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            res = sess.run([out, out_fused, grads, grads_fused], feed_dict={mat_values:mat_values_, mask_indices:mask_indices_})
+    err = np.max(np.abs(res[0] - res[1]))
+    for g, g_fused in zip(res[2], res[3]):
+        err = max(err, np.max(np.abs(g - g_fused)))
+    return err
+
+
+def bench_fused(args):
+    """Step time and peak RSS of a mean-pooling matrix_sparse stack with and without the fused layer op."""
+    err = check_fused()
+    print("fused vs unfused max abs difference (values and gradients): %g" % err)
+    assert err < 1e-4
+    rows = []
+    for config in ['movielens-1M', 'netflix/6m']:
+        N, M, nnz = CONFIGS[config]
+        for variant in ['unfused', 'fused']:
+            layers = stack_layers(args.layers, args.units, fused=(variant == 'fused'))
+            row = run_isolated(_train_stack, layers, N, M, nnz, args.iters)
+            row.update({'config':config, 'variant':variant})
+            rows.append(row)
+    print_table(rows, ['config', 'variant', 'nnz', 'step_s', 'peak_rss_mb'])
+
+
+def bench_recompute(args):
+    """Peak RSS and step time of a deep matrix_sparse stack with and without activation recomputation."""
+    rows = []
+    for config in ['movielens-1M', 'netflix/6m']:
+        N, M, nnz = CONFIGS[config]
+        nnz = args.nnz or nnz
+        for variant in ['stored', 'recompute']:
+            layers = stack_layers(args.layers, args.units, recompute=(variant == 'recompute'))
+            row = run_isolated(_train_stack, layers, N, M, nnz, args.iters)
+            row.update({'config':config, 'variant':variant})
+            rows.append(row)
+    print_table(rows, ['config', 'variant', 'nnz', 'step_s', 'peak_rss_mb'])
+
+
+def bench_bias(args):
+    """Step time of a matrix_sparse stack with gathered row/column biases on a Netflix-sized catalogue."""
+    N, M = 480189, 17770
+    rows = []
+    for variant, bias, lazy in [('no bias', False, False), ('bias, adam', True, False), ('bias, lazy_adam', True, True)]:
+        layers = stack_layers(2, 16, individual_bias=bias, regularizer=tf.contrib.keras.regularizers.l2(1e-5))
+        row = run_isolated(_train_stack, layers, N, M, args.nnz or 100000, args.iters, False, lazy)
+        row['variant'] = variant
+        rows.append(row)
+    print_table(rows, ['variant', 'nnz', 'step_s', 'peak_rss_mb'])
+
+
+def bench_fused_dropout(args):
+    """Step time and peak RSS of a stack with channel_dropout_sparse layers and with dropout inside matrix_sparse."""
+    rows = []
+    for config in ['movielens-1M', 'netflix/6m']:
+        N, M, nnz = CONFIGS[config]
+        for variant in ['layers', 'fused']:
+            layers = stack_layers(args.layers, args.units)
+            for layer in layers[-2:]:
+                layer['dropout'] = .5 if variant == 'fused' else 0.
+            if variant == 'layers':
+                layers = layers[:-2] + [{'type':'channel_dropout_sparse'}, layers[-2], {'type':'channel_dropout_sparse'}, layers[-1]]
+            row = run_isolated(_train_stack, layers, N, M, args.nnz or nnz, args.iters)
+            row.update({'config':config, 'variant':variant})
+            rows.append(row)
+    print_table(rows, ['config', 'variant', 'nnz', 'step_s', 'peak_rss_mb'])
+
+
+def bench_sorted(args):
+    """Step time of a mean-pooling matrix_sparse stack with unsorted and sorted segment reductions."""
+    rows = []
+    for config in ['movielens-100k', 'movielens-1M']:
+        N, M, nnz = CONFIGS[config]
+        for rows_sorted in [False, True]:
+            row = run_isolated(_train_stack, stack_layers(args.layers, args.units), N, M, nnz, args.iters, rows_sorted)
+            row.update({'config':config, 'variant':'sorted' if rows_sorted else 'unsorted'})
+            rows.append(row)
+    print_table(rows, ['config', 'variant', 'nnz', 'step_s', 'peak_rss_mb'])
+
+
+##### row/column dropout #####
+
+def dropout_row_col_setdiff(values, mask_inds, shape, rate=0.0, training=True):
+    """The previous sparse_dropout_row_col, whose masks are drawn in numpy at graph-construction time."""
+    N,M,K = shape
+    vals = tf.reshape(values, [-1,K])
+    num_vals = tf.shape(vals)[0]
+    row_keep = np.arange(N)[np.random.choice([0,1], size=N, p=(rate, 1-rate))==1]
+    _, row_inds = tf.setdiff1d(mask_inds[:,0], row_keep)
+    col_keep = np.arange(M)[np.random.choice([0,1], size=M, p=(rate, 1-rate))==1]
+    _, col_inds = tf.setdiff1d(mask_inds[:,1], col_keep)
+    inds, _ = tf.unique(tf.concat([row_inds, col_inds], axis=0))
+    drop_mask = tf.cast(tf.scatter_nd(tf.expand_dims(inds, axis=1), tf.ones_like(inds), shape=[num_vals]), tf.bool)
+    new_vals = tf.where(drop_mask, tf.zeros_like(vals), vals)
+    return tf.reshape(new_vals, [-1]) / (1 - rate * rate)
+
+
+def _dropout(variant, N, M, nnz, units, rate, n_iter):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    with tf.Graph().as_default():
+        x = tf.constant(np.random.randn(mask_indices_.shape[0] * units).astype(np.float32))
+        mask_indices = tf.placeholder(tf.int32, shape=[None, 2])
+        if variant == 'setdiff':
+            out = dropout_row_col_setdiff(x, mask_indices, [N,M,units], rate=rate)
+        else:
+            out = sparse_dropout_row_col(x, mask_indices, [N,M,units], rate=rate)
+        nonzero = tf.not_equal(out, 0)
+        kept = tf.reduce_mean(tf.cast(nonzero, tf.float32))
+        grad = tf.gradients(tf.reduce_sum(out), [x])[0]
+        with tf.Session() as sess:
+            feed = {mask_indices:mask_indices_}
+            masks = [sess.run(nonzero, feed_dict=feed) for _ in range(2)]
+            kept_ = sess.run(kept, feed_dict=feed)
+            step = time_fetches(sess, [out, grad], feed, n_iter)
+    return {'variant':variant, 'nnz':mask_indices_.shape[0], 'step_s':step, 'kept':float(kept_),
+            'fresh_mask':str(not np.array_equal(masks[0], masks[1]))}
+
+
+def bench_dropout(args):
+    """Compare the in-graph row/column dropout with the setdiff1d version used by matrix_dropout_sparse before."""
+    rows = []
+    for config in ['movielens-1M', 'netflix/6m']:
+        N, M, nnz = CONFIGS[config]
+        for variant in ['setdiff', 'in_graph']:
+            row = run_isolated(_dropout, variant, N, M, nnz, args.units, args.rate, args.iters)
+            row['config'] = config
+            rows.append(row)
+    print_table(rows, ['config', 'variant', 'nnz', 'step_s', 'kept', 'fresh_mask', 'peak_rss_mb'])
+    print("expected fraction kept: %.4g" % ((1 - args.rate)**2))
+
+
+##### max pooling #####
+
+def segment_max_sentinel(vals, ids, num_segments):
+    """The previous max path of sparse_reduce: a full-size select against a -2e8 sentinel."""
+    out = tf.unsorted_segment_max(vals, ids, num_segments=num_segments)
+    return tf.where(tf.greater(out, -200000000), out, tf.zeros_like(out))
+
+
+def _maxpool(variant, N, M, nnz, units, n_iter, ties=False):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    with tf.Graph().as_default():
+        if ties:#a few distinct values, so most segment maxima are shared by several entries
+            x = tf.constant(np.random.RandomState(1).randint(0, 3, size=mask_indices_.shape[0] * units).astype(np.float32))
+        else:
+            x = tf.constant(np.random.randn(mask_indices_.shape[0] * units).astype(np.float32))
+        mask_indices = tf.placeholder(tf.int32, shape=[None, 2])
+        plan = SparseIndexPlan(mask_indices, [N,M])
+        vals = tf.reshape(x, [-1,units])
+        if variant == 'sentinel':
+            outs = [segment_max_sentinel(vals, plan.segment_ids(axis), plan.num_segments(axis)) for axis in [0,1]]
+        else:
+            outs = [sparse_reduce(mask_indices, x, units, mode='max', axis=axis, plan=plan) for axis in [0,1]]
+        grad = tf.gradients(tf.reduce_sum(outs[0]) + tf.reduce_sum(outs[1]), [x])[0]
+        with tf.Session() as sess:
+            feed = {mask_indices:mask_indices_}
+            outs_, grad_ = sess.run([outs, grad], feed_dict=feed)
+            step = time_fetches(sess, [outs, grad], feed, n_iter)
+    return {'variant':variant, 'nnz':mask_indices_.shape[0], 'step_s':step, 'outs':outs_, 'grad':grad_}
+
+
+def bench_maxpool(args):
+    """Forward+backward time of both max reductions, against the sentinel-based version."""
+    N, M, nnz = CONFIGS['movielens-1M']
+    rows = [run_isolated(_maxpool, v, N, M, args.nnz or nnz, args.units, args.iters) for v in ['sentinel', 'counts']]
+    err = max(np.max(np.abs(a - b)) for a, b in zip(rows[0]['outs'], rows[1]['outs']))
+    print_table(rows, ['variant', 'nnz', 'step_s', 'peak_rss_mb'])
+    print("max abs difference: %g" % err)
+    assert err == 0.
+    # the gradient of tied maxima is split between them, as by the gradient of tf.unsorted_segment_max
+    tied = [run_isolated(_maxpool, v, 2000, 500, 20000, args.units, 1, True) for v in ['sentinel', 'counts']]
+    grad_err = np.max(np.abs(tied[0]['grad'] - tied[1]['grad']))
+    print("max abs gradient difference with ties: %g" % grad_err)
+    assert grad_err < 1e-6
+
+
+##### index scaling #####
+
+def bench_scaling(args):
+    """Exactness of the integer index path on a synthetic matrix with row ids beyond 2^24.
+
+    Row and column sums from sparse_reduce/sparse_marginalize_mask with int64 mask_indices
+    are compared to np.bincount. Duplicate coordinates are allowed, since they do not change
+    what a segment sum should return.
+    """
+    nnz = args.nnz or 50000000
+    N, M = 2**25 + 2**20, 20000
+    rng = np.random.RandomState(0)
+    mask_indices_ = np.stack([rng.randint(0, N, size=nnz), rng.randint(0, M, size=nnz)], axis=1).astype(np.int64)
+    mat_values_ = rng.randint(1, 6, size=nnz).astype(np.float32)
+    lost = np.sum(mask_indices_[:,0].astype(np.float32).astype(np.int64) != mask_indices_[:,0])
+    print("row ids a float32 round-trip would corrupt: %d of %d" % (lost, nnz))
+    with tf.Graph().as_default():
+        mask_indices = tf.placeholder(tf.int64, shape=[None, 2])
+        mat_values = tf.placeholder(tf.float32, shape=[None])
+        plan = SparseIndexPlan(mask_indices, [N,M])
+        row_sums = sparse_reduce(mask_indices, mat_values, 1, shape=[N,M], axis=1, plan=plan)
+        col_sums = sparse_reduce(mask_indices, mat_values, 1, shape=[N,M], axis=0, plan=plan)
+        row_counts = sparse_marginalize_mask(mask_indices, shape=[N,M], axis=1, keep_dims=False, plan=plan)
+        tail = expand_tensor_indices(mask_indices[-1000:], 3)
+        with tf.Session() as sess:
+            begin = time.time()
+            res = sess.run([row_sums, col_sums, row_counts, tail], feed_dict={mask_indices:mask_indices_, mat_values:mat_values_})
+            took = time.time() - begin
+    checks = [('row sums', res[0][:,0], np.bincount(mask_indices_[:,0], weights=mat_values_, minlength=N)),
+              ('col sums', res[1][:,0], np.bincount(mask_indices_[:,1], weights=mat_values_, minlength=M)),
+              ('row counts', res[2][:,0], np.bincount(mask_indices_[:,0], minlength=N)),
+              ('expanded indices', res[3], expand_array_indices(mask_indices_[-1000:], 3)),
+              ]
+    print("nnz: %d, reductions took %.2fs, peak RSS %.0f MB" % (nnz, took, peak_rss_mb()))
+    for name, out, expected in checks:
+        print("%s exact: %s" % (name, np.array_equal(out, expected)))
+        assert np.array_equal(out, expected)
+
+
+##### numpy inference #####
+
+def autoencoder_opts(units, latent_features=32):
+    """A scaled-down encoder/decoder config of sparse_factorized_autoencoder.py (no dropout at inference)."""
+    return {'loss':'mse',
+            'encoder':[{'type':'matrix_sparse', 'units':units},
+                       {'type':'matrix_sparse', 'units':units},
+                       {'type':'matrix_sparse', 'units':latent_features, 'activation':None},
+                       {'type':'matrix_pool_sparse'}],
+            'decoder':[{'type':'matrix_sparse', 'units':units},
+                       {'type':'channel_dropout_sparse'},
+                       {'type':'matrix_sparse', 'units':units, 'skip_connections':True},
+                       {'type':'matrix_sparse', 'units':1, 'activation':None}],
+            'defaults':{'matrix_sparse':{'activation':leaky_relu,
+                                         'pool_mode':'mean',
+                                         'kernel_initializer':tf.random_normal_initializer(0, .1),
+                                         },
+                        'matrix_pool_sparse':{'pool_mode':'mean'},
+                        'channel_dropout_sparse':{'rate':.5},
+                        },
+            }
+
+
+def build_autoencoder(opts, N, M):
+    mat_values = tf.placeholder(tf.float32, shape=[None], name='mat_values')
+    mask_indices = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices')
+    mask_indices_pred = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_pred')
+    encoder = Model(layers=opts['encoder'], layer_defaults=opts['defaults'], scope="encoder", verbose=0)
+    out_enc = encoder.get_output({'input':mat_values, 'mask_indices':mask_indices, 'units':1, 'shape':[N,M]}, is_training=False)
+    decoder = Model(layers=opts['decoder'], layer_defaults=opts['defaults'], scope="decoder", verbose=0)
+    out_dec = decoder.get_output({'nvec':out_enc['nvec'], 'mvec':out_enc['mvec'], 'units':out_enc['units'],
+                                  'mask_indices':mask_indices_pred, 'shape':[N,M]}, is_training=False)
+    return mat_values, mask_indices, mask_indices_pred, tf.reshape(out_dec['input'], [-1])
+
+
+def _autoencoder_data(N, M, nnz):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    mat_values_ = np.random.RandomState(1).randint(1, 6, size=mask_indices_.shape[0]).astype(np.float32)
+    return mat_values_, mask_indices_, random_mask_indices(N, M, nnz // 10, seed=2)
+
+
+def _save_autoencoder(units, N, M, folder):
+    """Checkpoint a randomly initialised autoencoder and export it for numpy_inference."""
+    import numpy_inference
+    opts = autoencoder_opts(units)
+    with tf.Graph().as_default():
+        build_autoencoder(opts, N, M)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            checkpoint = tf.train.Saver().save(sess, os.path.join(folder, "model.ckpt"))
+    numpy_inference.export_model(opts, checkpoint, os.path.join(folder, "model.npz"))
+    return {'checkpoint':checkpoint}
+
+
+def _predict_tf(units, N, M, nnz, n_iter, checkpoint):
+    mat_values_, mask_indices_, mask_indices_pred_ = _autoencoder_data(N, M, nnz)
+    begin = time.time()
+    with tf.Graph().as_default():
+        mat_values, mask_indices, mask_indices_pred, out = build_autoencoder(autoencoder_opts(units), N, M)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint)
+            feed_dict = {mat_values:mat_values_, mask_indices:mask_indices_, mask_indices_pred:mask_indices_pred_}
+            pred = sess.run(out, feed_dict=feed_dict)
+            cold = time.time() - begin
+            step = time_fetches(sess, out, feed_dict, n_iter)
+    return {'cold_start_s':cold, 'predict_s':step, 'pred':pred}
+
+
+def _predict_numpy(N, M, nnz, n_iter, path):
+    import numpy_inference
+    mat_values_, mask_indices_, mask_indices_pred_ = _autoencoder_data(N, M, nnz)
+    begin = time.time()
+    model = numpy_inference.load_model(path)
+    pred = numpy_inference.predict(model, mat_values_, mask_indices_, mask_indices_pred_, [N,M])
+    cold = time.time() - begin
+    begin = time.time()
+    for _ in range(n_iter):
+        numpy_inference.predict(model, mat_values_, mask_indices_, mask_indices_pred_, [N,M])
+    return {'cold_start_s':cold, 'predict_s':(time.time() - begin) / n_iter, 'pred':pred}
+
+
+def _predict_numpy_streaming(N, M, nnz, path, chunk_size):
+    import numpy_inference
+    mat_values_, mask_indices_, mask_indices_pred_ = _autoencoder_data(N, M, nnz)
+    model = numpy_inference.load_model(path)
+    begin = time.time()
+    pred = numpy_inference.predict(model, mat_values_, mask_indices_, mask_indices_pred_, [N,M], chunk_size=chunk_size)
+    return {'predict_s':time.time() - begin, 'pred':pred}
+
+
+def bench_streaming(args):
+    """Peak RSS and time of numpy_inference predictions on a whole matrix, in one piece and streamed in chunks."""
+    N, M = 6040, 3706 # ml-1M
+    nnz = args.nnz or 1000000
+    folder = tempfile.mkdtemp()
+    try:
+        run_isolated(_save_autoencoder, args.units, N, M, folder)
+        path = os.path.join(folder, "model.npz")
+        rows = []
+        for chunk_size in [None, 100000, 20000]:
+            row = run_isolated(_predict_numpy_streaming, N, M, nnz, path, chunk_size)
+            row['chunk_size'] = str(chunk_size)
+            rows.append(row)
+        for row in rows:
+            row['max_rel_err'] = float(np.max(np.abs(row['pred'] - rows[0]['pred']) / (1. + np.abs(rows[0]['pred']))))
+            assert row['max_rel_err'] < 1e-5
+        print_table(rows, ['chunk_size', 'predict_s', 'peak_rss_mb', 'max_rel_err'])
+    finally:
+        shutil.rmtree(folder)
+
+
+def bench_numpy_inference(args):
+    """Cold start, prediction time and peak RSS of TensorFlow and numpy_inference on an exported autoencoder."""
+    folder = tempfile.mkdtemp()
+    try:
+        rows = []
+        for config in ['movielens-100k', 'netflix/6m']:
+            N, M, nnz = CONFIGS[config]
+            nnz = args.nnz or nnz
+            checkpoint = run_isolated(_save_autoencoder, args.units, N, M, folder)['checkpoint']
+            res_tf = run_isolated(_predict_tf, args.units, N, M, nnz, args.iters, checkpoint)
+            res_np = run_isolated(_predict_numpy, N, M, nnz, args.iters, os.path.join(folder, "model.npz"))
+            err = np.max(np.abs(res_tf['pred'] - res_np['pred']) / (1. + np.abs(res_tf['pred'])))
+            print("%s: numpy vs tensorflow max relative difference %g" % (config, err))
+            assert err < 1e-5
+            for variant, res in [('tensorflow', res_tf), ('numpy', res_np)]:
+                res.update({'config':config, 'variant':variant, 'nnz':nnz})
+                rows.append(res)
+        print_table(rows, ['config', 'variant', 'nnz', 'cold_start_s', 'predict_s', 'peak_rss_mb'])
+    finally:
+        shutil.rmtree(folder)
+
+
+##### frozen inference export #####
+
+def _save_training_checkpoint(units, N, M, nnz, folder):
+    """Train the full sparse_factorized_autoencoder graph for a few steps, checkpoint it and export the frozen inference graph."""
+    import sparse_factorized_autoencoder as sfa
+    opts = dict(autoencoder_opts(units), lr=1e-3, ema_decay=.9, optimizer='adam')
+    mat_values_, mask_indices_, _ = _autoencoder_data(N, M, nnz)
+    with tf.Graph().as_default():
+        handles = sfa.build_model(opts, N, M)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {handles['mat_values_tr']:mat_values_, handles['mask_indices_tr']:mask_indices_}
+            for _ in range(3):#so that the EMA shadows differ from the weights
+                sess.run([handles['train_step']] + handles['ema_op'], feed_dict=feed_dict)
+            checkpoint = tf.train.Saver().save(sess, os.path.join(folder, "full.ckpt"))
+    frozen = sfa.export_inference_graph(opts, checkpoint, os.path.join(folder, "inference.pb"), N, M, use_ema=True)
+    return {'checkpoint':checkpoint, 'frozen':frozen}
+
+
+def _load_full(units, N, M, nnz, n_iter, checkpoint):
+    import sparse_factorized_autoencoder as sfa
+    opts = dict(autoencoder_opts(units), lr=1e-3, ema_decay=.9, optimizer='adam')
+    mat_values_, mask_indices_, mask_indices_pred_ = _autoencoder_data(N, M, nnz)
+    begin = time.time()
+    with tf.Graph().as_default():
+        handles = sfa.build_model(opts, N, M)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint)
+            load = time.time() - begin
+            feed_dict = {handles['mat_values_tr']:mat_values_, handles['mask_indices_tr']:mask_indices_,
+                         handles['mask_indices_tr_val']:mask_indices_pred_}
+            pred = sess.run(handles['out_val'], feed_dict=feed_dict)#the EMA-weights validation output
+            step = time_fetches(sess, handles['out_val'], feed_dict, n_iter)
+    return {'load_s':load, 'predict_s':step, 'pred':pred}
+
+
+def _load_frozen(N, M, nnz, n_iter, path):
+    import sparse_factorized_autoencoder as sfa
+    mat_values_, mask_indices_, mask_indices_pred_ = _autoencoder_data(N, M, nnz)
+    begin = time.time()
+    graph, mat_values, mask_indices, mask_indices_pred, predictions = sfa.load_inference_graph(path)
+    with tf.Session(graph=graph) as sess:
+        load = time.time() - begin
+        feed_dict = {mat_values:mat_values_, mask_indices:mask_indices_, mask_indices_pred:mask_indices_pred_}
+        pred = sess.run(predictions, feed_dict=feed_dict)
+        step = time_fetches(sess, predictions, feed_dict, n_iter)
+    return {'load_s':load, 'predict_s':step, 'pred':pred}
+
+
+def bench_frozen(args):
+    """Load time, prediction time and peak RSS of a full checkpoint restore and of the frozen inference graph."""
+    N, M, nnz = CONFIGS['netflix/6m']
+    nnz = args.nnz or nnz
+    folder = tempfile.mkdtemp()
+    try:
+        paths = run_isolated(_save_training_checkpoint, args.units, N, M, nnz, folder)
+        res_full = run_isolated(_load_full, args.units, N, M, nnz, args.iters, paths['checkpoint'])
+        res_frozen = run_isolated(_load_frozen, N, M, nnz, args.iters, paths['frozen'])
+        err = np.max(np.abs(res_full['pred'] - res_frozen['pred']) / (1. + np.abs(res_full['pred'])))
+        print("frozen vs full checkpoint max relative difference %g" % err)
+        assert err < 1e-5
+        res_full.update({'variant':'saver.restore', 'file_mb':sum(os.path.getsize(f) for f in glob.glob(paths['checkpoint'] + ".*")) / 2.**20})
+        res_frozen.update({'variant':'frozen', 'file_mb':os.path.getsize(paths['frozen']) / 2.**20})
+        print_table([res_full, res_frozen], ['variant', 'file_mb', 'load_s', 'predict_s', 'peak_rss_mb'])
+    finally:
+        shutil.rmtree(folder)
+
+
+##### data-parallel training #####
+
+def bench_data_parallel(args):
+    """Training ratings/sec on ml-1M with 1/2/4/8 data-parallel worker processes (same threads and minibatches per worker)."""
+    import data_parallel
+    N, M, _ = CONFIGS['movielens-1M']
+    workers_list = [1, 2, 4, 8]
+    opts = dict(autoencoder_opts(args.units), data_path='movielens-1M', sample_mode='conditional_sample_sparse',
+                maxN=N, maxM=M, lr=1e-3, optimizer='adam', ema_decay=1., epochs=2, steps_per_epoch=args.iters,
+                threads_per_worker=max(1, multiprocessing.cpu_count() // max(workers_list)))
+    data = data_parallel.load_data(opts)
+    folder = tempfile.mkdtemp()
+    try:
+        rows = []
+        for workers in workers_list:
+            losses = data_parallel.train_data_parallel(dict(opts, workers=workers, ckpt_folder=folder), data=data)
+            rows.append({'workers':workers, 'ratings_per_sec':float(losses['ratings_per_sec'][-1]), 'train_loss':float(losses['train'][-1])})#the first epoch is warm-up
+        for row in rows:
+            row['speedup'] = row['ratings_per_sec'] / rows[0]['ratings_per_sec']
+        print_table(rows, ['workers', 'ratings_per_sec', 'speedup', 'train_loss'])
+    finally:
+        shutil.rmtree(folder)
+
+
+##### dataset cache #####
+
+def _load_dataset(dataset, cache):
+    import util
+    begin = time.time()
+    data = util.get_data(dataset, train=.6, valid=.2, test=.2, mode='sparse', fold=1, cache=cache)
+    return {'load_s':time.time() - begin, 'nnz':data['mask_indices_all'].shape[0]}
+
+
+def bench_dataset_cache(args):
+    """Load time and peak RSS of util.get_data: parsing ratings.dat, the first load (parse and write the cache) and cached loads."""
+    import util
+    datasets = [d for d in sorted(util.DATASET_FILES) if os.path.exists(os.path.join(util.data_folder, util.DATASET_FILES[d]))]
+    rows = []
+    for dataset in datasets:
+        folder = util.dataset_cache_folder(dataset, valid=.2, test=.2, seed=1234)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        for variant, cache in [('parse', False), ('first_load', True), ('cached', True)]:
+            row = run_isolated(_load_dataset, dataset, cache)
+            row.update({'dataset':dataset, 'variant':variant})
+            rows.append(row)
+    print_table(rows, ['dataset', 'variant', 'nnz', 'load_s', 'peak_rss_mb'])
+
+
+##### dense <-> sparse array conversion #####
+
+def expand_array_indices_tile(mask_indices, num_features):
+    """The tile/transpose expansion previously in sparse_util.expand_array_indices."""
+    num_vals = mask_indices.shape[0]
+    inds_exp = np.reshape(np.tile(range(num_features), reps=[num_vals]), newshape=[-1, 1])
+    inds = np.reshape(np.tile(mask_indices, reps=[num_features,1]), newshape=[num_features, num_vals, 2])
+    return np.concatenate((np.reshape(np.transpose(inds, axes=[1,0,2]), newshape=[-1,2]), inds_exp), axis=1)
+
+
+def dense_array_to_sparse_zip(x):
+    """The list-of-tuples conversion previously in sparse_util.dense_array_to_sparse (mask_indices=None)."""
+    vals = x[x.nonzero()]
+    inds = np.array(list(zip(*x[:,:,0].nonzero())))
+    return {'indices':expand_array_indices_tile(inds, x.shape[2]), 'values':vals, 'dense_shape':x.shape}
+
+
+def sparse_array_to_dense_zip(values, mask_indices, shape):
+    """The list-of-tuples conversion previously in sparse_util.sparse_array_to_dense."""
+    out = np.zeros(shape)
+    out[tuple(zip(*expand_array_indices_tile(mask_indices, shape[2])))] = values
+    return out
+
+
+def _time_call(fn, args, n_iter):
+    fn(*args)
+    begin = time.time()
+    for _ in range(n_iter):
+        fn(*args)
+    return (time.time() - begin) / n_iter
+
+
+def bench_conversion(args):
+    """Time of the per-minibatch dense <-> sparse numpy conversions on ml-1M sized submatrices."""
+    N, M, nnz = CONFIGS['movielens-1M']
+    mask_indices_ = random_mask_indices(N, M, args.nnz or nnz)
+    mask = np.zeros([N, M, 1])
+    mask[mask_indices_[:,0], mask_indices_[:,1]] = 1.
+    mat = mask * np.random.randint(1, 6, size=[N, M, 1])
+    values = mat[mask_indices_[:,0], mask_indices_[:,1], 0]
+
+    old, new = dense_array_to_sparse_zip(mat), dense_array_to_sparse(mat)
+    assert np.array_equal(old['indices'], new['indices']) and np.array_equal(old['values'], new['values'])
+    assert np.array_equal(get_mask_indices(mask), mask_indices_)
+    assert np.array_equal(sparse_array_to_dense(values, mask_indices_, [N, M, 1]), mat)
+    assert np.array_equal(sparse_array_to_dense_zip(values, mask_indices_, [N, M, 1]), mat)
+
+    rows = []
+    for name, fn_old, fn_new, fn_args in [('dense_array_to_sparse', dense_array_to_sparse_zip, dense_array_to_sparse, (mat,)),
+                                          ('get_mask_indices', lambda m: dense_array_to_sparse_zip(m)['indices'][:,0:2], get_mask_indices, (mask,)),
+                                          ('sparse_array_to_dense', sparse_array_to_dense_zip, sparse_array_to_dense, (values, mask_indices_, [N, M, 1]))]:
+        t_old, t_new = _time_call(fn_old, fn_args, args.iters), _time_call(fn_new, fn_args, args.iters)
+        rows.append({'function':name, 'nnz':mask_indices_.shape[0], 'zip_s':t_old, 'vectorized_s':t_new, 'speedup':t_old / t_new})
+    print_table(rows, ['function', 'nnz', 'zip_s', 'vectorized_s', 'speedup'])
+
+
+##### graph op counts #####
+
+SEGMENT_OPS = ['UnsortedSegmentSum', 'UnsortedSegmentMax', 'SegmentSum', 'SegmentMax']
+
+
+def count_segment_ops(graph, prefix=''):
+    """Number of segment reduction ops per type among the ops of graph whose name starts with prefix."""
+    ops = [op for op in graph.get_operations() if op.name.startswith(prefix)]
+    return {op_type:sum(op.type == op_type for op in ops) for op_type in SEGMENT_OPS}
+
+
+def bench_opcount(args):
+    """Segment reduction ops in the training graph of the autoencoder, by scope; counts are computed once per plan."""
+    N, M, _ = CONFIGS['movielens-1M']
+    rows = []
+    for pool_mode in ['mean', 'max']:
+        opts = autoencoder_opts(args.units)
+        opts['defaults']['matrix_sparse']['pool_mode'] = pool_mode
+        opts['defaults']['matrix_pool_sparse']['pool_mode'] = pool_mode
+        with tf.Graph().as_default() as graph:
+            mat_values = tf.placeholder(tf.float32, shape=[None], name='mat_values')
+            mask_indices = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices')
+            plan = SparseIndexPlan(mask_indices, [N,M])
+            encoder = Model(layers=opts['encoder'], layer_defaults=opts['defaults'], scope="encoder", verbose=0)
+            out_enc = encoder.get_output({'input':mat_values, 'mask_indices':mask_indices, 'plan':plan, 'units':1, 'shape':[N,M]})
+            decoder = Model(layers=opts['decoder'], layer_defaults=opts['defaults'], scope="decoder", verbose=0)
+            out_dec = decoder.get_output({'nvec':out_enc['nvec'], 'mvec':out_enc['mvec'], 'units':out_enc['units'],
+                                          'mask_indices':mask_indices, 'plan':out_enc['plan'], 'shape':[N,M]})
+            loss = tf.reduce_mean((tf.reshape(out_dec['input'], [-1]) - mat_values)**2)
+            forward = {scope:count_segment_ops(graph, scope) for scope in ['sparse_index_plan', 'encoder', 'decoder']}
+            tf.train.AdamOptimizer(1e-4).minimize(loss)
+            plans = set()
+            for op in graph.get_operations():
+                parts = op.name.split('/')
+                plans.update('/'.join(parts[:i+1]) for i, part in enumerate(parts) if part.startswith('sparse_index_plan'))
+            assert plans == {'sparse_index_plan'}, "counts were recomputed by %s" % sorted(plans)
+            for scope, counts in sorted(forward.items()):
+                rows.append(dict(counts, pool_mode=pool_mode, scope=scope, total=sum(counts.values())))
+            total = count_segment_ops(graph)
+            rows.append(dict(total, pool_mode=pool_mode, scope='step (with gradients)', total=sum(total.values())))
+    print_table(rows, ['pool_mode', 'scope'] + SEGMENT_OPS + ['total'])
+
+
+##### attention pooling #####
+
+def softmax_mean_global_max(values, logits, num_features, plan, axis, eps=1e-3):
+    """The attention pooling previously in layers.weighted_mean_reduce: one global max subtracted before exp."""
+    weights = tf.exp(logits - tf.reduce_max(logits))
+    stats = sparse_segment_stats(values, num_features, plan, axis=axis, stats=('sum', 'count'), weights=weights)
+    return stats['sum'] / (stats['count'] + eps)
+
+
+def softmax_mean_reference(values, logits, ids, num_segments):
+    """float64 numpy per-segment softmax-weighted mean, [num_segments, K]."""
+    values, logits = values.astype(np.float64), logits.astype(np.float64)
+    out = np.zeros([num_segments, values.shape[1]])
+    order = np.argsort(ids, kind='mergesort')
+    bounds = np.searchsorted(ids[order], np.arange(num_segments + 1))
+    for seg in range(num_segments):
+        rows = order[bounds[seg]:bounds[seg + 1]]
+        if rows.shape[0] > 0:
+            w = np.exp(logits[rows] - logits[rows].max(axis=0))
+            out[seg] = (w * values[rows]).sum(axis=0) / w.sum(axis=0)
+    return out
+
+
+def _attention(N, M, nnz, units, n_iter, logit_scale):
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    rng = np.random.RandomState(0)
+    values_ = rng.randn(mask_indices_.shape[0], units).astype(np.float32)
+    logits_ = (logit_scale * rng.randn(mask_indices_.shape[0], units)).astype(np.float32)
+    expected = softmax_mean_reference(values_, logits_, mask_indices_[:,1], M)
+    row = {'nnz':mask_indices_.shape[0]}
+    with tf.Graph().as_default():
+        values = tf.placeholder(tf.float32, shape=[None, units])
+        logits = tf.placeholder(tf.float32, shape=[None, units])
+        mask_indices = tf.placeholder(tf.int32, shape=[None, 2])
+        plan = SparseIndexPlan(mask_indices, [N,M])
+        feed_dict = {values:values_, logits:logits_, mask_indices:mask_indices_}
+        with tf.Session() as sess:
+            for variant, fn in [('global_max', softmax_mean_global_max), ('segment_softmax', sparse_segment_softmax_mean)]:
+                out = fn(values, logits, units, plan, axis=0)
+                grad = tf.gradients(tf.reduce_sum(out), [values, logits])
+                res = sess.run(out, feed_dict=feed_dict)
+                row[variant + '_max_err'] = float(np.max(np.abs(res - expected)))
+                row[variant + '_s'] = time_fetches(sess, [out, grad], feed_dict, n_iter)
+    return row
+
+
+def bench_attention(args):
+    """Accuracy (vs a float64 per-segment softmax) and step time of attention pooling at Netflix batch size."""
+    N, M, nnz = CONFIGS['netflix/6m']
+    rows = []
+    for logit_scale in [1., 10., 100.]: # weight_scale (10) times the spread of the attention logweights
+        row = run_isolated(_attention, N, M, args.nnz or nnz, 32, args.iters, logit_scale)
+        row['logit_scale'] = logit_scale
+        rows.append(row)
+    print_table(rows, ['logit_scale', 'nnz', 'global_max_max_err', 'segment_softmax_max_err', 'global_max_s', 'segment_softmax_s'])
+
+
+##### tiled matrix_dense #####
+
+def dense_stack(n_layers, units, **layer_params):
+    layers = [dict({'type':'matrix_dense', 'units':units}, **layer_params) for _ in range(n_layers)]
+    layers.append(dict({'type':'matrix_dense', 'units':1, 'activation':None}, **layer_params))
+    return layers
+
+
+def dense_defaults():
+    return {'matrix_dense':{'activation':tf.nn.relu,
+                            'drop_mask':False,
+                            'pool_mode':'mean',
+                            'kernel_initializer':tf.random_normal_initializer(0, .01),
+                            }}
+
+
+def _dense_forward(N, M, units, n_layers, row_block, n_iter, check=False):
+    """Forward pass of a matrix_dense stack on a full N x M matrix, optionally checked against the untiled layer."""
+    rng = np.random.RandomState(0)
+    mask_ = (rng.rand(N, M, 1) < .05).astype(np.float32)
+    mat_ = mask_ * rng.randint(1, 6, size=[N, M, 1]).astype(np.float32)
+    with tf.Graph().as_default():
+        mat = tf.placeholder(tf.float32, shape=[N, M, 1])
+        mask = tf.placeholder(tf.float32, shape=[N, M, 1])
+        inputs = {'input':mat, 'mask':mask, 'total_shape':[N, M], 'indn':None, 'indm':None}
+        model = Model(layers=dense_stack(n_layers, units, row_block=row_block), layer_defaults=dense_defaults(), scope="dense", verbose=0)
+        out = model.get_output(inputs)['input']
+        if check:
+            reference = Model(layers=dense_stack(n_layers, units), layer_defaults=dense_defaults(), scope="dense", verbose=0)
+            out_ref = reference.get_output(inputs, reuse=True)['input']
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {mat:mat_, mask:mask_}
+            if check:
+                res, res_ref = sess.run([out, out_ref], feed_dict=feed_dict)
+                return {'max_err':float(np.max(np.abs(res - res_ref)))}
+            return {'forward_s':time_fetches(sess, out, feed_dict, n_iter)}
+
+
+def bench_dense_tiled(args):
+    """Peak RSS and forward time of a matrix_dense stack on a full N x M matrix, untiled and in row blocks."""
+    err = run_isolated(_dense_forward, 50, 40, 8, 2, 16, 1, True)['max_err']
+    print("tiled vs untiled max abs difference: %g" % err)
+    assert err < 1e-5
+    rows = []
+    for row_block in [None, 512, 128]:
+        row = run_isolated(_dense_forward, args.N, args.M, args.units, args.layers, row_block, args.iters)
+        row['row_block'] = str(row_block)
+        rows.append(row)
+    print_table(rows, ['row_block', 'forward_s', 'peak_rss_mb'])
+
+
+def _overparam_step(NN, MM, N, M, units, optimizer, n_iter):
+    """Train step time of an overparameterized matrix_dense stack on an N x M submatrix of an NN x MM catalogue."""
+    rng = np.random.RandomState(0)
+    mask_ = (rng.rand(N, M, 1) < .05).astype(np.float32)
+    mat_ = mask_ * rng.randint(1, 6, size=[N, M, 1]).astype(np.float32)
+    lazy = optimizer == 'lazy_adam'
+    layers = [{'type':'matrix_dense', 'units':units, 'overparam':True, 'sparse_updates':lazy},
+              {'type':'matrix_dense', 'units':1, 'activation':None, 'overparam':True, 'sparse_updates':lazy}]
+    defaults = dense_defaults()
+    defaults['matrix_dense']['regularizer'] = tf.contrib.keras.regularizers.l2(.00001)
+    with tf.Graph().as_default():
+        mat = tf.placeholder(tf.float32, shape=[N, M, 1])
+        mask = tf.placeholder(tf.float32, shape=[N, M, 1])
+        indn = tf.placeholder(tf.int32, shape=[N])
+        indm = tf.placeholder(tf.int32, shape=[M])
+        model = Model(layers=layers, layer_defaults=defaults, scope="dense", verbose=0)
+        out = model.get_output({'input':mat, 'mask':mask, 'total_shape':[NN, MM], 'indn':indn, 'indm':indm})['input']
+        loss = tf.reduce_sum(((out - mat) * mask)**2) / tf.reduce_sum(mask) + sum(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
+        opt = tf.contrib.opt.LazyAdamOptimizer(1e-4) if lazy else tf.train.AdamOptimizer(1e-4)
+        train_step = opt.minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {mat:mat_, mask:mask_, indn:rng.choice(NN, N, replace=False), indm:rng.choice(MM, M, replace=False)}
+            step = time_fetches(sess, train_step, feed_dict, n_iter)
+    return {'step_s':step}
+
+
+def bench_lazy_adam(args):
+    """Step time of overparameterized matrix_dense layers with dense Adam and with sliced regularization + LazyAdam."""
+    rows = []
+    for NN, MM in [(6040, 3706), (60000, 18000)]:
+        for optimizer in ['adam', 'lazy_adam']:
+            row = run_isolated(_overparam_step, NN, MM, 200, 200, 16, optimizer, args.iters)
+            row.update({'catalogue':"%dx%d" % (NN, MM), 'optimizer':optimizer})
+            rows.append(row)
+    print_table(rows, ['catalogue', 'optimizer', 'step_s', 'peak_rss_mb'])
+
+
+##### 3-mode tensors #####
+
+def random_tensor_indices(shape, nnz, seed=0):
+    """nnz distinct coordinates of a sparse tensor of the given shape, sorted in row-major order."""
+    rng = np.random.RandomState(seed)
+    size = int(np.prod(shape))
+    flat = np.unique(rng.randint(0, size, size=int(min(nnz, size) * 1.2), dtype=np.int64))
+    flat = np.sort(rng.choice(flat, size=min(nnz, flat.shape[0]), replace=False))
+    return np.stack(np.unravel_index(flat, shape), axis=1).astype(np.int32)
+
+
+def check_tensor_sparse(N=50, M=40, nnz=600, units=8):
+    """Max abs difference between tensor_sparse on a 2-mode tensor and matrix_sparse, sharing their weights."""
+    mask_indices_ = random_mask_indices(N, M, nnz)
+    mat_values_ = np.random.randn(mask_indices_.shape[0]).astype(np.float32)
+    with tf.Graph().as_default():
+        mat_values, mask_indices, out, _ = build_stack(stack_layers(1, units), N, M)
+        layers = [dict(layer, type='tensor_sparse') for layer in stack_layers(1, units)]
+        defaults = dict(stack_defaults(), tensor_sparse=stack_defaults()['matrix_sparse'])
+        model = Model(layers=layers, layer_defaults=defaults, scope="stack", verbose=0)
+        out_tensor = model.get_output({'input':mat_values, 'mask_indices':mask_indices, 'units':1, 'shape':[N,M]}, reuse=True)['input']
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            res = sess.run([out, out_tensor], feed_dict={mat_values:mat_values_, mask_indices:mask_indices_})
+    return np.max(np.abs(res[0] - res[1]))
+
+
+def tensor_autoencoder(units, latent_features=32):
+    encoder = [{'type':'tensor_sparse', 'units':units},
+               {'type':'tensor_sparse', 'units':units},
+               {'type':'tensor_sparse', 'units':latent_features, 'activation':None},
+               {'type':'tensor_pool_sparse'}]
+    decoder = [{'type':'tensor_sparse', 'units':units},
+               {'type':'tensor_sparse', 'units':units},
+               {'type':'tensor_sparse', 'units':1, 'activation':None}]
+    defaults = {'tensor_sparse':{'activation':leaky_relu,
+                                 'pool_mode':'mean',
+                                 'kernel_initializer':tf.random_normal_initializer(0, .01),
+                                 },
+                'tensor_pool_sparse':{'pool_mode':'mean'},
+                }
+    return encoder, decoder, defaults
+
+
+def _tensor_step(shape, nnz, units, n_iter):
+    mask_indices_ = random_tensor_indices(shape, nnz)
+    values_ = np.random.RandomState(1).randint(1, 6, size=mask_indices_.shape[0]).astype(np.float32)
+    encoder_layers, decoder_layers, defaults = tensor_autoencoder(units)
+    with tf.Graph().as_default():
+        values = tf.placeholder(tf.float32, shape=[None])
+        mask_indices = tf.placeholder(tf.int32, shape=[None, len(shape)])
+        plan = SparseTensorIndexPlan(mask_indices, shape)
+        encoder = Model(layers=encoder_layers, layer_defaults=defaults, scope="encoder", verbose=0)
+        out_enc = encoder.get_output({'input':values, 'mask_indices':mask_indices, 'plan':plan, 'units':1, 'shape':shape})
+        decoder = Model(layers=decoder_layers, layer_defaults=defaults, scope="decoder", verbose=0)
+        out = decoder.get_output({'vecs':out_enc['vecs'], 'mask_indices':mask_indices, 'plan':plan, 'units':out_enc['units'], 'shape':shape})['input']
+        loss = tf.reduce_mean((out - values)**2)
+        train_step = tf.train.AdamOptimizer(1e-4).minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            step = time_fetches(sess, [train_step, loss], {values:values_, mask_indices:mask_indices_}, n_iter)
+    return {'nnz':mask_indices_.shape[0], 'step_s':step}
+
+
+def bench_tensor3(args):
+    """Train step time of a 3-mode tensor_sparse autoencoder as the number of non-zeros grows."""
+    err = check_tensor_sparse()
+    print("tensor_sparse (2 modes) vs matrix_sparse max abs difference: %g" % err)
+    assert err < 1e-5
+    shape = [args.N, args.M, 24] # users x items x contexts
+    rows = []
+    for nnz in [args.nnz or 100000, 2 * (args.nnz or 100000), 4 * (args.nnz or 100000)]:
+        row = run_isolated(_tensor_step, shape, nnz, args.units, args.iters)
+        row.update({'shape':"x".join(str(n) for n in shape), 'us_per_nnz':1e6 * row['step_s'] / row['nnz']})
+        rows.append(row)
+    print_table(rows, ['shape', 'nnz', 'step_s', 'us_per_nnz', 'peak_rss_mb'])
+
+
+BENCHMARKS = {'broadcast':bench_broadcast,
+              'fused':bench_fused,
+              'scaling':bench_scaling,
+              'dropout':bench_dropout,
+              'maxpool':bench_maxpool,
+              'sorted':bench_sorted,
+              'numpy_inference':bench_numpy_inference,
+              'conversion':bench_conversion,
+              'recompute':bench_recompute,
+              'opcount':bench_opcount,
+              'attention':bench_attention,
+              'dense_tiled':bench_dense_tiled,
+              'lazy_adam':bench_lazy_adam,
+              'tensor3':bench_tensor3,
+              'bias':bench_bias,
+              'fused_dropout':bench_fused_dropout,
+              'streaming':bench_streaming,
+              'frozen':bench_frozen,
+              'data_parallel':bench_data_parallel,
+              'dataset_cache':bench_dataset_cache,
+              }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--N", default=1100, type=int, help="Rows of the synthetic matrix")
+    parser.add_argument("--M", default=1100, type=int, help="Columns of the synthetic matrix")
+    parser.add_argument("--nnz", default=None, type=int, help="Non-zeros per minibatch (default depends on the benchmark)")
+    parser.add_argument("--units", default=220, type=int, help="Hidden units per layer")
+    parser.add_argument("--rate", default=.05, type=float, help="Dropout rate")
+    parser.add_argument("--layers", default=4, type=int, help="Hidden matrix_sparse layers in stacked benchmarks")
+    parser.add_argument("--iters", default=10, type=int, help="Timed iterations per variant")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,249 @@
+from __future__ import print_function
+'''
+Synchronous data-parallel training of sparse_factorized_autoencoder on a single (CPU) host.
+
+K worker processes each build a replica of the training graph and draw their own minibatches
+(the numpy sampler of every worker is seeded with its rank). Each step, the workers average their
+flat gradients through shared memory (SharedAllReduce) and apply the mean with their own optimizer.
+All replicas start from the parameters of worker 0, so they stay identical: a step with K workers
+is a step on K minibatches. It is enabled from sparse_factorized_autoencoder.main with
+
+    opts['workers'] = 8
+
+Worker 0 logs the training loss and ratings/sec per epoch and, like main, validates and tests every
+validate_interval epochs, keeps the best checkpoint with save_best, stops all workers when the validation
+loss diverges and writes the frozen inference graph with export_inference. Checkpoints are named like the
+ones of main, so either can resume from the other through restore_point.
+Only the python-side samplers 'conditional_sample_sparse' and 'uniform_over_dense_values' are supported.
+'''
+import os
+import sys
+import time
+import multiprocessing
+from collections import OrderedDict
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+import numpy as np
+import tensorflow as tf
+from util import get_data, sort_row_major
+from sparse_factorized_autoencoder import build_model, conditional_sample_sparse, sample_dense_values_uniform, one_hot, column_permutation
+from sparse_factorized_autoencoder import validate_and_test, export_inference_graph
+
+
+class ProcessBarrier(object):
+    '''A reusable barrier for `parties` processes (multiprocessing.Barrier is python 3 only).'''
+    def __init__(self, parties):
+        self._parties = parties
+        self._count = multiprocessing.Value('i', 0, lock=False)
+        self._generation = multiprocessing.Value('i', 0, lock=False)
+        self._cond = multiprocessing.Condition()
+
+    def wait(self):
+        with self._cond:
+            generation = self._generation.value
+            self._count.value += 1
+            if self._count.value == self._parties:
+                self._count.value = 0
+                self._generation.value += 1
+                self._cond.notify_all()
+            else:
+                while generation == self._generation.value:
+                    self._cond.wait()
+
+
+class SharedAllReduce(object):
+    '''
+    Average float32 vectors of a fixed size across `workers` processes through shared memory.
+    Every worker writes its vector to its own row, then reduces 1/workers of the columns (reduce-scatter),
+    so each step moves O(size) floats per worker. Create it before starting the worker processes.
+    '''
+    def __init__(self, workers, size):
+        self._workers = workers
+        self._size = size
+        self._vectors = multiprocessing.RawArray('f', workers * size)
+        self._mean = multiprocessing.RawArray('f', size)
+        self._bounds = np.linspace(0, size, workers + 1).astype(np.int64)
+        self._barrier = ProcessBarrier(workers)
+
+    def _views(self):
+        vectors = np.frombuffer(self._vectors, dtype=np.float32).reshape([self._workers, self._size])
+        return vectors, np.frombuffer(self._mean, dtype=np.float32)
+
+    def allreduce(self, rank, values):
+        '''
+        Mean of the values of all workers. The result is a view of shared memory that stays valid
+        until this worker calls allreduce or broadcast again.
+        '''
+        vectors, mean = self._views()
+        vectors[rank] = values
+        self._barrier.wait()
+        lo, hi = self._bounds[rank], self._bounds[rank + 1]
+        np.mean(vectors[:, lo:hi], axis=0, out=mean[lo:hi])
+        self._barrier.wait()
+        return mean
+
+    def broadcast(self, rank, values=None):
+        '''The values of worker 0, in every worker.'''
+        _, mean = self._views()
+        if rank == 0:
+            mean[:] = values
+        self._barrier.wait()
+        out = mean.copy()
+        self._barrier.wait()
+        return out
+
+
+def load_data(opts):
+    path = opts['data_path']
+    if 'movielens-100k' in path:
+        data = get_data(path, train=.75, valid=.05, test=.2, mode='sparse', fold=1)
+    else:
+        data = get_data(path, train=.6, valid=.2, test=.2, mode='sparse', fold=1)
+    if opts.get('sorted_segments', False):
+        data = sort_row_major(data)
+    return data
+
+
+def count_parameters(opts, N, M):
+    with tf.Graph().as_default():
+        handles = build_model(opts, N, M, opts.get('sorted_segments', False))
+        return handles['flat_grad_in'].get_shape().as_list()[0]
+
+
+def _samples(opts, data, N, M, steps):
+    maxN, maxM = min(opts['maxN'], N), min(opts['maxM'], M)
+    if 'conditional_sample_sparse' in opts['sample_mode']:
+        samples = (sample_ for _, _, _, _, sample_ in conditional_sample_sparse(data['mask_indices_tr'], data['mask_tr_val_split'], [N,M,1], maxN, maxM))
+    elif 'uniform_over_dense_values' in opts['sample_mode']:
+        samples = (np.sort(sample_) if opts.get('sorted_segments', False) else sample_
+                   for sample_ in sample_dense_values_uniform(data['mask_indices_tr'], opts['minibatch_size'], steps))
+    else:
+        raise ValueError("data-parallel training does not support sample mode %s" % opts['sample_mode'])
+    for step, sample_ in enumerate(samples):
+        if step == steps:
+            break
+        yield sample_
+
+
+def _steps_per_epoch(opts, data, N, M, workers):
+    if opts.get('steps_per_epoch', None):
+        return opts['steps_per_epoch']
+    if 'conditional_sample_sparse' in opts['sample_mode']:
+        iters_per_epoch = (N // min(opts['maxN'], N)) * (M // min(opts['maxM'], M))
+    else:
+        iters_per_epoch = data['mask_indices_tr'].shape[0] // min(opts['minibatch_size'], data['mask_indices_tr'].shape[0])
+    return max(1, iters_per_epoch // workers) # the workers share the minibatches of an epoch
+
+
+def _worker(rank, opts, data, allreduce, results, logfile, restore_point=None):
+    LOG = sys.stdout if logfile is None or rank > 0 else open(logfile, "a")
+    np.random.seed(opts.get('seed', 0) + rank)
+    workers = opts['workers']
+    N, M, _ = data['mat_shape']
+    maxN, maxM = min(opts['maxN'], N), min(opts['maxM'], M)
+    lossfn = opts.get("loss", "mse")
+    sorted_segments = opts.get('sorted_segments', False)
+    threads = opts.get('threads_per_worker', max(1, multiprocessing.cpu_count() // workers))
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2)
+    steps = _steps_per_epoch(opts, data, N, M, workers)
+    losses = OrderedDict([("train", []), ("valid", []), ("test", []), ("ratings_per_sec", [])])
+    min_loss, min_loss_epoch = 5., 0
+    first_epoch = opts.get('restore_point_epoch', 0)
+    if rank == 0 and not os.path.exists(opts['ckpt_folder']):
+        os.makedirs(opts['ckpt_folder'])
+    with tf.Graph().as_default():
+        handles = build_model(opts, N, M, sorted_segments)
+        saver = tf.train.Saver()
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            if restore_point is not None:#every worker restores, so the optimizer slots match too
+                saver.restore(sess, restore_point)
+            params = allreduce.broadcast(rank, np.concatenate([sess.run(handles['flat_params']), np.zeros(3)]) if rank == 0 else None)
+            sess.run(handles['assign_params'], feed_dict={handles['flat_params_in']:params[:-3]})#the buffer also holds the losses and batch size
+            for ep in range(first_epoch, opts['epochs'] + first_epoch):
+                begin = time.time()
+                loss_tr_, rec_loss_tr_, ratings, steps_run = 0., 0., 0., 0
+                for sample_ in _samples(opts, data, N, M, steps):
+                    mat_values = data['mat_values_tr'][sample_]
+                    mask_indices = data['mask_indices_tr'][sample_]
+                    tr_dict = {handles['mat_values_tr']:mat_values if lossfn == "mse" else one_hot(mat_values),
+                               handles['mask_indices_tr']:mask_indices,
+                               handles['mask_split']:np.ones_like(mat_values)
+                               }
+                    if sorted_segments:
+                        tr_dict[handles['col_perm_tr']] = column_permutation(mask_indices)
+                    grad, bloss_, brec_loss_ = sess.run([handles['flat_grad'], handles['total_loss'], handles['rec_loss']], feed_dict=tr_dict)
+                    # the losses and batch size ride along with the gradient, so every worker sees the global averages
+                    mean = allreduce.allreduce(rank, np.concatenate([grad, [bloss_, brec_loss_, mat_values.shape[0]]]))
+                    sess.run([handles['apply_step']] + handles['ema_op'], feed_dict={handles['flat_grad_in']:mean[:-3]})
+                    loss_tr_ += mean[-3]
+                    rec_loss_tr_ += np.sqrt(mean[-2])
+                    ratings += mean[-1] * workers
+                    steps_run += 1 # the sampler can run out before steps
+                took = time.time() - begin
+                steps_run = max(steps_run, 1)
+                losses["train"].append(loss_tr_ / steps_run)
+                losses["ratings_per_sec"].append(ratings / took)
+                if rank == 0:
+                    print("Data-parallel: epoch {:d} took {:.1f}s with {:d} workers, train loss {:.3f} (rec:{:.3f}), {:.0f} ratings/sec"
+                          .format(ep+1, took, workers, loss_tr_ / steps_run, rec_loss_tr_ / steps_run, ratings / took), file=LOG)
+                    if (ep+1) % opts.get("checkpoint_interval", 10000000) == 0 or ep+1 == opts['epochs'] + first_epoch:
+                        save_path = saver.save(sess, opts['ckpt_folder'] + "/%s_checkpt_ep_%05d.ckpt" % (opts.get('model_name', "test"), ep + 1))
+                        print("Model saved in file: %s" % save_path, file=LOG)
+                if opts.get('validate_interval', None) and (ep+1) % opts['validate_interval'] == 0:
+                    diverged = 0.
+                    if rank == 0:#the other workers wait in broadcast
+                        loss_val_, loss_ts_ = validate_and_test(sess, handles, data, opts, maxN, maxM, steps * workers)
+                        losses['valid'].append(loss_val_)
+                        losses['test'].append(loss_ts_)
+                        if loss_val_ < min_loss:
+                            min_loss, min_loss_epoch = loss_val_, ep+1
+                            if opts.get("save_best", False):
+                                save_path = saver.save(sess, opts['ckpt_folder'] + "/%s_best.ckpt" % opts.get('model_name', "test"))
+                                print("Model saved in file: %s" % save_path, file=LOG)
+                        print("Validation: epoch {:d} valid: {:.3f}; min valid loss: {:.3f} at epoch: {:d}; test loss: {:.3f}"
+                              .format(ep+1, loss_val_, min_loss, min_loss_epoch, loss_ts_), file=LOG)
+                        diverged = float(loss_val_ > min_loss * 1.075)
+                    if allreduce.broadcast(rank, diverged if rank == 0 else None)[0] > 0:
+                        break # overfitting: every worker stops when the validation loss diverges
+    if rank == 0:
+        if opts.get("export_inference", False) and opts.get("save_best", False) and min_loss_epoch > 0:
+            best_path = opts['ckpt_folder'] + "/%s_best.ckpt" % opts.get('model_name', "test")
+            frozen_path = export_inference_graph(opts, best_path, opts['ckpt_folder'] + "/%s_inference.pb" % opts.get('model_name', "test"), N, M,
+                                                 use_ema=opts.get("ema_decay", 1.) < 1.)
+            print("Inference graph saved in file: %s" % frozen_path, file=LOG)
+        results.put(losses)
+
+
+def train_data_parallel(opts, logfile=None, data=None, restore_point=None):
+    '''
+    Train with opts['workers'] worker processes and return the per-epoch training losses and ratings/sec and the
+    validation and test losses of worker 0. data defaults to the dataset at opts['data_path']; it is loaded once
+    and shared with the workers by fork. restore_point is a checkpoint to start from, as in main.
+    '''
+    opts = dict(opts, data_parallel=True)#build_model adds the flat gradient ops
+    workers = opts['workers']
+    if data is None:
+        data = load_data(opts)
+    N, M, _ = data['mat_shape']
+    allreduce = SharedAllReduce(workers, count_parameters(opts, N, M) + 3)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_worker, args=(rank, opts, data, allreduce, results, logfile, restore_point)) for rank in range(workers)]
+    for proc in procs:
+        proc.start()
+    try:
+        while True:
+            try:
+                losses = results.get(timeout=10)
+                break
+            except Empty:
+                if any(proc.exitcode not in (None, 0) for proc in procs):#a worker died, the others wait for it forever
+                    raise RuntimeError("data-parallel worker failed with exit codes %s" % [proc.exitcode for proc in procs])
+    finally:
+        for proc in procs:
+            proc.join(timeout=60)
+            if proc.is_alive():
+                proc.terminate()
+    return losses
@@ -231,6 +231,7 @@ if __name__ == "__main__":
                     'kernel_initializer': tf.random_normal_initializer(0, .01),
                     'regularizer': tf.contrib.keras.regularizers.l2(.00001),
                     'skip_connections':False,
+                    # 'row_block':256,#compute the outputs 256 rows at a time, so full N x M validation matrices fit in memory
                 },
                 'dense':{#not used
                     'activation':tf.nn.elu, 
@@ -5,6 +5,7 @@ import numpy as np
 from base import Model
 from util import get_data, to_indicator, to_number
 from sparse_util import sparse_tensordot_sparse, get_mask_indices
+from tf_helper import get_optimizer
 import math
 import time
 from tqdm import tqdm
@@ -164,7 +165,7 @@ def main(opts):
         mse_loss_train = rec_loss_fn(mat_raw, mask_tr, tf.reshape(tf.tensordot(tf.nn.softmax(out_tr), rng, idx), (maxN,maxM,1)))
         mse_loss_valid = rec_loss_fn(mat_raw_valid, mask_val, tf.reshape(tf.tensordot(tf.nn.softmax(out_val), rng, idx), (N,M,1)))
 
-        train_step = tf.train.AdamOptimizer(opts['lr']).minimize(total_loss)
+        train_step = get_optimizer(total_loss, opts)
         merged = tf.summary.merge_all()
         sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
         train_writer = tf.summary.FileWriter('logs/train', sess.graph)
@@ -298,6 +299,7 @@ if __name__ == "__main__":
                     'regularizer': tf.contrib.keras.regularizers.l2(.00001),
                     'skip_connections':False,
                     'overparam':False, # whether to use the different parameters for each movie/user 
+                    'sparse_updates':False, # True regularizes only the gathered rows of the overparameterized thetas, so that lazy_adam updates only those (the L2 term then depends on how often rows are sampled)
                 },
                 'dense':{#not used
                     'activation':tf.nn.elu, 
@@ -312,6 +314,7 @@ if __name__ == "__main__":
                 },                
             },
            'lr':learning_rate,
+           'optimizer':'adam',#'lazy_adam' only updates the rows in the batch, but does not decay the moments of the others
     }
     
     main(opts)
@@ -5,8 +5,56 @@ import tensorflow as tf
 from tensorflow.contrib.framework import add_arg_scope, model_variable
 from tf_helper import variable_summaries
 
+def leaky_relu(x):
+    '''Leaky ReLU with slope 0.01; a named function so that configs can be exported (see numpy_inference.py).'''
+    return tf.nn.relu(x) - 0.01*tf.nn.relu(-x)
+
 ##### Dense Layers: #####
 
+def add_regularization(tensor, layer_params):
+    '''Add the layer's regularizer applied to tensor (e.g. the gathered rows of a variable) to the regularization losses.'''
+    regularizer = layer_params.get('regularizer', None)
+    if regularizer is not None:
+        tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, regularizer(tensor))
+
+
+def _row_blocks(x, block):
+    '''x padded with zero rows to a multiple of block and reshaped to [n_blocks, block, ...].'''
+    N = x.get_shape().as_list()[0]
+    n_blocks = -(-N // block)
+    x = tf.pad(x, [[0, n_blocks * block - N]] + [[0, 0]] * (len(x.get_shape()) - 1))
+    return tf.reshape(x, [n_blocks, block] + x.get_shape().as_list()[1:])
+
+
+def map_row_blocks(fn, row_inputs, block):
+    '''
+    fn(*row_inputs) computed on consecutive blocks of <block> rows at a time (rows are the leading axis of
+    every tensor in row_inputs) and concatenated. Blocks run one after the other (tf.map_fn with
+    parallel_iterations=1), so only one block's intermediates are alive at a time; N is padded up to a
+    multiple of block. The concatenated output itself is of course full size.
+    '''
+    N = row_inputs[0].get_shape().as_list()[0]
+    blocks = tuple(_row_blocks(x, block) for x in row_inputs)
+    out = tf.map_fn(lambda xs: fn(*xs), blocks, dtype=tf.float32, parallel_iterations=1)
+    out = tf.reshape(out, [-1] + out.get_shape().as_list()[2:])
+    return out if out.get_shape().as_list()[0] == N else out[:N]
+
+
+def masked_sums_by_row_blocks(mat, mask, block):
+    '''
+    Sums of mat * mask over rows (1 x M x K) and over columns (N x 1 x K), computing mat * mask for
+    one block of rows at a time instead of for the whole N x M x K matrix.
+    '''
+    N = mat.get_shape().as_list()[0]
+    def block_sums(xs):
+        masked = xs[0] * xs[1]
+        return tf.reduce_sum(masked, axis=0, keep_dims=True), tf.reduce_sum(masked, axis=1, keep_dims=True)
+    col_sums, row_sums = tf.map_fn(block_sums, (_row_blocks(mat, block), _row_blocks(mask, block)),
+                                   dtype=(tf.float32, tf.float32), parallel_iterations=1)
+    row_sums = tf.reshape(row_sums, [-1] + row_sums.get_shape().as_list()[2:])[:N]
+    return tf.reduce_sum(col_sums, axis=0), row_sums
+
+
 def matrix_dense(
         inputs,
         layer_params,
@@ -38,44 +86,62 @@ def matrix_dense(
         mat = inputs.get('input', None)#N x M x K        
         mask = inputs.get('mask', None)#N x M
         skip_connections = layer_params.get('skip_connections', False)
-        output =  tf.convert_to_tensor(0, np.float32)
         config_string = "Using the following terms: "
         sign = 1
 
         overparam = layer_params.get('overparam', False)
+        # with sparse_updates the overparameterized thetas are only regularized on the rows gathered for this
+        # batch, so their gradients stay IndexedSlices and a lazy optimizer only touches those rows. This changes
+        # the objective: the L2 penalty of each row is weighted by how often the row is sampled
+        sparse_updates = layer_params.get('sparse_updates', False)
+        slice_regularizer = (lambda _: None) if sparse_updates else None
         indn = inputs['indn']
         indm = inputs['indm']
 
+        # Each term of the output is (sign, fn, row_inputs): fn maps the row_inputs (tensors with leading axis N),
+        # or a block of their rows, to a tensor broadcastable to [rows, M, units]. See combine_terms below.
+        terms = []
         if layer_params.get('bias', True):
             bias = model_variable("bias",shape=[units],trainable=True)
-            output += sign*bias
+            terms.append((sign, lambda: bias, []))
             sign *= -1
 
+        row_block = layer_params.get('row_block', None)#rows per block of the output computation, see below
         if mat is not None:#if we have an input matrix. If not, we only have nvec and mvec, i.e., user and movie properties                
             N,M,K = mat.get_shape().as_list()
+            blocked = row_block is not None and row_block < N
             norm_N = np.float32(N)
             norm_M = np.float32(M)
             norm_NM = np.float32(N*M)
+            # the masked input enters the output terms as masked_rows(*mat_rows), so that in row blocks
+            # mat * mask is only formed one block at a time
+            mat_rows, masked_rows = [mat], lambda mat_rows: mat_rows
             if mask is not None:                    
-                mat = mat * mask
                 norm_N = tf.reduce_sum(mask, axis=0, keep_dims=True) + eps# 1, M, 1
                 norm_M = tf.reduce_sum(mask, axis=1, keep_dims=True) + eps# N, 1, 1
                 norm_NM = tf.reduce_sum(mask, axis=[0,1], keep_dims=True) + eps# 1, 1, 1
+                if blocked:
+                    sum_0, sum_1 = masked_sums_by_row_blocks(mat, mask, row_block)
+                    mat_rows, masked_rows = [mat, mask], lambda mat_rows, mask_rows: mat_rows * mask_rows
+                else:
+                    mat = mat * mask
+                    mat_rows = [mat]
 
             if 'max' in layer_params.get('pool_mode', 'max') and mask is None:
                 mat_marg_0 = tf.reduce_max(mat, axis=0, keep_dims=True)
                 mat_marg_1 = tf.reduce_max(mat, axis=1, keep_dims=True)
                 mat_marg_2 = tf.reduce_max(mat_marg_0, axis=1, keep_dims=True)
             else:
-                mat_marg_0 = tf.reduce_sum(mat, axis=0, keep_dims=True)/norm_N # 1 x M x K
-                mat_marg_1 = tf.reduce_sum(mat, axis=1, keep_dims=True)/norm_M # N x 1 x K
+                if mask is None or not blocked:
+                    sum_0, sum_1 = tf.reduce_sum(mat, axis=0, keep_dims=True), tf.reduce_sum(mat, axis=1, keep_dims=True)
+                mat_marg_0 = sum_0/norm_N # 1 x M x K
+                mat_marg_1 = sum_1/norm_M # N x 1 x K
                 mat_marg_2 = tf.reduce_sum(mat_marg_0, axis=1, keep_dims=True)/norm_NM # 1 x 1 x K
 
             if layer_params.get('theta_0', True):
                 config_string += "theta 0, "
                 theta_0 = model_variable("theta_0",shape=[K, units],trainable=True)
-                output += sign*tf.tensordot(mat, theta_0, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32)) # N x M x units
-                output.set_shape([N,M,units])#because of current tensorflow bug!!
+                terms.append((sign, lambda *rows: tf.tensordot(masked_rows(*rows), theta_0, axes=[[2],[0]]), mat_rows)) # N x M x units
                 sign *= -1
             
             if layer_params.get('theta_1', True):
@@ -83,15 +149,15 @@ def matrix_dense(
 
                 if overparam:
                     MM = inputs['total_shape'][1]
-                    theta_1 = tf.get_variable('theta_1', shape=[MM,K,units], trainable=True)
+                    theta_1 = tf.get_variable('theta_1', shape=[MM,K,units], trainable=True, regularizer=slice_regularizer)
                     theta_1 = tf.gather(theta_1, indm, axis=0)
                     theta_1.set_shape([M,K,units]) 
-                    output += sign*tf.einsum('ijk,jkl->ijl', mat_marg_0, theta_1) # 1 x M x units
+                    if sparse_updates:
+                        add_regularization(theta_1, layer_params)
+                    terms.append((sign, lambda: tf.einsum('ijk,jkl->ijl', mat_marg_0, theta_1), [])) # 1 x M x units
                 else:
                     theta_1 = model_variable("theta_1",shape=[K, units],trainable=True)
-                    output += sign*tf.tensordot(mat_marg_0, theta_1, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32)) # 1 x M x units
-
-                output.set_shape([N,M,units])#because of current tensorflow bug!! 
+                    terms.append((sign, lambda: tf.tensordot(mat_marg_0, theta_1, axes=[[2],[0]]), [])) # 1 x M x units
                 sign *= -1
 
             if layer_params.get('theta_2', True):  
@@ -99,22 +165,21 @@ def matrix_dense(
 
                 if overparam:                    
                     NN = inputs['total_shape'][0]                    
-                    theta_2 = tf.get_variable('theta_2', shape=[NN,K,units], trainable=True)
+                    theta_2 = tf.get_variable('theta_2', shape=[NN,K,units], trainable=True, regularizer=slice_regularizer)
                     theta_2 = tf.gather(theta_2, indn, axis=0)
                     theta_2.set_shape([N,K,units])
-                    output += sign*tf.einsum('ijk,ikl->ijl', mat_marg_1, theta_2)
+                    if sparse_updates:
+                        add_regularization(theta_2, layer_params)
+                    terms.append((sign, lambda marg_rows, theta_rows: tf.einsum('ijk,ikl->ijl', marg_rows, theta_rows), [mat_marg_1, theta_2]))
                 else:
                     theta_2 = model_variable("theta_2", shape=[K,units], trainable=True)   
-                    output +=  sign *tf.tensordot(mat_marg_1, theta_2, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32)) # N x 1 x units
-
-                output.set_shape([N,M,units])#because of current tensorflow bug!!  
+                    terms.append((sign, lambda marg_rows: tf.tensordot(marg_rows, theta_2, axes=[[2],[0]]), [mat_marg_1])) # N x 1 x units
                 sign *= -1
 
             if layer_params.get('theta_3', True):
                 config_string += "theta 3, "
                 theta_3 = model_variable("theta_3",shape=[K, units],trainable=True)          
-                output +=  sign *tf.tensordot(mat_marg_2, theta_3, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32)) # 1 x 1 x units
-                output.set_shape([N,M,units])#because of current tensorflow bug!!            
+                terms.append((sign, lambda: tf.tensordot(mat_marg_2, theta_3, axes=[[2],[0]]), [])) # 1 x 1 x units
                 sign *= -1
               
 
@@ -126,9 +191,10 @@ def matrix_dense(
                 config_string += "bilinear, "
                 _,_,K = nvec.get_shape().as_list()
                 theta_6 = model_variable("theta_6", shape=[K, K, units], trainable=True)
-                output_n = tf.reduce_sum(nvec[:,:,:,None,None] * theta_6[None, None, :, :, :], axis=2)
-                output_m = tf.reduce_sum(output_n * mvec[:, :, :, None], axis=2)
-                output +=  sign *output_m
+                def bilinear(nvec_rows):
+                    output_n = tf.reduce_sum(nvec_rows[:,:,:,None,None] * theta_6[None, None, :, :, :], axis=2)
+                    return tf.reduce_sum(output_n * mvec[:, :, :, None], axis=2)
+                terms.append((sign, bilinear, [nvec]))
                 sign *= -1
 
         if layer_params.get('theta_4', True):
@@ -136,9 +202,7 @@ def matrix_dense(
                 config_string += "theta 4, "
                 N,_,K = nvec.get_shape().as_list()
                 theta_4 = model_variable("theta_4",shape=[K, units],trainable=True)
-                output_tmp = tf.tensordot(nvec, theta_4, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32))# N x 1 x units
-                output_tmp.set_shape([N,1,units])#because of current tensorflow bug!!
-                output += sign * output_tmp
+                terms.append((sign, lambda nvec_rows: tf.tensordot(nvec_rows, theta_4, axes=[[2],[0]]), [nvec]))# N x 1 x units
                 sign *= -1
 
         if layer_params.get('theta_5', True):
@@ -146,18 +210,35 @@ def matrix_dense(
                 config_string += "theta 5, "
                 _,M,K = mvec.get_shape().as_list()
                 theta_5 = model_variable("theta_5",shape=[K, units],trainable=True)
-                output_tmp = tf.tensordot(mvec, theta_5, axes=tf.convert_to_tensor([[2],[0]], dtype=np.int32))# 1 x M x units
-                output_tmp.set_shape([1,M,units])#because of current tensorflow bug!!
-                output +=  sign *output_tmp
+                terms.append((sign, lambda: tf.tensordot(mvec, theta_5, axes=[[2],[0]]), []))# 1 x M x units
                 sign *= -1
 
-        if layer_params.get('activation', None) is not None:
-            output = layer_params.get('activation')(output)
+        skip = skip_connections and mat is not None and K == units
+        if skip:
+            config_string += "with skip connections"
+        row_inputs = [x for _, _, rows in terms for x in rows] + (mat_rows if skip else [])
+
+        def combine_terms(*rows):#the layer output for a block of rows of row_inputs
+            rows = list(rows)
+            output = tf.convert_to_tensor(0, np.float32)
+            for term_sign, fn, term_rows in terms:
+                output += term_sign * fn(*[rows.pop(0) for _ in term_rows])
+            if layer_params.get('activation', None) is not None:
+                output = layer_params.get('activation')(output)
+            if skip:
+                output = output + masked_rows(*rows)
+            return output
+
+        # In blocks of row_block rows, the per-term products, the activation and (with a mask) the masked input
+        # are only formed for row_block x M at a time; the layer's input and output are still full N x M tensors.
+        n_rows = row_inputs[0].get_shape().as_list()[0] if row_inputs else None
+        if row_block is not None and n_rows is not None and row_block < n_rows:
+            config_string += "in blocks of %d rows" % row_block
+            output = map_row_blocks(combine_terms, row_inputs, row_block)
+        else:
+            output = combine_terms(*row_inputs)
         if layer_params.get('drop_mask', True):
             mask = None
-        if skip_connections and mat is not None and K == units:
-            config_string += "with skip connections"
-            output = output + mat
 
         print(config_string)
         outdic = {'input':output, 'mask':mask, 'total_shape':inputs['total_shape'], 'indn':indn, 'indm':indm}
@@ -206,7 +287,7 @@ def channel_dropout_sparse(inputs, layer_params, verbose=1, scope=None,
     out = tf.layers.dropout(tf.reshape(inp_values, [-1, units]), rate = rate, training=is_training)
     out = tf.reshape(out, [-1])
 
-    return {'input':out, 'mask_indices':mask_indices, 'units':units, 'shape':shape}
+    return {'input':out, 'mask_indices':mask_indices, 'units':units, 'shape':shape, 'plan':inputs.get('plan', None)}
 
 def matrix_dropout(inputs,#dropout along both axes
                    layer_params,
@@ -227,22 +308,19 @@ def matrix_dropout(inputs,#dropout along both axes
     return outdic
 
 
-def weighted_mean_reduce(mask_indices, mat_values, K, shape, logweights=None, axis=None, weight_scale=10.):
+def weighted_mean_reduce(mask_indices, mat_values, K, shape, logweights=None, axis=None, weight_scale=10., plan=None):
     eps = tf.convert_to_tensor(1e-3, dtype=np.float32)
+    if plan is None:
+        plan = SparseIndexPlan(mask_indices, shape)
     if logweights is None:
-        weights = tf.ones_like(mat_values)
-        weighted_values = mat_values
+        stats = sparse_segment_stats(mat_values, K, plan, axis=axis, stats=('sum', 'count'))
+        mean = stats['sum'] / (stats['count'] + eps)
     else:
-        weights = tf.exp(weight_scale * (logweights - tf.reduce_max(logweights))) # prevent overflow
-        weights = tf.reshape(weights, shape=[-1,K])
+        logits = tf.reshape(weight_scale * logweights, shape=[-1,K])
         if axis is not None:
-            weights = tf.gather(weights, mask_indices[:,axis])
-        weighted_values = weights * tf.reshape(mat_values, shape=[-1,K])
-        weighted_values = tf.reshape(weighted_values, [-1])
-        weights = tf.reshape(weights, [-1])
-
-    norm = sparse_reduce(mask_indices, weights, K, shape=shape, mode='sum', axis=axis, keep_dims=True) + eps # 1 x M x K
-    return sparse_reduce(mask_indices, weighted_values, K, shape=shape, mode='sum', axis=axis, keep_dims=True) / norm
+            logits = tf.gather(logits, plan.row_ids if axis == 0 else plan.col_ids)
+        mean = sparse_segment_softmax_mean(mat_values, logits, K, plan, axis=axis, eps=eps) # attention: softmax over each segment
+    return tf.expand_dims(mean, axis=0 if axis is None else axis) # 1 x M x K, N x 1 x K or 1 x 1 x K
             
 
 ##### Sparse Layers: #####
@@ -273,35 +351,52 @@ def matrix_sparse(
         skip_connections = layer_params.get('skip_connections', False)
         shape = inputs['shape']
         N,M = shape
+        plan = get_index_plan(inputs)
         
         K = inputs['units']
 
         output =  tf.convert_to_tensor(0, np.float32)
 
-        if mat_values is not None:#if we have an input matrix. If not, we only have nvec and mvec, i.e., user and movie properties
-            if 'max' in layer_params.get('pool_mode', 'max'):
-                mat_marg_0 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=0, keep_dims=True) 
-                mat_marg_1 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=1, keep_dims=True)
-                mat_marg_2 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=None, keep_dims=True)
-            elif layer_params['pool_mode'] == 'mean':
-                mat_marg_0 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_row', None), axis=0) # 1 x M x K
-                mat_marg_1 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_col', None), axis=1) # N x 1 x K
-                mat_marg_2 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_both', None), axis=None) # 1 x 1 x K
-            else:
-                raise KeyError("Unrecognised pool mode: %s" % layer_params["pool_mode"])
+        if mat_values is None and layer_params.get('dropout', 0.) > 0.:
+            raise ValueError("dropout is applied to the input values, but this layer only has nvec/mvec inputs")
+        if mat_values is not None and layer_params.get('dropout', 0.) > 0.:
+            # dropout on the input values, in place of a channel_dropout_sparse/matrix_dropout_sparse layer before this one
+            mat_values = tf.reshape(sparse_dropout_values(tf.reshape(mat_values, [-1,K]), layer_params['dropout'],
+                                                          layer_params.get('dropout_mode', 'channel'), plan,
+                                                          training=kwargs.get('is_training', True)), [-1])
 
+        if mat_values is not None:#if we have an input matrix. If not, we only have nvec and mvec, i.e., user and movie properties
             theta_0 = model_variable("theta_0", shape=[K,units], trainable=True, dtype=tf.float32)
             theta_1 = model_variable("theta_1", shape=[K,units], trainable=True, dtype=tf.float32)
             theta_2 = model_variable("theta_2", shape=[K,units], trainable=True, dtype=tf.float32)
             theta_3 = model_variable("theta_3", shape=[K,units], trainable=True, dtype=tf.float32)
-            
-            output = sparse_tensordot_sparse(mat_values, theta_0, K)
-            output_0 = tf.tensordot(mat_marg_0, theta_1, axes=[[2],[0]]) # 1 x M x units
-            output = sparse_tensor_broadcast_dense_add(output, output_0, mask_indices, units, broadcast_axis=0)
-            output_1 = tf.tensordot(mat_marg_1, theta_2, axes=[[2],[0]]) # N x 1 x units
-            output = sparse_tensor_broadcast_dense_add(output, output_1, mask_indices, units, broadcast_axis=1)
-            output_2 = tf.tensordot(mat_marg_2, theta_3, axes=[[2],[0]]) # 1 x 1 x units
-            output = sparse_tensor_broadcast_dense_add(output, output_2, mask_indices, units, broadcast_axis=None)
+
+            # the fused op only covers unweighted mean pooling, and its marginals stay internal
+            fused = (layer_params.get('fused', False) and layer_params.get('pool_mode', 'max') == 'mean'
+                     and not layer_params.get('attention_pooling', False)
+                     and all(inputs.get(w, None) is None for w in ['weights_row', 'weights_col', 'weights_both']))
+
+            if fused:
+                output = sparse_exchangeable_mean(mat_values, [theta_0, theta_1, theta_2, theta_3], K, units, plan)
+            else:
+                if 'max' in layer_params.get('pool_mode', 'max'):
+                    mat_marg_0 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=0, keep_dims=True, plan=plan) 
+                    mat_marg_1 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=1, keep_dims=True, plan=plan)
+                    mat_marg_2 = sparse_reduce(mask_indices, mat_values, K, shape=shape, mode='max', axis=None, keep_dims=True, plan=plan)
+                elif layer_params['pool_mode'] == 'mean':
+                    mat_marg_0 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_row', None), axis=0, plan=plan) # 1 x M x K
+                    mat_marg_1 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_col', None), axis=1, plan=plan) # N x 1 x K
+                    mat_marg_2 = weighted_mean_reduce(mask_indices, mat_values, K, shape=shape, logweights=inputs.get('weights_both', None), axis=None, plan=plan) # 1 x 1 x K
+                else:
+                    raise KeyError("Unrecognised pool mode: %s" % layer_params["pool_mode"])
+
+                output = sparse_tensordot_sparse(mat_values, theta_0, K)
+                output_0 = tf.tensordot(mat_marg_0, theta_1, axes=[[2],[0]]) # 1 x M x units
+                output = sparse_tensor_broadcast_dense_add(output, output_0, mask_indices, units, broadcast_axis=0, plan=plan)
+                output_1 = tf.tensordot(mat_marg_1, theta_2, axes=[[2],[0]]) # N x 1 x units
+                output = sparse_tensor_broadcast_dense_add(output, output_1, mask_indices, units, broadcast_axis=1, plan=plan)
+                output_2 = tf.tensordot(mat_marg_2, theta_3, axes=[[2],[0]]) # 1 x 1 x units
+                output = sparse_tensor_broadcast_dense_add(output, output_2, mask_indices, units, broadcast_axis=None, plan=plan)
 
         nvec = inputs.get('nvec', None)
         mvec = inputs.get('mvec', None)
@@ -311,7 +406,7 @@ def matrix_sparse(
             output_tmp = tf.tensordot(nvec, theta_4, axes=[[2],[0]])# N x 1 x units
             output_tmp.set_shape([N,1,units])#because of current tensorflow bug!!
             if mat_values is not None:
-                output = sparse_tensor_broadcast_dense_add(output, output_tmp, mask_indices, units, broadcast_axis=1)
+                output = sparse_tensor_broadcast_dense_add(output, output_tmp, mask_indices, units, broadcast_axis=1, plan=plan)
             else:     
                 # output = output + output_tmp
                 output = dense_vector_to_sparse_values(output_tmp, mask_indices) + output
@@ -321,21 +416,25 @@ def matrix_sparse(
             output_tmp = tf.tensordot(mvec, theta_5, axes=[[2],[0]])# 1 x M x units
             output_tmp.set_shape([1,M,units])#because of current tensorflow bug!!
             if mat_values is not None:
-                output = sparse_tensor_broadcast_dense_add(output, output_tmp, mask_indices, units, broadcast_axis=0)
+                output = sparse_tensor_broadcast_dense_add(output, output_tmp, mask_indices, units, broadcast_axis=0, plan=plan)
             else:
                 # output = output + output_tmp
                 output = dense_vector_to_sparse_values(output_tmp, mask_indices) + output
 
         if layer_params.get("individual_bias", False):
             # for testing my individual bias idea - I don't think it is helpful
-            print("Using individual bias in scope %s" % tf.contrib.framework.get_name_scope(), kwargs["sizes"])
-            row_bias = model_variable("row_bias",shape=[kwargs["sizes"][0]],trainable=True)
-            column_bias = model_variable("column_bias",shape=[kwargs["sizes"][1]],trainable=True)
-            #mask_indices = tf.cast(mask_indices, dtype=tf.float32) 
-            r_bias = tf.reshape(tf.gather(column_bias, inputs['col']), (1, -1, 1))
-            c_bias = tf.reshape(tf.gather(row_bias, inputs['row']), (-1, 1, 1))
-            output += r_bias - tf.reduce_mean(r_bias)
-            output += c_bias - tf.reduce_mean(c_bias)
+            if verbose == 1:
+                print("Using individual bias in scope %s" % tf.contrib.framework.get_name_scope(), shape)
+            # [N] and [M] biases gathered per non-zero, so their gradients are IndexedSlices over the rows/columns
+            # in the batch; they are regularized on the gathered entries only (see add_regularization)
+            row_bias = model_variable("row_bias", shape=[N], trainable=True, initializer=tf.zeros_initializer(), regularizer=lambda _: None)
+            column_bias = model_variable("column_bias", shape=[M], trainable=True, initializer=tf.zeros_initializer(), regularizer=lambda _: None)
+            r_bias = tf.gather(row_bias, plan.row_ids) # nnz
+            c_bias = tf.gather(column_bias, plan.col_ids) # nnz
+            add_regularization(r_bias, layer_params)
+            add_regularization(c_bias, layer_params)
+            bias = (r_bias - tf.reduce_mean(r_bias)) + (c_bias - tf.reduce_mean(c_bias))
+            output = tf.reshape(tf.reshape(output, [-1,units]) + tf.expand_dims(bias, axis=1), [-1])
         
         if layer_params.get('activation', None) is not None:
             if verbose == 1:
@@ -348,7 +447,7 @@ def matrix_sparse(
         # if mat_values is None:
             # output = dense_tensor_to_sparse_values(output, mask_indices, units)
 
-        outdic = {'input':output, 'mask_indices':mask_indices, 'units':units, 'shape':shape}
+        outdic = {'input':output, 'mask_indices':mask_indices, 'units':units, 'shape':shape, 'plan':plan}
         if layer_params.get("attention_pooling", False):
             gamma_0 = model_variable("gamma_0", shape=[K,units], trainable=True, dtype=tf.float32)
             gamma_1 = model_variable("gamma_1", shape=[K,units], trainable=True, dtype=tf.float32)
@@ -377,6 +476,7 @@ def matrix_pool_sparse(inputs,#pool the tensor: input: N x M x K along two dimen
     mode = layer_params.get('mode', 'dense')
     shape = inputs['shape']
     N,M = shape
+    plan = get_index_plan(inputs)
 
     eps = tf.convert_to_tensor(1e-3, dtype=np.float32)
     with tf.variable_scope(scope, default_name="matrix_sparse"):
@@ -385,20 +485,20 @@ def matrix_pool_sparse(inputs,#pool the tensor: input: N x M x K along two dimen
         theta_m = model_variable("theta_m", shape=[units_in,units_in], trainable=True, dtype=tf.float32)
         
         if pool_mode is 'mean':
-            norm_0 = sparse_marginalize_mask(mask_indices, shape=shape, axis=0, keep_dims=True) + eps
-            norm_1 = sparse_marginalize_mask(mask_indices, shape=shape, axis=1, keep_dims=True) + eps
-            nvec = sparse_reduce(mask_indices, inp_values, units_in, mode='sum', shape=shape, axis=1, keep_dims=True) / norm_1
-            mvec = sparse_reduce(mask_indices, inp_values, units_in, mode='sum', shape=shape, axis=0, keep_dims=True) / norm_0
+            stats_1 = sparse_segment_stats(inp_values, units_in, plan, axis=1)
+            stats_0 = sparse_segment_stats(inp_values, units_in, plan, axis=0)
+            nvec = tf.expand_dims(stats_1['sum'] / (stats_1['count'] + eps), axis=1)
+            mvec = tf.expand_dims(stats_0['sum'] / (stats_0['count'] + eps), axis=0)
         else:
-            nvec = sparse_reduce(mask_indices, inp_values, units_in, mode=pool_mode, shape=shape, axis=1, keep_dims=True)
-            mvec = sparse_reduce(mask_indices, inp_values, units_in, mode=pool_mode, shape=shape, axis=0, keep_dims=True)
+            nvec = sparse_reduce(mask_indices, inp_values, units_in, mode=pool_mode, shape=shape, axis=1, keep_dims=True, plan=plan)
+            mvec = sparse_reduce(mask_indices, inp_values, units_in, mode=pool_mode, shape=shape, axis=0, keep_dims=True, plan=plan)
 
         nvec = tf.tensordot(nvec, theta_n, axes=1)
         nvec.set_shape([N,1,units_in])#because of current tensorflow bug!!
         mvec = tf.tensordot(mvec, theta_m, axes=1)
         mvec.set_shape([1,M,units_in])#because of current tensorflow bug!!
 
-        outdic = {'nvec':nvec, 'mvec':mvec, 'mask_indices':mask_indices, 'units':units_in, 'shape':shape}
+        outdic = {'nvec':nvec, 'mvec':mvec, 'mask_indices':mask_indices, 'units':units_in, 'shape':shape, 'plan':plan}
         return outdic             
         
 
@@ -415,10 +515,102 @@ def matrix_dropout_sparse(inputs,
     mask_indices = inputs.get('mask_indices', None)
     units = inputs['units']
     N,M = inputs['shape']
+    plan = get_index_plan(inputs)
    
     # out = sparse_dropout(inp_values, units, rate=rate, training=is_training)
-    out = sparse_dropout_row_col(inp_values, mask_indices, [N,M,units], rate=rate, training=is_training)
+    out = sparse_dropout_row_col(inp_values, mask_indices, [N,M,units], rate=rate, training=is_training, plan=plan)
+
+    return {'input':out, 'mask_indices':mask_indices, 'units':units, 'shape':[N,M], 'plan':plan}
+
+
 
-    return {'input':out, 'mask_indices':mask_indices, 'units':units, 'shape':[N,M]}
 
+##### Sparse Tensor Layers: #####
 
+def tensor_sparse(
+        inputs,
+        layer_params,
+        reuse = None,
+        scope = None,
+        verbose = 1,
+        **kwargs
+        ):
+    '''
+    Exchangeable layer for a sparse tensor with D modes (e.g. user x item x context), the D-mode version of matrix_sparse.
+    input: nnz*K values at mask_indices [nnz, D] of a tensor of shape [N_0, ..., N_{D-1}]
+    vecs: optional list of D per-mode features [N_d, K'] (see tensor_pool_sparse)
+    There is one parameter matrix per subset of pooled axes: theta_<c> pools over the axes d with bit d set in c,
+    so for D = 2 theta_0 to theta_3 are those of matrix_sparse.
+    '''
+    units = layer_params.get('units')
+
+    if not scope:
+        scope = "tensor_sparse"
+    with tf.variable_scope(scope, default_name="tensor_sparse",
+                               initializer=layer_params.get('kernel_initializer', None),
+                               regularizer=layer_params.get('regularizer', None),
+                               reuse=reuse,
+                               ):
+        assert('vecs' in inputs or 'input' in inputs)
+
+        values = inputs.get('input', None)
+        mask_indices = inputs['mask_indices']
+        shape = inputs['shape']
+        num_modes = len(shape)
+        skip_connections = layer_params.get('skip_connections', False)
+        pool_mode = layer_params.get('pool_mode', 'max')
+        plan = get_tensor_index_plan(inputs)
+        K = inputs['units']
+
+        output = tf.convert_to_tensor(0, np.float32)
+        if values is not None:
+            vals = tf.reshape(values, [-1,K])
+            for code in range(2**num_modes):
+                axes = tuple(d for d in range(num_modes) if code & (1 << d))
+                theta = model_variable("theta_%d" % code, shape=[K,units], trainable=True)
+                if len(axes) == 0:
+                    output += tf.matmul(vals, theta) # nnz x units
+                else:
+                    marg = tf.matmul(sparse_tensor_marginal(vals, K, plan, axes, pool_mode=pool_mode), theta) # segments x units
+                    output += marg if len(axes) == num_modes else tf.gather(marg, plan.segment_ids(axes))
+
+        vecs = inputs.get('vecs', None)
+        if vecs is not None:
+            for d, vec in enumerate(vecs):
+                phi = model_variable("phi_%d" % d, shape=[vec.get_shape().as_list()[-1], units], trainable=True)
+                pooled = tuple(a for a in range(num_modes) if a != d)
+                output += tf.gather(tf.matmul(vec, phi), plan.segment_ids(pooled)) # nnz x units
+
+        if layer_params.get('activation', None) is not None:
+            output = layer_params.get('activation')(output)
+
+        if skip_connections and values is not None and K == units:
+            output = output + vals
+
+        return {'input':tf.reshape(output, [-1]), 'mask_indices':mask_indices, 'units':units, 'shape':shape, 'plan':plan}
+
+
+def tensor_pool_sparse(inputs,#pool a sparse tensor with D modes into one feature vector per index of each mode
+                       layer_params,
+                       verbose=1,
+                       scope=None,
+                       **kwargs
+                       ):
+    inp_values = inputs['input']
+    units_in = inputs['units']
+    mask_indices = inputs['mask_indices']
+    shape = inputs['shape']
+    num_modes = len(shape)
+    pool_mode = layer_params.get('pool_mode', 'max')#max or average pooling
+    plan = get_tensor_index_plan(inputs)
+
+    with tf.variable_scope(scope, default_name="tensor_pool_sparse"):
+        vecs = []
+        for d in range(num_modes):
+            theta = model_variable("theta_pool_%d" % d, shape=[units_in,units_in], trainable=True, dtype=tf.float32)
+            pooled = tuple(a for a in range(num_modes) if a != d)
+            vec = tf.matmul(sparse_tensor_marginal(inp_values, units_in, plan, pooled, pool_mode=pool_mode), theta)
+            vec.set_shape([shape[d], units_in])
+            vecs.append(vec) # N_d x units_in
+
+        return {'vecs':vecs, 'mask_indices':mask_indices, 'units':units_in, 'shape':shape, 'plan':plan}
@@ -0,0 +1,341 @@
+from __future__ import print_function
+'''
+NumPy forward pass of trained sparse factorized autoencoders, for scoring without TensorFlow.
+
+Weights are exported once from a tf.train.Saver checkpoint written by sparse_factorized_autoencoder.main
+(this is the only part that imports TensorFlow):
+
+    export_model(opts, "checkpoints/factorized_ae/noatt_fac_ae_best.ckpt", "model.npz", use_ema=True)
+
+and then scored with numpy only:
+
+    model = load_model("model.npz")
+    predictions = predict(model, mat_values, mask_indices, mask_indices_pred, shape=[N,M])
+
+For all non-zeros of a large matrix, predict(..., chunk_size=100000) streams them in chunks with exact
+marginals (get_output_streaming), so memory does not grow with nnz x units. Models with attention_pooling
+layers need the logits of all non-zeros at once and are scored without chunk_size.
+
+The layer functions mirror their TensorFlow counterparts in layers.py, with 2D [nnz, units] values
+and [N, units]/[M, units] nvec/mvec. Segment reductions use np.bincount.
+'''
+import json
+import numpy as np
+
+EPS = np.float32(1e-3)
+
+ACTIVATIONS = {'relu':lambda x: np.maximum(x, 0),
+               'leaky_relu':lambda x: np.maximum(x, 0) - 0.01 * np.maximum(-x, 0),
+               'elu':lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+               'tanh':np.tanh,
+               'sigmoid':lambda x: 1. / (1. + np.exp(-x)),
+               }
+
+
+def activation_name(fn):
+    '''
+    Name of a layer activation in ACTIVATIONS, or None for no activation. Activations are matched by identity,
+    not by __name__: tf.nn.leaky_relu is also called leaky_relu but has slope 0.2 instead of layers.leaky_relu's 0.01.
+    '''
+    import tensorflow as tf
+    import layers
+    if fn is None:
+        return None
+    known = [(tf.nn.relu, 'relu'), (layers.leaky_relu, 'leaky_relu'), (tf.nn.elu, 'elu'),
+             (tf.nn.tanh, 'tanh'), (tf.tanh, 'tanh'), (tf.nn.sigmoid, 'sigmoid'), (tf.sigmoid, 'sigmoid')]
+    for known_fn, name in known:
+        if fn is known_fn:
+            return name
+    raise KeyError("No numpy version of activation %s; use one of tf.nn.relu, layers.leaky_relu, tf.nn.elu, tf.nn.tanh or tf.nn.sigmoid"
+                   % getattr(fn, '__name__', fn))
+
+
+def architecture(layers, layer_defaults):
+    '''JSON-serializable copy of a layer list with defaults filled in (as base.Model.setup does), keeping only what inference needs.'''
+    keys = ['type', 'units', 'pool_mode', 'skip_connections', 'attention_pooling', 'individual_bias']
+    arch = []
+    for layer in layers:
+        params = dict(layer_defaults.get(layer['type'], {}), **layer)
+        spec = {key:params[key] for key in keys if key in params}
+        spec['activation'] = activation_name(params.get('activation', None))
+        arch.append(spec)
+    return arch
+
+
+def export_model(opts, checkpoint, path, use_ema=False):
+    '''Write the encoder/decoder weights of a checkpoint and the architecture in opts to an npz file.
+
+    With use_ema, the ExponentialMovingAverage shadow of each variable is exported when present,
+    which is what the validation graph in sparse_factorized_autoencoder.main evaluates.
+    '''
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    names = reader.get_variable_to_shape_map().keys()
+    weights = {}
+    for name in names:
+        if not (name.startswith('encoder/') or name.startswith('decoder/')) or name.split('/')[-1] in ['Adam', 'Adam_1', 'ExponentialMovingAverage']:
+            continue
+        ema_name = name + '/ExponentialMovingAverage'
+        weights[name] = reader.get_tensor(ema_name if use_ema and ema_name in names else name)
+    arch = {'encoder':architecture(opts['encoder'], opts['defaults']),
+            'decoder':architecture(opts['decoder'], opts['defaults']),
+            'loss':opts.get('loss', 'mse')}
+    np.savez(path, __architecture__=np.array(json.dumps(arch)), **weights)
+
+
+def load_model(path):
+    '''Load an exported model: {'architecture':..., 'weights':{name:array}}.'''
+    with np.load(path) as f:
+        weights = {name:f[name].astype(np.float32) for name in f.files if name != '__architecture__'}
+        arch = json.loads(str(f['__architecture__']))
+    return {'architecture':arch, 'weights':weights}
+
+
+##### segment reductions #####
+
+def segment_sum(values, ids, num_segments):
+    '''[nnz, K] -> [num_segments, K] sums of the rows of values sharing an id.'''
+    return np.stack([np.bincount(ids, weights=values[:,k], minlength=num_segments) for k in range(values.shape[1])], axis=1).astype(np.float32)
+
+
+def segment_count(ids, num_segments):
+    return np.bincount(ids, minlength=num_segments).astype(np.float32)[:,None]
+
+
+class MarginalAccumulator(object):
+    '''
+    Column, row and global marginals of [nnz, K] values that arrive in chunks of non-zeros.
+    Mean pooling keeps running sums and counts, max pooling running maxima, so the marginals are exact
+    whatever the chunking, in O((N + M) K) memory.
+    '''
+    def __init__(self, shape, pool_mode):
+        if 'max' not in pool_mode and pool_mode != 'mean':
+            raise KeyError("Unrecognised pool mode: %s" % pool_mode)
+        self.shape = shape
+        self.pool_mode = pool_mode
+        self.stats = None
+
+    def add(self, values, mask_indices):
+        N, M = self.shape
+        rows, cols = mask_indices[:,0], mask_indices[:,1]
+        K = values.shape[1]
+        if 'max' in self.pool_mode:
+            if self.stats is None:
+                self.stats = [np.full((M, K), -np.inf, dtype=np.float32), np.full((N, K), -np.inf, dtype=np.float32),
+                              np.full((1, K), -np.inf, dtype=np.float32)]
+            np.maximum.at(self.stats[0], cols, values)
+            np.maximum.at(self.stats[1], rows, values)
+            if values.shape[0] > 0:
+                np.maximum(self.stats[2], values.max(axis=0, keepdims=True), out=self.stats[2])
+        else:
+            stats = [segment_sum(values, cols, M), segment_sum(values, rows, N), values.sum(axis=0, keepdims=True),
+                     segment_count(cols, M), segment_count(rows, N), np.float32(values.shape[0])]
+            self.stats = stats if self.stats is None else [acc + stat for acc, stat in zip(self.stats, stats)]
+
+    def marginals(self):
+        '''[M, K], [N, K] and [1, K] marginals; empty rows/columns are 0 as in sparse_reduce.'''
+        if 'max' in self.pool_mode:
+            margs = [stat.copy() for stat in self.stats]
+            for marg in margs:
+                marg[np.isinf(marg)] = 0.
+            return margs
+        col_sum, row_sum, total, col_count, row_count, nnz = self.stats
+        return col_sum / (col_count + EPS), row_sum / (row_count + EPS), total / (nnz + EPS)
+
+
+def marginals(values, mask_indices, shape, pool_mode):
+    '''Column, row and global marginals of [nnz, K] values: [M, K], [N, K], [1, K].'''
+    acc = MarginalAccumulator(shape, pool_mode)
+    acc.add(values, mask_indices)
+    return acc.marginals()
+
+
+ATTENTION_WEIGHTS = ['weights_row', 'weights_col', 'weights_both']
+
+def segment_softmax_mean(values, logits, ids, num_segments):
+    '''[nnz, K] values averaged per segment with the softmax of [nnz, K] logits within the segment as weights
+    (sparse_util.sparse_segment_softmax_mean); ids=None is a single segment.'''
+    if ids is None:
+        weights = np.exp(logits - logits.max(axis=0, keepdims=True))
+        return (weights * values).sum(axis=0, keepdims=True) / (weights.sum(axis=0, keepdims=True) + EPS)
+    logits_max = np.full((num_segments, logits.shape[1]), -np.inf, dtype=np.float32)
+    np.maximum.at(logits_max, ids, logits)
+    weights = np.exp(logits - logits_max[ids])
+    return segment_sum(weights * values, ids, num_segments) / (segment_sum(weights, ids, num_segments) + EPS)
+
+
+def attention_marginals(values, mask_indices, shape, inputs, weight_scale=10.):
+    '''
+    Mean-pooling marginals where the weights_row/weights_col/weights_both logits of an attention_pooling layer
+    below replace the plain means by softmax-weighted ones, as layers.weighted_mean_reduce does.
+    '''
+    N, M = shape
+    K = values.shape[1]
+    rows, cols = mask_indices[:,0], mask_indices[:,1]
+    margs = list(marginals(values, mask_indices, shape, 'mean'))
+    # marginal i: (logits, what they are gathered by, segment ids, number of segments)
+    for i, (key, gather, ids, num_segments) in enumerate([('weights_row', rows, cols, M),
+                                                          ('weights_col', cols, rows, N),
+                                                          ('weights_both', None, None, 1)]):
+        if inputs.get(key, None) is None:
+            continue
+        logits = weight_scale * np.reshape(inputs[key], [-1, K]).astype(np.float32)
+        if gather is not None:
+            logits = logits[gather]
+        margs[i] = segment_softmax_mean(values, logits, ids, num_segments).astype(np.float32)
+    return margs
+
+
+##### layers #####
+# margs and bias_means, if given, are the marginals of the layer input and the means of the gathered
+# individual biases over the whole matrix (see get_output_streaming); otherwise they are computed from inputs.
+
+def matrix_sparse(inputs, spec, weights, prefix, margs=None, bias_means=None):
+    mat_values = inputs.get('input', None)
+    mask_indices = inputs['mask_indices']
+    rows, cols = mask_indices[:,0], mask_indices[:,1]
+    output = np.float32(0)
+    if mat_values is not None:
+        if margs is None and spec.get('pool_mode', 'max') == 'mean' and any(inputs.get(key, None) is not None for key in ATTENTION_WEIGHTS):
+            margs = attention_marginals(mat_values, mask_indices, inputs['shape'], inputs)
+        elif margs is None:
+            margs = marginals(mat_values, mask_indices, inputs['shape'], spec.get('pool_mode', 'max'))
+        marg_0, marg_1, marg_2 = margs
+        output = (mat_values.dot(weights[prefix + 'theta_0'])
+                  + marg_0.dot(weights[prefix + 'theta_1'])[cols]
+                  + marg_1.dot(weights[prefix + 'theta_2'])[rows]
+                  + marg_2.dot(weights[prefix + 'theta_3']))
+    if inputs.get('nvec', None) is not None:
+        output = output + inputs['nvec'].dot(weights[prefix + 'theta_4'])[rows]
+    if inputs.get('mvec', None) is not None:
+        output = output + inputs['mvec'].dot(weights[prefix + 'theta_5'])[cols]
+    if spec.get('individual_bias', False):
+        r_bias, c_bias = weights[prefix + 'row_bias'][rows], weights[prefix + 'column_bias'][cols]
+        if bias_means is None:
+            bias_means = r_bias.mean(), c_bias.mean()
+        output = output + ((r_bias - bias_means[0]) + (c_bias - bias_means[1]))[:,None]
+    if spec.get('activation', None) is not None:
+        output = ACTIVATIONS[spec['activation']](output)
+    if spec.get('skip_connections', False) and mat_values is not None and mat_values.shape[1] == output.shape[1]:
+        output = output + mat_values
+    outputs = {'input':output.astype(np.float32), 'mask_indices':mask_indices, 'shape':inputs['shape']}
+    if spec.get('attention_pooling', False):#logits for the pooling of the next layer
+        if mat_values is not None:
+            outputs['weights_row'] = margs[1].dot(weights[prefix + 'gamma_2'])
+            outputs['weights_col'] = margs[0].dot(weights[prefix + 'gamma_1'])
+            outputs['weights_both'] = mat_values.dot(weights[prefix + 'gamma_0'])
+        else:
+            outputs['weights_row'] = inputs['nvec'].dot(weights[prefix + 'gamma_2'])
+            outputs['weights_col'] = inputs['mvec'].dot(weights[prefix + 'gamma_1'])
+    return outputs
+
+
+def matrix_pool_sparse(inputs, spec, weights, prefix, margs=None):
+    if margs is None:
+        margs = marginals(inputs['input'], inputs['mask_indices'], inputs['shape'], spec.get('pool_mode', 'max'))
+    mvec, nvec = margs[0], margs[1]
+    return {'nvec':nvec.dot(weights[prefix + 'theta_n']), 'mvec':mvec.dot(weights[prefix + 'theta_m']),
+            'mask_indices':inputs['mask_indices'], 'shape':inputs['shape']}
+
+
+def identity(inputs, spec, weights, prefix):
+    '''Dropout layers are the identity at inference time.'''
+    return inputs
+
+
+LAYERS = {'matrix_sparse':matrix_sparse,
+          'matrix_pool_sparse':matrix_pool_sparse,
+          'channel_dropout_sparse':identity,
+          'matrix_dropout_sparse':identity,
+          }
+
+
+def get_output(arch, weights, inputs, scope):
+    '''Run the layer list arch on inputs, reading layer l's weights from <scope>/<l>/.'''
+    product = inputs
+    for l, spec in enumerate(arch):
+        if spec['type'] not in LAYERS:
+            raise KeyError("layer type %s has no numpy implementation" % spec['type'])
+        product = LAYERS[spec['type']](product, spec, weights, "%s/%d/" % (scope, l))
+    return product
+
+
+def get_output_streaming(arch, weights, inputs, scope, chunk_size):
+    '''
+    get_output with the non-zeros of inputs (input values and mask_indices) processed chunk_size at a time.
+
+    A layer that pools over the whole matrix (the marginals of a matrix_sparse layer with input values, or
+    matrix_pool_sparse) gets one pass over all chunks, which recomputes the layers below it per chunk and
+    accumulates its marginals exactly (MarginalAccumulator). Memory is O(chunk_size x units + (N + M) x units),
+    except for the returned values if the last layer is not matrix_pool_sparse (then [nnz, units_out]).
+    '''
+    if any(spec.get('attention_pooling', False) for spec in arch):
+        raise ValueError("attention pooling needs the logits of all non-zeros at once and can't be streamed; use chunk_size=None")
+    mask_indices = np.asarray(inputs['mask_indices'])
+    values = inputs.get('input', None)
+    margs = {} # layer -> marginals of its input over the whole matrix
+    bias_means = {} # layer -> means of its gathered row and column biases over the whole matrix
+
+    def chunks():
+        for begin in range(0, mask_indices.shape[0], chunk_size):
+            chunk = dict(inputs, mask_indices=mask_indices[begin:begin + chunk_size])
+            if values is not None:
+                chunk['input'] = values[begin:begin + chunk_size]
+            yield chunk
+
+    def forward(product, upto):
+        for l in range(upto):
+            spec = arch[l]
+            if spec['type'] == 'matrix_sparse':
+                product = matrix_sparse(product, spec, weights, "%s/%d/" % (scope, l), margs=margs.get(l, None), bias_means=bias_means.get(l, None))
+            elif spec['type'] == 'matrix_pool_sparse':
+                product = matrix_pool_sparse(product, spec, weights, "%s/%d/" % (scope, l), margs=margs.get(l, None))
+            else:
+                product = LAYERS[spec['type']](product, spec, weights, "%s/%d/" % (scope, l))
+        return product
+
+    has_values = values is not None
+    for l, spec in enumerate(arch):
+        if spec['type'] not in LAYERS:
+            raise KeyError("layer type %s has no numpy implementation" % spec['type'])
+        if has_values and spec['type'] in ['matrix_sparse', 'matrix_pool_sparse']:
+            acc = MarginalAccumulator(inputs['shape'], spec.get('pool_mode', 'max'))
+            for chunk in chunks():
+                acc.add(forward(chunk, l)['input'], chunk['mask_indices'])
+            margs[l] = acc.marginals()
+        if spec.get('individual_bias', False):
+            prefix = "%s/%d/" % (scope, l)
+            bias_means[l] = (weights[prefix + 'row_bias'][mask_indices[:,0]].mean(), weights[prefix + 'column_bias'][mask_indices[:,1]].mean())
+        has_values = spec['type'] != 'matrix_pool_sparse' and (has_values or spec['type'] == 'matrix_sparse')
+
+    if arch[-1]['type'] == 'matrix_pool_sparse':#nvec and mvec only depend on the accumulated marginals
+        l = len(arch) - 1
+        return matrix_pool_sparse({'mask_indices':mask_indices, 'shape':inputs['shape']}, arch[l], weights, "%s/%d/" % (scope, l), margs=margs[l])
+    outputs = [forward(chunk, len(arch))['input'] for chunk in chunks()]
+    return {'input':np.concatenate(outputs, axis=0), 'mask_indices':mask_indices, 'shape':inputs['shape']}
+
+
+def expected_value(logits):
+    '''Expected rating under the softmax of [nnz, 5] logits.'''
+    p = np.exp(logits - logits.max(axis=1, keepdims=True))
+    p /= p.sum(axis=1, keepdims=True)
+    return p.dot(np.arange(1, 6, dtype=np.float32))
+
+
+def predict(model, mat_values, mask_indices, mask_indices_pred, shape, chunk_size=None):
+    '''Encode the observed ratings (mat_values at mask_indices) and decode predictions at mask_indices_pred.
+
+    mat_values are ratings for 'mse' models and one-hot [nnz*5] vectors for 'ce' models, as fed to the
+    TensorFlow graph; 'ce' predictions are expected ratings. With chunk_size, encoder and decoder stream
+    the non-zeros in chunks (get_output_streaming); the result is the same up to summation order.
+    '''
+    arch, weights = model['architecture'], model['weights']
+    units = 1 if arch['loss'] == 'mse' else 5
+    inputs = {'input':np.reshape(mat_values, [-1, units]).astype(np.float32),
+              'mask_indices':np.asarray(mask_indices), 'shape':shape}
+    run = get_output if chunk_size is None else lambda *args: get_output_streaming(*args, chunk_size=chunk_size)
+    encoded = run(arch['encoder'], weights, inputs, 'encoder')
+    decoded = run(arch['decoder'], weights, {'nvec':encoded['nvec'], 'mvec':encoded['mvec'],
+                                             'mask_indices':np.asarray(mask_indices_pred), 'shape':shape}, 'decoder')
+    out = decoded['input']
+    return out[:,0] if arch['loss'] == 'mse' else expected_value(out)
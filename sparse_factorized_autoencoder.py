@@ -1,5 +1,6 @@
 from __future__ import print_function
 # Standard lib imports
+import os
 import sys
 import gc
 import glob
@@ -13,7 +14,10 @@ import tensorflow as tf
 from scipy.sparse import csr_matrix
 # Model imports
 from base import Model
-from util import get_data
+from tf_helper import graph_fingerprint, save_graph, load_graph, StepProfiler, flat_gradient_ops, make_optimizer, get_optimizer
+from layers import leaky_relu
+import layers, sparse_util, base, tf_helper # their source is part of the graph cache key
+from util import get_data, sort_row_major
 from sparse_util import *
 
 
@@ -99,6 +103,12 @@ def conditional_sample_sparse(mask_indices, tr_val_split, shape, maxN, maxM): #
 
             yield inds_tr, inds_val, inds_tr_val, inds_ts, inds_all
 
+def column_permutation(mask_indices):
+    '''
+    Permutation that sorts a row-major batch by column, fed to the SparseIndexPlan of that batch.
+    '''
+    return np.argsort(mask_indices[:,1], kind='mergesort').astype(np.int32)
+
 def get_neighbours(seed_set, full_set, axis=None):
     if axis is None:
         axis = np.random.randint(2)
@@ -225,23 +235,6 @@ def one_hot(x):
 def expected_value(output):
     return tf.reduce_sum(output * tf.range(1,6, dtype="float32")[None,:], axis=-1)
 
-def get_optimizer(loss, opts):
-    optimizer = opts.get("optimizer", "adam")
-    opt_options = opts.get("opt_options", {})
-    print("Optimizing with %s with options: %s" % (optimizer, opt_options))
-    if isinstance(optimizer, str):
-        if optimizer == "adam":
-            train_step = tf.train.AdamOptimizer(opts['lr'], **opt_options).minimize(loss)
-        elif optimizer == "rmsprop":
-            train_step = tf.train.RMSPropOptimizer(opts['lr'], **opt_options).minimize(loss)
-        elif optimizer == "sgd":
-            train_step = tf.train.GradientDescentOptimizer(opts['lr']).minimize(loss)
-        else:
-            raise KeyError("Unknown optimizer: %s" % optimizer)
-    else:
-        train_step = optimizer.minimize(loss)
-    return train_step
-
 def build_getter(ema):
     def ema_getter(getter, name, *args, **kwargs):
         '''
@@ -269,7 +262,273 @@ def setup_ema(scope, decay=0.998):
         getter = None
         return ema_op, getter
 
+def build_model(opts, N, M, sorted_segments=False):
+    '''
+    Build the training and validation graph of the autoencoder in the default graph.
+    Returns a dictionary with the placeholders, outputs, losses and update ops used by main.
+    '''
+    lossfn = opts.get("loss", "mse")
+    mat_values_tr = tf.placeholder(tf.float32, shape=[None], name='mat_values_tr')
+    mask_indices_tr = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_tr')
+
+    mat_values_val = tf.placeholder(tf.float32, shape=[None], name='mat_values_val')
+    mask_split = tf.placeholder(tf.float32, shape=[None], name='mat_values_val')
+    mask_indices_val = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_val')
+    mask_indices_tr_val = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_tr_val')
+    if sorted_segments:
+        col_perm_tr = tf.placeholder_with_default(argsort_ids(mask_indices_tr[:,1]), shape=[None], name='col_perm_tr')
+        plan_tr = SparseIndexPlan(mask_indices_tr, [N,M], rows_sorted=True, col_perm=col_perm_tr)
+    else:
+        plan_tr = SparseIndexPlan(mask_indices_tr, [N,M]) # index bookkeeping shared by every layer that sees mask_indices_tr
+
+    tr_dict = {'input':mat_values_tr,
+                'mask_indices':mask_indices_tr,
+                'plan':plan_tr,
+                'units':1 if lossfn == "mse" else 5, 
+                'shape':[N,M],
+                }
+
+        
+    val_dict = {'input':mat_values_tr,
+                'mask_indices':mask_indices_tr,
+                'plan':plan_tr,
+                'units':1 if lossfn == "mse" else 5,
+                'shape':[N,M],
+                }
+
+    encoder = Model(layers=opts['encoder'], layer_defaults=opts['defaults'], scope="encoder", verbose=2) #define the encoder
+    out_enc_tr = encoder.get_output(tr_dict) #build the encoder
+    enc_ema_op, enc_getter = setup_ema("encoder", opts.get("ema_decay", 1.))
+    out_enc_val = encoder.get_output(val_dict, reuse=True, verbose=0, is_training=False, getter=enc_getter)#get encoder output, reusing the neural net
+
+    tr_dict = {'nvec':out_enc_tr['nvec'],
+                'mvec':out_enc_tr['mvec'],
+                'units':out_enc_tr['units'],
+                'mask_indices':mask_indices_tr,
+                'plan':out_enc_tr['plan'],
+                'shape':out_enc_tr['shape'],
+                }
+
+    val_dict = {'nvec':out_enc_val['nvec'],
+                'mvec':out_enc_val['mvec'],
+                'units':out_enc_val['units'],
+                'mask_indices':mask_indices_tr_val,
+                'plan':SparseIndexPlan(mask_indices_tr_val, [N,M], rows_sorted=sorted_segments),
+                'shape':out_enc_val['shape'],
+                }
+
+    decoder = Model(layers=opts['decoder'], layer_defaults=opts['defaults'], scope="decoder", verbose=2)#define the decoder
+    out_dec_tr = decoder.get_output(tr_dict)#build it
+    out_tr = out_dec_tr['input']
+    dec_ema_op, dec_getter = setup_ema("decoder", opts.get("ema_decay", 1.))
+    ema_op = enc_ema_op + dec_ema_op
+
+    out_dec_val = decoder.get_output(val_dict, reuse=True, verbose=0, is_training=False, getter=dec_getter)#reuse it for validation
+    out_val = out_dec_val['input']
+
+    eout_val = expected_value(tf.nn.softmax(tf.reshape(out_val, shape=[-1,5])))
+
+    #loss and training
+    reg_loss = sum(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)) # regularization
+        
+    rec_loss, rec_loss_val, total_loss = get_losses(lossfn, reg_loss, 
+                                                    mat_values_tr, 
+                                                    mat_values_val, 
+                                                    mask_indices_tr, 
+                                                    mask_indices_val, 
+                                                    out_tr, out_val,
+                                                    mask_split)
+    allreduce_handles = {}
+    if opts.get('data_parallel', False):#gradients are averaged across worker processes before they are applied (data_parallel.py)
+        allreduce_handles = flat_gradient_ops(total_loss, make_optimizer(opts))
+        train_step = allreduce_handles['apply_step']
+    else:
+        train_step = get_optimizer(total_loss, opts)
+    handles = {'mat_values_tr':mat_values_tr, 'mask_indices_tr':mask_indices_tr,
+               'mat_values_val':mat_values_val, 'mask_split':mask_split,
+               'mask_indices_val':mask_indices_val, 'mask_indices_tr_val':mask_indices_tr_val,
+               'out_tr':out_tr, 'out_val':out_val, 'eout_val':eout_val,
+               'rec_loss':rec_loss, 'rec_loss_val':rec_loss_val, 'total_loss':total_loss,
+               'train_step':train_step, 'ema_op':ema_op}
+    handles.update(allreduce_handles)
+    if sorted_segments:
+        handles['col_perm_tr'] = col_perm_tr
+    return handles
+
+def get_model(opts, N, M, sorted_segments=False, log=sys.stdout):
+    '''
+    Build the model, or import it from opts['graph_cache'] (a folder) if a run with the same
+    architecture and training options already exported its MetaGraphDef there. The build/import time goes to log.
+    '''
+    t0 = time.time()
+    cache = opts.get('graph_cache', None)
+    imported = False
+    if cache is None:
+        handles = build_model(opts, N, M, sorted_segments)
+    else:
+        key = graph_fingerprint([opts['encoder'], opts['decoder'], opts['defaults'], opts.get('loss', 'mse'),
+                                 opts.get('optimizer', 'adam'), opts.get('opt_options', {}), opts['lr'],
+                                 opts.get('ema_decay', 1.), opts.get('data_parallel', False), N, M, sorted_segments],
+                                modules=[layers, sparse_util, base, tf_helper, sys.modules[__name__]])
+        path = None if key is None else os.path.join(cache, "graph_%s.meta" % key)
+        if path is not None and os.path.exists(path):
+            handles = load_graph(path)
+            imported = True
+        else:
+            handles = build_model(opts, N, M, sorted_segments)
+            if path is not None:
+                if not os.path.exists(cache):
+                    os.makedirs(cache)
+                save_graph(path, handles)
+    print("Graph %s in %.2fs" % ("imported" if imported else "built", time.time() - t0), file=log)
+    return handles
+
+def build_inference(opts, N, M):
+    '''
+    Build the encoder/decoder forward pass only (no dropout, losses or optimizer) in the default graph.
+    Ratings mat_values at mask_indices are encoded and decoded at mask_indices_pred; the output tensor
+    'predictions' holds the predicted ratings (expected ratings for "ce" models).
+    '''
+    units = 1 if opts.get("loss", "mse") == "mse" else 5
+    mat_values = tf.placeholder(tf.float32, shape=[None], name='mat_values')
+    mask_indices = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices')
+    mask_indices_pred = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_pred')
+    encoder = Model(layers=opts['encoder'], layer_defaults=opts['defaults'], scope="encoder", verbose=0)
+    out_enc = encoder.get_output({'input':mat_values,
+                                  'mask_indices':mask_indices,
+                                  'plan':SparseIndexPlan(mask_indices, [N,M]),
+                                  'units':units,
+                                  'shape':[N,M]}, is_training=False)
+    decoder = Model(layers=opts['decoder'], layer_defaults=opts['defaults'], scope="decoder", verbose=0)
+    out_dec = decoder.get_output({'nvec':out_enc['nvec'],
+                                  'mvec':out_enc['mvec'],
+                                  'units':out_enc['units'],
+                                  'mask_indices':mask_indices_pred,
+                                  'plan':SparseIndexPlan(mask_indices_pred, [N,M]),
+                                  'shape':out_enc['shape']}, is_training=False)
+    out = out_dec['input']
+    if units == 1:
+        predictions = tf.identity(out, name='predictions')
+    else:
+        predictions = tf.identity(expected_value(tf.nn.softmax(tf.reshape(out, shape=[-1,5]))), name='predictions')
+    return mat_values, mask_indices, mask_indices_pred, predictions
+
+def export_inference_graph(opts, checkpoint, path, N, M, use_ema=True):
+    '''
+    Write a frozen inference graph (a GraphDef with the weights as constants) of a checkpoint saved by main.
+    Only the forward pass of build_inference is kept: optimizer slots, EMA shadows and the loss and training
+    ops are left out. With use_ema, the ExponentialMovingAverage of each weight is baked in when present,
+    which is what main validates with.
+    '''
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    names = reader.get_variable_to_shape_map()
+    with tf.Graph().as_default() as graph:
+        _, _, _, predictions = build_inference(opts, N, M)
+        var_list = {}
+        for var in tf.global_variables():
+            ema_name = var.op.name + '/ExponentialMovingAverage'
+            var_list[ema_name if use_ema and ema_name in names else var.op.name] = var
+        with tf.Session() as sess:
+            tf.train.Saver(var_list=var_list).restore(sess, checkpoint)
+            frozen = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [predictions.op.name])
+    with open(path, "wb") as f:
+        f.write(frozen.SerializeToString())
+    return path
+
+def load_inference_graph(path):
+    '''
+    Import a graph written by export_inference_graph into a new graph.
+    Returns the graph, its mat_values, mask_indices and mask_indices_pred placeholders and the predictions.
+    '''
+    graph_def = tf.GraphDef()
+    with open(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        tensors = tf.import_graph_def(graph_def, return_elements=['mat_values:0', 'mask_indices:0', 'mask_indices_pred:0', 'predictions:0'], name='')
+    return [graph] + tensors
+
+def validate_and_test(sess, handles, data, opts, maxN, maxM, iters_per_epoch):
+    '''
+    Validation and test RMSE of the expected ratings, predicted from conditional_sample_sparse submatrices until
+    opts['validation_threshold'] of the entries have been seen. Returns (loss_val, loss_ts).
+    '''
+    N, M, _ = data['mat_shape']
+    lossfn = opts.get("loss", "mse")
+    mat_values_tr, mask_indices_tr = handles['mat_values_tr'], handles['mask_indices_tr']
+    mat_values_val, mask_split = handles['mat_values_val'], handles['mask_split']
+    mask_indices_val, mask_indices_tr_val = handles['mask_indices_val'], handles['mask_indices_tr_val']
+    rec_loss_val, eout_val = handles['rec_loss_val'], handles['eout_val']
+
+    # entries_val = np.zeros(data['mask_indices_all'].shape[0])
+    predictions_val = np.mean(data['mat_values_tr']) * np.ones(data['mask_indices_all'].shape[0])
+
+    predictions_val_count = np.zeros(data['mask_indices_all'].shape[0])
+    num_entries_val = data['mask_indices_val'].shape[0]
+                    
+    while np.sum(predictions_val_count) < opts['validation_threshold'] * num_entries_val:
+        for sample_tr_, sample_val_, sample_tr_val_, _, _ in tqdm(conditional_sample_sparse(data['mask_indices_all'], data['mask_tr_val_split'], [N,M,1], maxN, maxM), total=iters_per_epoch):
+
+            mat_values_tr_ = data['mat_values_all'][sample_tr_]
+            mat_values_tr_val_ = data['mat_values_all'][sample_tr_val_]
+
+            mask_indices_tr_ = data['mask_indices_all'][sample_tr_]
+            mask_indices_val_ = data['mask_indices_all'][sample_val_]
+            mask_indices_tr_val_ = data['mask_indices_all'][sample_tr_val_]
+
+            mask_split_ = (data['mask_tr_val_split'][sample_tr_val_] == 1) * 1.
+    
+            val_dict = {mat_values_tr:mat_values_tr_ if lossfn =="mse" else one_hot(mat_values_tr_),
+                        mask_indices_tr:mask_indices_tr_,
+                        mat_values_val:mat_values_tr_val_ if lossfn =="mse" else one_hot(mat_values_tr_val_),
+                        mask_indices_val:mask_indices_val_,
+                        mask_indices_tr_val:mask_indices_tr_val_,
+                        mask_split:mask_split_
+                        }
+
+            bloss_val, beout_val, = sess.run([rec_loss_val, eout_val], feed_dict=val_dict)
+            predictions_val[sample_val_] = beout_val[mask_split_ == 1.]
+            predictions_val_count[sample_val_] = 1 
+
+    loss_val_ = np.sqrt(np.mean( (data['mat_values_all'][data['mask_tr_val_split'] == 1] - predictions_val[data['mask_tr_val_split'] == 1])**2 ))
+
+    ## Test Loss
+    print("Testing: ")
+    predictions_ts = np.mean(data['mat_values_tr_val']) * np.ones(data['mask_indices_all'].shape[0])
+
+    predictions_ts_count = np.zeros(data['mask_indices_all'].shape[0])
+    num_entries_ts = data['mask_indices_test'].shape[0]
+
+    while np.sum(predictions_ts_count) < opts['validation_threshold'] * num_entries_ts:
+        for sample_tr_, _, sample_tr_val_, sample_ts_, sample_all_ in tqdm(conditional_sample_sparse(data['mask_indices_all'], data['mask_tr_val_split'], [N,M,1], maxN, maxM), total=iters_per_epoch):
+
+            mat_values_tr_val_ = data['mat_values_all'][sample_tr_val_]
+            mat_values_all_ = data['mat_values_all'][sample_all_]
+
+            mask_indices_tr_val_ = data['mask_indices_all'][sample_tr_val_]
+            mask_indices_ts_ = data['mask_indices_all'][sample_ts_]
+            mask_indices_all_ = data['mask_indices_all'][sample_all_]
+
+            mask_split_ = (data['mask_tr_val_split'][sample_all_] == 2) * 1.
+                                
+            test_dict = {mat_values_tr:mat_values_tr_val_ if lossfn =="mse" else one_hot(mat_values_tr_val_),
+                        mask_indices_tr:mask_indices_tr_val_,
+                        mat_values_val:mat_values_all_ if lossfn =="mse" else one_hot(mat_values_all_),
+                        mask_indices_val:mask_indices_ts_,
+                        mask_indices_tr_val:mask_indices_all_,
+                        mask_split:mask_split_
+                    }
+
+            bloss_test, beout_ts, = sess.run([rec_loss_val, eout_val], feed_dict=test_dict)
+            predictions_ts[sample_ts_] = beout_ts[mask_split_ == 1.]
+            predictions_ts_count[sample_ts_] = 1 
+
+    loss_ts_ = np.sqrt(np.mean(  (data['mat_values_all'][data['mask_tr_val_split'] == 2] - predictions_ts[data['mask_tr_val_split'] == 2])**2  ))
+    return loss_val_, loss_ts_
+
 def main(opts, logfile=None, restore_point=None):        
+    if opts.get('workers', 1) > 1:
+        from data_parallel import train_data_parallel
+        return train_data_parallel(opts, logfile, restore_point=restore_point)
     if logfile is not None:
         LOG = open(logfile, "w", 0)
     else:
@@ -282,6 +541,16 @@ def main(opts, logfile=None, restore_point=None):
     else: 
         data = get_data(path, train=.6, valid=.2, test=.2, mode='sparse', fold=1)
     
+    sorted_segments = opts.get('sorted_segments', False) # feed row-major batches and reduce them with sorted segment ops
+    if sorted_segments:
+        if 'neighbourhood' in opts['sample_mode']:
+            raise ValueError("sorted_segments needs row-major batches, which neighbourhood sampling does not produce")
+        data = sort_row_major(data) # every increasing subset of the data is now row-major
+    if 'by_row_column_density' in opts['sample_mode'] and any(dict(opts['defaults'].get(layer['type'], {}), **layer).get('individual_bias', False)
+                                                            for layer in opts['encoder'] + opts['decoder']):
+        # the biases are indexed by global row/column ids, but these batches have submatrix-local mask_indices
+        raise ValueError("individual_bias needs global mask_indices, which by_row_column_density sampling does not produce")
+
     #build encoder and decoder and use VAE loss
     N, M, num_features = data['mat_shape']
     maxN, maxM = opts['maxN'], opts['maxM']
@@ -303,69 +572,16 @@ def main(opts, logfile=None, restore_point=None):
         print('', file=LOG)
 
     with tf.Graph().as_default():
-        mat_values_tr = tf.placeholder(tf.float32, shape=[None], name='mat_values_tr')
-        mask_indices_tr = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_tr')
-
-        mat_values_val = tf.placeholder(tf.float32, shape=[None], name='mat_values_val')
-        mask_split = tf.placeholder(tf.float32, shape=[None], name='mat_values_val')
-        mask_indices_val = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_val')
-        mask_indices_tr_val = tf.placeholder(tf.int32, shape=[None, 2], name='mask_indices_tr_val')
-
-        tr_dict = {'input':mat_values_tr,
-                    'mask_indices':mask_indices_tr,
-                    'units':1 if lossfn == "mse" else 5, 
-                    'shape':[N,M],
-                    }
-
-        
-        val_dict = {'input':mat_values_tr,
-                    'mask_indices':mask_indices_tr,
-                    'units':1 if lossfn == "mse" else 5,
-                    'shape':[N,M],
-                    }
-
-        encoder = Model(layers=opts['encoder'], layer_defaults=opts['defaults'], scope="encoder", verbose=2) #define the encoder
-        out_enc_tr = encoder.get_output(tr_dict) #build the encoder
-        enc_ema_op, enc_getter = setup_ema("encoder", opts.get("ema_decay", 1.))
-        out_enc_val = encoder.get_output(val_dict, reuse=True, verbose=0, is_training=False, getter=enc_getter)#get encoder output, reusing the neural net
-
-        tr_dict = {'nvec':out_enc_tr['nvec'],
-                    'mvec':out_enc_tr['mvec'],
-                    'units':out_enc_tr['units'],
-                    'mask_indices':mask_indices_tr,
-                    'shape':out_enc_tr['shape'],
-                    }
-
-        val_dict = {'nvec':out_enc_val['nvec'],
-                    'mvec':out_enc_val['mvec'],
-                    'units':out_enc_val['units'],
-                    'mask_indices':mask_indices_tr_val,
-                    'shape':out_enc_val['shape'],
-                    }
-
-        decoder = Model(layers=opts['decoder'], layer_defaults=opts['defaults'], scope="decoder", verbose=2)#define the decoder
-        out_dec_tr = decoder.get_output(tr_dict)#build it
-        out_tr = out_dec_tr['input']
-        dec_ema_op, dec_getter = setup_ema("decoder", opts.get("ema_decay", 1.))
-        ema_op = enc_ema_op + dec_ema_op
-
-        out_dec_val = decoder.get_output(val_dict, reuse=True, verbose=0, is_training=False, getter=dec_getter)#reuse it for validation
-        out_val = out_dec_val['input']
-
-        eout_val = expected_value(tf.nn.softmax(tf.reshape(out_val, shape=[-1,5])))
-
-        #loss and training
-        reg_loss = sum(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)) # regularization
-        
-        rec_loss, rec_loss_val, total_loss = get_losses(lossfn, reg_loss, 
-                                                        mat_values_tr, 
-                                                        mat_values_val, 
-                                                        mask_indices_tr, 
-                                                        mask_indices_val, 
-                                                        out_tr, out_val,
-                                                        mask_split)
-        train_step = get_optimizer(total_loss, opts)
+        handles = get_model(opts, N, M, sorted_segments, log=LOG)
+        mat_values_tr, mask_indices_tr = handles['mat_values_tr'], handles['mask_indices_tr']
+        mat_values_val, mask_split = handles['mat_values_val'], handles['mask_split']
+        mask_indices_val, mask_indices_tr_val = handles['mask_indices_val'], handles['mask_indices_tr_val']
+        out_tr, out_val, eout_val = handles['out_tr'], handles['out_val'], handles['eout_val']
+        rec_loss, rec_loss_val, total_loss = handles['rec_loss'], handles['rec_loss_val'], handles['total_loss']
+        train_step, ema_op = handles['train_step'], handles['ema_op']
+        col_perm_tr = handles.get('col_perm_tr', None)
         sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+        profiler = StepProfiler(opts.get('profile_every', 0), "logs/timeline_" + opts.get('model_name', "TEST"), log=LOG) # per-layer profile and Chrome trace every profile_every steps
         sess.run(tf.global_variables_initializer())
 
         if 'by_row_column_density' in opts['sample_mode'] or 'conditional_sample_sparse' in opts['sample_mode']:
@@ -413,14 +629,16 @@ def main(opts, logfile=None, restore_point=None):
                     inds_ = np.ix_(indn_,indm_,[0])#select a sub-matrix given random indices for users/movies                    
                     mat_sp = data['mat_tr_val'][inds_] * data['mask_tr'][inds_]
                     mat_values = dense_array_to_sparse(mat_sp)['values']
-                    mask_indices = dense_array_to_sparse(data['mask_tr'][inds_])['indices'][:,0:2]
+                    mask_indices = get_mask_indices(data['mask_tr'][inds_])
 
                     tr_dict = {mat_values_tr:mat_values if lossfn == "mse" else one_hot(mat_values),
                                 mask_indices_tr:mask_indices,
                                 mask_split:np.ones_like(mat_values)
                                 }
+                    if sorted_segments:
+                        tr_dict[col_perm_tr] = column_permutation(mask_indices)
                     
-                    returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                    returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                     bloss_, brec_loss_ = [i for i in returns[1:3]]
 
                     loss_tr_ += np.sqrt(bloss_)
@@ -429,6 +647,8 @@ def main(opts, logfile=None, restore_point=None):
             elif 'uniform_over_dense_values' in opts['sample_mode']:
                 for sample_ in tqdm(sample_dense_values_uniform(data['mask_indices_tr'], minibatch_size, iters_per_epoch), 
                                     total=iters_per_epoch):
+                    if sorted_segments:
+                        sample_ = np.sort(sample_)
                     mat_values = data['mat_values_tr'][sample_]
                     mask_indices = data['mask_indices_tr'][sample_]
 
@@ -436,8 +656,10 @@ def main(opts, logfile=None, restore_point=None):
                                 mask_indices_tr:mask_indices,
                                 mask_split:np.ones_like(mat_values)
                                 }
+                    if sorted_segments:
+                        tr_dict[col_perm_tr] = column_permutation(mask_indices)
                     
-                    returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                    returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                     bloss_, brec_loss_ = [i for i in returns[1:3]] # ema_op may be empty and we only need these two outputs
 
                     loss_tr_ += bloss_
@@ -464,7 +686,7 @@ def main(opts, logfile=None, restore_point=None):
                                 mask_split:mat_weight
                                 }
                     
-                    returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                    returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                     bloss_, brec_loss_ = [i for i in returns[1:3]] # ema_op may be empty and we only need these two outputs
 
                     loss_tr_ += bloss_
@@ -481,8 +703,10 @@ def main(opts, logfile=None, restore_point=None):
                                 mask_indices_tr:mask_indices,
                                 mask_split:np.ones_like(mat_values)
                                 }
+                    if sorted_segments:
+                        tr_dict[col_perm_tr] = column_permutation(mask_indices)
                     
-                    returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                    returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                     bloss_, brec_loss_ = [i for i in returns[1:3]] # ema_op may be empty and we only need these two outputs
 
                     loss_tr_ += bloss_
@@ -535,70 +759,7 @@ def main(opts, logfile=None, restore_point=None):
                                     lossfn=lossfn,
                                     minibatch_size=minibatch_size / 100)
                 else:
-                    # entries_val = np.zeros(data['mask_indices_all'].shape[0])
-                    predictions_val = np.mean(data['mat_values_tr']) * np.ones(data['mask_indices_all'].shape[0])
-
-                    predictions_val_count = np.zeros(data['mask_indices_all'].shape[0])
-                    num_entries_val = data['mask_indices_val'].shape[0]
-                                    
-                    while np.sum(predictions_val_count) < opts['validation_threshold'] * num_entries_val:
-                        for sample_tr_, sample_val_, sample_tr_val_, _, _ in tqdm(conditional_sample_sparse(data['mask_indices_all'], data['mask_tr_val_split'], [N,M,1], maxN, maxM), total=iters_per_epoch):
-
-                            mat_values_tr_ = data['mat_values_all'][sample_tr_]
-                            mat_values_tr_val_ = data['mat_values_all'][sample_tr_val_]
-
-                            mask_indices_tr_ = data['mask_indices_all'][sample_tr_]
-                            mask_indices_val_ = data['mask_indices_all'][sample_val_]
-                            mask_indices_tr_val_ = data['mask_indices_all'][sample_tr_val_]
-
-                            mask_split_ = (data['mask_tr_val_split'][sample_tr_val_] == 1) * 1.
-                    
-                            val_dict = {mat_values_tr:mat_values_tr_ if lossfn =="mse" else one_hot(mat_values_tr_),
-                                        mask_indices_tr:mask_indices_tr_,
-                                        mat_values_val:mat_values_tr_val_ if lossfn =="mse" else one_hot(mat_values_tr_val_),
-                                        mask_indices_val:mask_indices_val_,
-                                        mask_indices_tr_val:mask_indices_tr_val_,
-                                        mask_split:mask_split_
-                                        }
-
-                            bloss_val, beout_val, = sess.run([rec_loss_val, eout_val], feed_dict=val_dict)
-                            predictions_val[sample_val_] = beout_val[mask_split_ == 1.]
-                            predictions_val_count[sample_val_] = 1 
-
-                    loss_val_ = np.sqrt(np.mean( (data['mat_values_all'][data['mask_tr_val_split'] == 1] - predictions_val[data['mask_tr_val_split'] == 1])**2 ))
-
-                    ## Test Loss
-                    print("Testing: ")
-                    predictions_ts = np.mean(data['mat_values_tr_val']) * np.ones(data['mask_indices_all'].shape[0])
-
-                    predictions_ts_count = np.zeros(data['mask_indices_all'].shape[0])
-                    num_entries_ts = data['mask_indices_test'].shape[0]
-
-                    while np.sum(predictions_ts_count) < opts['validation_threshold'] * num_entries_ts:
-                        for sample_tr_, _, sample_tr_val_, sample_ts_, sample_all_ in tqdm(conditional_sample_sparse(data['mask_indices_all'], data['mask_tr_val_split'], [N,M,1], maxN, maxM), total=iters_per_epoch):
-
-                            mat_values_tr_val_ = data['mat_values_all'][sample_tr_val_]
-                            mat_values_all_ = data['mat_values_all'][sample_all_]
-
-                            mask_indices_tr_val_ = data['mask_indices_all'][sample_tr_val_]
-                            mask_indices_ts_ = data['mask_indices_all'][sample_ts_]
-                            mask_indices_all_ = data['mask_indices_all'][sample_all_]
-
-                            mask_split_ = (data['mask_tr_val_split'][sample_all_] == 2) * 1.
-                                                
-                            test_dict = {mat_values_tr:mat_values_tr_val_ if lossfn =="mse" else one_hot(mat_values_tr_val_),
-                                        mask_indices_tr:mask_indices_tr_val_,
-                                        mat_values_val:mat_values_all_ if lossfn =="mse" else one_hot(mat_values_all_),
-                                        mask_indices_val:mask_indices_ts_,
-                                        mask_indices_tr_val:mask_indices_all_,
-                                        mask_split:mask_split_
-                                    }
-
-                            bloss_test, beout_ts, = sess.run([rec_loss_val, eout_val], feed_dict=test_dict)
-                            predictions_ts[sample_ts_] = beout_ts[mask_split_ == 1.]
-                            predictions_ts_count[sample_ts_] = 1 
-
-                    loss_ts_ = np.sqrt(np.mean(  (data['mat_values_all'][data['mask_tr_val_split'] == 2] - predictions_ts[data['mask_tr_val_split'] == 2])**2  ))
+                    loss_val_, loss_ts_ = validate_and_test(sess, handles, data, opts, maxN, maxM, iters_per_epoch)
                 
                 losses['valid'].append(loss_val_)
                 losses['test'].append(loss_ts_)
@@ -631,6 +792,11 @@ def main(opts, logfile=None, restore_point=None):
             if loss_val_ > min_loss * 1.075:
                 # overfitting: break if validation loss diverges
                 break
+    if opts.get("export_inference", False) and opts.get("save_best", False) and min_loss_epoch > 0:
+        best_path = opts['ckpt_folder'] + "/%s_best.ckpt" % opts.get('model_name', "test")
+        frozen_path = export_inference_graph(opts, best_path, opts['ckpt_folder'] + "/%s_inference.pb" % opts.get('model_name', "test"), N, M,
+                                             use_ema=opts.get("ema_decay", 1.) < 1.)
+        print("Inference graph saved in file: %s" % frozen_path, file=LOG)
     return losses
 
 if __name__ == "__main__":
@@ -696,6 +862,9 @@ if __name__ == "__main__":
            'model_name':'noatt_fac_ae',
            'ema_decay':0.9,
            'verbose':2,
+           'workers':1,#>1 trains synchronous data-parallel replicas in that many processes (data_parallel.py)
+           'profile_every':0,#trace a training step every profile_every steps: per-layer timings and logs/timeline_<model_name>_<step>.json
+           #'graph_cache':'checkpoints/graphs',#export the built graph and import it in later runs with the same architecture
            'loss':lossfn,
            'optimizer':"adam",
            'opt_options':{"epsilon":1e-6},
@@ -710,6 +879,7 @@ if __name__ == "__main__":
            'checkpoint_interval':checkpoint_interval,
            'validation_threshold':.99, # Make sure we sample at least this proportion of validation entries.
            'save_best':True,
+           'export_inference':True,#write a frozen inference graph of the best checkpoint after training
            'encoder':[
                {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
                {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
@@ -720,10 +890,8 @@ if __name__ == "__main__":
                {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
                {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
                {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
-               {'type':'channel_dropout_sparse'},
-               {'type':'matrix_sparse', 'units':units, "attention_pooling":ap},
-               {'type':'channel_dropout_sparse'},
-               {'type':'matrix_sparse', 'units':5 if lossfn == "ce" else 1, 'activation':None},
+               {'type':'matrix_sparse', 'units':units, "attention_pooling":ap, 'dropout':.5},#dropout on the layer's input (was a channel_dropout_sparse layer)
+               {'type':'matrix_sparse', 'units':5 if lossfn == "ce" else 1, 'activation':None, 'dropout':.5},
             ],
             'defaults':{#default values for each layer type (see layer.py)
                  'bilinear_sparse':{
@@ -740,12 +908,14 @@ if __name__ == "__main__":
                     # 'activation':tf.nn.tanh,
                     # 'activation':tf.nn.sigmoid,
                     #'activation':tf.nn.relu,
-                    'activation':lambda x: tf.nn.relu(x) - 0.01*tf.nn.relu(-x), # Leaky Relu
+                    'activation':leaky_relu,
                     # 'drop_mask':False,#whether to go over the whole matrix, or emulate the sparse matrix in layers beyond the input. If the mask is droped the whole matrix is used.
                     'pool_mode':'mean',#mean vs max in the exchangeable layer. Currently, when the mask is present, only mean is supported
                     'kernel_initializer': tf.random_normal_initializer(0, .01),
                     'regularizer': tf.contrib.keras.regularizers.l2(1e-10),
                     'skip_connections':skip_connections,
+                    'dropout_mode':'channel',#channel (single values), entry (whole non-zeros) or row_col, for layers with 'dropout'
+                    # 'recompute':True,#recompute activations in the backward pass: less memory per nonzero, slower steps (see benchmark_sparse.py recompute)
                 },
                 'dense':{#not used
                     'activation':tf.nn.elu,
@@ -222,6 +222,7 @@ def main(opts, logfile=None, restore_point=None):
                     'mvec':out_enc_tr['mvec'],
                     'units':out_enc_tr['units'],
                     'mask_indices':mask_indices_tr,
+                    'plan':out_enc_tr['plan'],
                     'shape':out_enc_tr['shape'],
                     }
 
@@ -9,35 +9,30 @@ def dense_array_to_sparse(x, mask_indices=None, expand_dims=False):
     K = x.shape[2]
     if mask_indices is None:
         vals = x[x.nonzero()]
-        inds = np.array(list(zip(*x[:,:,0].nonzero())))
-        inds = expand_array_indices(inds, K)
+        inds = expand_array_indices(get_mask_indices(x), K)
     else:
         inds = expand_array_indices(mask_indices, K)
-        vals = x[list(zip(*inds))]
+        vals = dense_array_to_sparse_values(x, mask_indices)
     return {'indices':inds, 'values':vals, 'dense_shape':x.shape}
 
 
 def dense_array_to_sparse_values(x, mask_indices):
     """Return all values of x corresponding to indices in mask_indices."""
-    K = x.shape[2]
-    inds = expand_array_indices(mask_indices, K)
-    return np.reshape(x[list(zip(*inds))], [-1])
+    return np.reshape(x[mask_indices[:,0], mask_indices[:,1]], [-1]) # nnz x K, flattened row-major
 
 
 def get_mask_indices(mask):
     """Return the non-zero indices of mask."""
-    if len(mask.shape) is 3:
+    if len(mask.shape) == 3:
         mask = mask[:,:,0]
-    return np.array(list(zip(*mask.nonzero())))
+    return np.stack(np.nonzero(mask), axis=1)
 
 
 # Mostly used for debugging
 def sparse_array_to_dense(values, mask_indices, shape):
     """Given sparse representation of an array, return the dense array."""
     out = np.zeros(shape)
-    inds = expand_array_indices(mask_indices, shape[2])
-    inds = list(zip(*inds))
-    out[inds] = values
+    out[mask_indices[:,0], mask_indices[:,1]] = np.reshape(values, [-1, shape[2]])
     return out
 
 
@@ -77,29 +72,182 @@ def sparse_tensor_to_dense(x_sp, shape=None):
  
 def expand_array_indices(mask_indices, num_features):    
     """Given np array mask_indices in [N,M], return equivalent indices in [N,M,num_features]."""
-    num_vals = mask_indices.shape[0]
-    inds_exp = np.reshape(np.tile(range(num_features), reps=[num_vals]), newshape=[-1, 1]) # expand dimension of mask indices
-    inds = np.tile(mask_indices, reps=[num_features,1]) # duplicate mask_indices num_features times
-    inds = np.reshape(inds, newshape=[num_features, num_vals, 2])
-    inds = np.reshape(np.transpose(inds, axes=[1,0,2]), newshape=[-1,2])
-    inds = np.concatenate((inds, inds_exp), axis=1)
-    return inds
+    mask_indices = np.asarray(mask_indices, dtype=np.int64)
+    inds = np.empty([mask_indices.shape[0], num_features, 3], dtype=np.int64)
+    inds[:,:,:2] = mask_indices[:,None,:] # each mask index repeated num_features times
+    inds[:,:,2] = np.arange(num_features)
+    return np.reshape(inds, [-1,3])
 
 
-def expand_tensor_indices(mask_indices, num_features):
-    """Like expand_array_indices, but for tensorflow tensors."""
-    num_vals = tf.shape(mask_indices)[0]
-    inds_exp = tf.reshape(tf.tile(tf.range(num_features, dtype=tf.float32), multiples=[num_vals]), shape=[-1, 1]) # expand dimension of mask indices
-    mask_indices = tf.cast(mask_indices, dtype=tf.float32) # cast so computation can be done on gpu
-    inds = tf.tile(mask_indices, multiples=[num_features,1]) # duplicate mask_indices num_features times
-    inds = tf.reshape(inds, shape=[num_features, num_vals, 2])
-    inds = tf.reshape(tf.transpose(inds, perm=[1,0,2]), shape=[-1,2])
-    inds = tf.concat((inds, inds_exp), axis=1)
-    inds = tf.cast(inds, dtype=tf.int32)
-    return inds
+def index_dtype(mask_indices):
+    """Integer dtype used for index arithmetic on mask_indices: int64 if it is fed as int64, else int32."""
+    return tf.int64 if tf.as_dtype(mask_indices.dtype) == tf.int64 else tf.int32
 
 
-def sparse_reduce(mask_indices, values, num_features, mode='sum', shape=None, axis=None, keep_dims=False):
+def expand_tensor_indices(mask_indices, num_features):
+    """Like expand_array_indices, but for tensorflow tensors. Index arithmetic is integer-only, so ids stay exact at any scale."""
+    dtype = index_dtype(mask_indices)
+    mask_indices = tf.cast(mask_indices, dtype=dtype)
+    num_vals = tf.shape(mask_indices)[0]
+    inds = tf.tile(tf.expand_dims(mask_indices, axis=1), multiples=[1,num_features,1]) # nnz x num_features x 2
+    inds_exp = tf.tile(tf.reshape(tf.range(num_features, dtype=dtype), shape=[1,-1,1]), multiples=tf.stack([num_vals,1,1])) # nnz x num_features x 1
+    inds = tf.concat((inds, inds_exp), axis=2)
+    return tf.reshape(inds, shape=[-1,3])
+
+
+def argsort_ids(ids):
+    """In-graph ascending argsort of an integer id vector (order within equal ids is unspecified)."""
+    _, perm = tf.nn.top_k(-ids, k=tf.shape(ids)[0], sorted=True)
+    return perm
+
+
+class SparseIndexPlan(object):
+    """Index bookkeeping for one minibatch of a 2D sparse matrix given by mask_indices [nnz, 2].
+
+    Segment ids and per-row/per-column counts only depend on mask_indices,
+    so they are derived once per batch here and shared (under the 'plan' key of the layer
+    dicts) by every sparse layer and reduction that works on the same mask_indices.
+
+    If the batch is known to be in row-major order (rows_sorted=True), segment sums use the
+    sorted segment ops: directly on the row ids, and through the column-sort permutation
+    col_perm for the column ids. col_perm can be fed by the sampler; otherwise it is computed
+    in-graph.
+    """
+    def __init__(self, mask_indices, shape=None, rows_sorted=False, col_perm=None):
+        with tf.name_scope('sparse_index_plan'):
+            self.mask_indices = mask_indices
+            self.shape = shape
+            inds = tf.cast(mask_indices, dtype=index_dtype(mask_indices))
+            self.row_ids = inds[:,0] # segment ids when reducing along axis 1
+            self.col_ids = inds[:,1] # segment ids when reducing along axis 0
+            self.num_vals = tf.shape(inds)[0]
+            if shape is None:
+                self.num_rows = tf.reduce_max(self.row_ids) + 1
+                self.num_cols = tf.reduce_max(self.col_ids) + 1
+            else:
+                self.num_rows, self.num_cols = shape[0], shape[1]
+            ones = tf.ones_like(self.row_ids, dtype=tf.float32)
+            self.row_counts = tf.expand_dims(tf.unsorted_segment_sum(ones, self.row_ids, self.num_rows), axis=1) # N x 1
+            self.col_counts = tf.expand_dims(tf.unsorted_segment_sum(ones, self.col_ids, self.num_cols), axis=1) # M x 1
+            self.total_count = tf.reshape(tf.cast(self.num_vals, tf.float32), shape=[1,1])
+            self.rows_sorted = rows_sorted
+            if rows_sorted:
+                self.col_perm = argsort_ids(self.col_ids) if col_perm is None else col_perm
+                self.sorted_col_ids = tf.gather(self.col_ids, self.col_perm)
+
+    def segment_ids(self, axis):
+        """Ids of the segments that a reduction along <axis> sums into."""
+        return self.col_ids if axis == 0 else self.row_ids
+
+    def num_segments(self, axis):
+        return self.num_cols if axis == 0 else self.num_rows
+
+    def segment_sum(self, values, axis):
+        """Sum the rows of values [nnz, K] into the segments of a reduction along <axis>; [segments, K]."""
+        if not self.rows_sorted:
+            return tf.unsorted_segment_sum(values, self.segment_ids(axis), num_segments=self.num_segments(axis))
+        if axis == 0:
+            out = tf.segment_sum(tf.gather(values, self.col_perm), self.sorted_col_ids)
+        else:
+            out = tf.segment_sum(values, self.row_ids)
+        # segment_sum stops at the largest id present; pad up to the full number of segments
+        return tf.pad(out, [[0, tf.cast(self.num_segments(axis), tf.int32) - tf.shape(out)[0]], [0, 0]])
+
+    def counts(self, axis):
+        """Number of non-zeros per segment of a reduction along <axis>; [segments, 1]."""
+        if axis is None:
+            return self.total_count
+        return self.col_counts if axis == 0 else self.row_counts
+
+
+def get_index_plan(inputs):
+    """Return the SparseIndexPlan of a layer input dict, building one if it is missing or stale."""
+    plan = inputs.get('plan', None)
+    if plan is None or plan.mask_indices is not inputs['mask_indices']:
+        plan = SparseIndexPlan(inputs['mask_indices'], inputs.get('shape', None))
+    return plan
+
+
+class SparseTensorIndexPlan(object):
+    """Index bookkeeping for one minibatch of a sparse tensor with D modes given by mask_indices [nnz, D].
+
+    A reduction is identified by the tuple of axes it pools over (None pools over all of them). Its segments
+    are the distinct coordinates on the kept axes: for a single kept axis d these are the coordinates
+    [0, shape[d]), as for the rows and columns of a SparseIndexPlan; for several kept axes the linearized
+    coordinates are renumbered with tf.unique, so there are never more segments than non-zeros.
+    Segment ids and counts are built on first use and then shared, and the interface matches
+    SparseIndexPlan, so sparse_segment_stats and sparse_segment_max accept either plan.
+    """
+    def __init__(self, mask_indices, shape):
+        with tf.name_scope('sparse_tensor_index_plan'):
+            self.mask_indices = mask_indices
+            self.shape = list(shape)
+            self.num_modes = len(shape)
+            self.num_vals = tf.shape(mask_indices)[0]
+            self.total_count = tf.reshape(tf.cast(self.num_vals, tf.float32), shape=[1,1])
+        self._segments = {}
+
+    def _segments_of(self, axes):
+        axes = tuple(sorted(axes))
+        if axes not in self._segments:
+            kept = [d for d in range(self.num_modes) if d not in axes]
+            with tf.name_scope('sparse_tensor_index_plan'):
+                inds = tf.cast(self.mask_indices, tf.int64)
+                if len(kept) == 1:
+                    ids = inds[:,kept[0]]
+                    num_segments = self.shape[kept[0]]
+                else:
+                    linear = inds[:,kept[0]]
+                    for d in kept[1:]:
+                        linear = linear * self.shape[d] + inds[:,d]
+                    unique, ids = tf.unique(linear, out_idx=tf.int64)
+                    num_segments = tf.shape(unique)[0]
+                ones = tf.ones_like(ids, dtype=tf.float32)
+                counts = tf.expand_dims(tf.unsorted_segment_sum(ones, ids, num_segments), axis=1)
+            self._segments[axes] = (ids, num_segments, counts)
+        return self._segments[axes]
+
+    def segment_ids(self, axis):
+        """Ids of the segments that a reduction over the axes in <axis> sums into."""
+        return self._segments_of(axis)[0]
+
+    def num_segments(self, axis):
+        return self._segments_of(axis)[1]
+
+    def segment_sum(self, values, axis):
+        return tf.unsorted_segment_sum(values, self.segment_ids(axis), num_segments=self.num_segments(axis))
+
+    def counts(self, axis):
+        """Number of non-zeros per segment of a reduction over <axis>; [segments, 1]."""
+        if axis is None:
+            return self.total_count
+        return self._segments_of(axis)[2]
+
+
+def get_tensor_index_plan(inputs):
+    """Return the SparseTensorIndexPlan of a layer input dict, building one if it is missing or stale."""
+    plan = inputs.get('plan', None)
+    if not isinstance(plan, SparseTensorIndexPlan) or plan.mask_indices is not inputs['mask_indices']:
+        plan = SparseTensorIndexPlan(inputs['mask_indices'], inputs['shape'])
+    return plan
+
+
+def sparse_tensor_marginal(values, num_features, plan, axes, pool_mode='mean', eps=1e-3):
+    """Mean (or max) of a sparse tensor over the axes in <axes>, one row per segment of plan: [segments, num_features].
+
+    Pooling over every axis gives [1, num_features]. Cost is O(nnz x num_features) whatever the axes.
+    """
+    vals = tf.reshape(values, shape=[-1,num_features])
+    axis = None if len(axes) == plan.num_modes else tuple(sorted(axes))
+    if 'max' in pool_mode:
+        if axis is None:
+            return tf.reduce_max(vals, axis=0, keep_dims=True)
+        return sparse_segment_max(vals, num_features, plan, axis)
+    stats = sparse_segment_stats(vals, num_features, plan, axis=axis, stats=('sum', 'count'))
+    return stats['sum'] / (stats['count'] + eps)
+
+
+def sparse_reduce(mask_indices, values, num_features, mode='sum', shape=None, axis=None, keep_dims=False, plan=None):
     """Equivalent to tf.reduce_sum/max, but for 2D sparse tensors."""
     if 'sum' in mode:
         op = tf.unsorted_segment_sum
@@ -109,35 +257,18 @@ def sparse_reduce(mask_indices, values, num_features, mode='sum', shape=None, ax
         print('\nERROR - unknown <mode> in sparse_reduce()\n')
         return 
 
-    mask_indices = tf.cast(mask_indices, dtype=tf.float32) # cast so computation can be done on gpu
-    if axis is 0:
-        inds = tf.cast(mask_indices[:,1], dtype=tf.int32)
-        vals = tf.reshape(values, shape=[-1,num_features])
-        if shape is None:
-            num_segments = tf.cast(tf.reduce_max(mask_indices[:,1]), tf.int32) + 1
-        else:
-            num_segments = shape[1]
-        out = op(vals, inds, num_segments=num_segments)
-        if 'max' in mode: ## Hack to avoid tensorflow bug where 0 values are set to large negative number
-            out = tf.where(tf.greater(out, -200000000), out, tf.zeros_like(out))
-        if keep_dims:
-            out = tf.expand_dims(out, axis=0)
-        return out
-    elif axis is 1:
-        inds = tf.cast(mask_indices[:,0], dtype=tf.int32)
-        if shape is None:
-            num_segments = tf.cast(tf.reduce_max(mask_indices[:,0]), tf.int32) + 1
+    vals = tf.reshape(values, shape=[-1,num_features])
+    if axis in (0, 1):
+        if plan is None:
+            plan = SparseIndexPlan(mask_indices, shape)
+        if 'max' in mode:
+            out = sparse_segment_max(vals, num_features, plan, axis)
         else:
-            num_segments = shape[0]
-        vals = tf.reshape(values, shape=[-1,num_features])
-        out = op(vals, inds, num_segments=num_segments)
-        if 'max' in mode: ## Hack to avoid tensorflow bug where 0 values are set to large negative number
-            out = tf.where(tf.greater(out, -200000000), out, tf.zeros_like(out))
+            out = plan.segment_sum(vals, axis)
         if keep_dims:
-            out = tf.expand_dims(out, axis=1)
+            out = tf.expand_dims(out, axis=axis)
         return out
     elif axis is None:
-        vals = tf.reshape(values, shape=[-1,num_features])
         if 'sum' in mode:
             out = tf.reduce_sum(vals, axis=0, keep_dims=keep_dims)
         elif 'max' in mode:
@@ -152,33 +283,101 @@ def sparse_reduce(mask_indices, values, num_features, mode='sum', shape=None, ax
         print('\nERROR - unknown <axis> in sparse_reduce()\n')
 
 
-def sparse_marginalize_mask(mask_indices, shape=None, axis=None, keep_dims=True):
+def sparse_segment_max(values, num_features, plan, axis):
+    """Segment max of a 2D sparse tensor along <axis>, with empty segments set to 0.
+
+    tf.unsorted_segment_max fills empty segments with the lowest float; they are zeroed with a
+    [segments, 1] mask from the plan counts rather than a full-size comparison against a sentinel.
+    The gradient is routed straight to the entries equal to their segment max, split evenly between
+    ties like the gradient of tf.unsorted_segment_max.
+    """
+    ids = plan.segment_ids(axis)
+    num_segments = plan.num_segments(axis)
+    nonempty = tf.cast(tf.greater(plan.counts(axis), 0), tf.float32) # segments x 1
+
+    @tf.custom_gradient
+    def segment_max(x):
+        out = tf.unsorted_segment_max(x, ids, num_segments=num_segments) * nonempty
+
+        def grad(dy):
+            is_max = tf.cast(tf.equal(x, tf.gather(out, ids)), dy.dtype)
+            ties = tf.maximum(plan.segment_sum(is_max, axis), 1.) # segments x K, empty segments get no gradient anyway
+            return tf.gather(dy / ties, ids) * is_max
+        return out, grad
+
+    return segment_max(tf.reshape(values, shape=[-1,num_features]))
+
+
+def sparse_segment_stats(values, num_features, plan, axis=None, stats=('sum', 'count'), weights=None):
+    """Several per-segment statistics of a 2D sparse tensor from a single segment reduction along <axis>.
+
+    'sum' (always returned) and optionally 'sumsq' and the weighted 'count' are read off one segment sum
+    over a concatenated [nnz, ...] buffer; unweighted counts come from the index plan. 'max' needs its own
+    segment max. weights, if given, are [nnz, num_features] or [nnz, 1] and weight sum, sumsq and count.
+    Every statistic has shape [segments, width] ([1, width] for axis=None).
+    """
+    vals = tf.reshape(values, shape=[-1,num_features])
+    cols = [vals if weights is None else weights * vals]
+    sizes = [num_features]
+    if 'sumsq' in stats:
+        cols.append(cols[0] * vals)
+        sizes.append(num_features)
+    if 'count' in stats and weights is not None:
+        cols.append(weights)
+        sizes.append(weights.get_shape().as_list()[-1])
+    buf = tf.concat(cols, axis=1) if len(cols) > 1 else cols[0]
+    if axis is None:
+        red = tf.reduce_sum(buf, axis=0, keep_dims=True)
+    else:
+        red = plan.segment_sum(buf, axis)
+    parts = tf.split(red, sizes, axis=1) if len(cols) > 1 else [red]
+    out = {'sum':parts[0]}
+    if 'sumsq' in stats:
+        out['sumsq'] = parts[1]
+    if 'count' in stats:
+        out['count'] = plan.counts(axis) if weights is None else parts[-1]
+    if 'max' in stats:
+        if axis is None:
+            out['max'] = tf.reduce_max(vals, axis=0, keep_dims=True)
+        else:
+            out['max'] = sparse_segment_max(vals, num_features, plan, axis)
+    return out
+
+
+def sparse_segment_softmax_mean(values, logits, num_features, plan, axis=None, eps=1e-3):
+    """Mean of a 2D sparse tensor along <axis>, weighted by the softmax of logits within each segment.
+
+    logits are [nnz, num_features] (or reshapeable to it). The per-segment max is subtracted before
+    exponentiating, so every non-empty segment keeps a weight of 1 and nothing underflows. The weighted
+    sum and the normalizer come from one segment sum (sparse_segment_stats). Returns [segments, num_features].
+    """
+    logits = tf.cast(tf.reshape(logits, shape=[-1,num_features]), tf.float32)
+    if axis is None:
+        logits_max = tf.reduce_max(logits, axis=0, keep_dims=True)
+    else:
+        ids = plan.segment_ids(axis)
+        logits_max = tf.gather(tf.unsorted_segment_max(logits, ids, num_segments=plan.num_segments(axis)), ids)
+    weights = tf.exp(logits - tf.stop_gradient(logits_max))
+    stats = sparse_segment_stats(values, num_features, plan, axis=axis, stats=('sum', 'count'), weights=weights)
+    return stats['sum'] / (stats['count'] + eps)
+
+
+def sparse_marginalize_mask(mask_indices, shape=None, axis=None, keep_dims=True, plan=None):
     """Equivalent to tf.reduce_sum applied to 2D mask."""
-    mask_indices = tf.cast(mask_indices, dtype=tf.float32) # cast so computation can be done on gpu
+    if plan is None:
+        plan = SparseIndexPlan(mask_indices, shape)
     if axis is 0:
-        inds = tf.cast(mask_indices[:,1], dtype=tf.int32)
-        if shape is None:
-            num_segments = tf.cast(tf.reduce_max(mask_indices[:,1]), tf.int32) + 1
-        else:
-            num_segments = shape[1]
-        marg = tf.unsorted_segment_sum(tf.ones_like(inds, dtype=tf.float32), inds, num_segments)
-        marg = tf.cast(tf.expand_dims(marg, axis=1), dtype=tf.float32)
+        marg = plan.col_counts
         if keep_dims:
             marg = tf.reshape(marg, shape=[1,-1,1])
         return marg
     elif axis is 1:
-        inds = tf.cast(mask_indices[:,0], dtype=tf.int32)
-        if shape is None:
-            num_segments = tf.cast(tf.reduce_max(mask_indices[:,0]), tf.int32) + 1
-        else:
-            num_segments = shape[0]
-        marg = tf.unsorted_segment_sum(tf.ones_like(inds, dtype=tf.float32), inds, num_segments)
-        marg = tf.cast(tf.expand_dims(marg, axis=1), dtype=tf.float32)
+        marg = plan.row_counts
         if keep_dims:
             marg = tf.reshape(marg, shape=[-1,1,1])
         return marg
     elif axis is None:
-        return tf.cast(tf.reshape(tf.shape(mask_indices)[0], shape=[1,1,1]), dtype=tf.float32)
+        return tf.reshape(plan.total_count, shape=[1,1,1])
     else:
         print('\nERROR - unknown <axis> in sparse_marginalize_mask()\n')
 
@@ -190,28 +389,65 @@ def sparse_tensordot_sparse(tensor_values, param, num_features):
     return vals
 
 
-def sparse_tensor_broadcast_dense_add(x_values, y, mask_indices, num_features, broadcast_axis=None):
-    """Broadcast add y onto the sparse coordinates of x_sp. Produces a sparse tensor with the same shape as x_sp, and non-zero values corresponding to those of x_sp."""
-    inds = expand_tensor_indices(mask_indices, num_features)
-    num_vals = tf.shape(inds)[0]
-    if broadcast_axis is 0:
-        temp_inds = tf.strided_slice(inds, begin=[0,0], end=[num_vals,2], strides=[num_features,1])
-        temp_inds = tf.slice(temp_inds, begin=[0,1], size=[-1,1])
-        new_vals = tf.cast(tf.gather_nd(tf.reshape(y, shape=[-1,num_features]), temp_inds), tf.float32)
-        vals = tf.reshape(x_values, shape=[-1,num_features]) + new_vals
-        vals = tf.reshape(vals, shape=[num_vals])
-
-    elif broadcast_axis is 1:
-        temp_inds = tf.strided_slice(inds, begin=[0,0], end=[num_vals,2], strides=[num_features,1])
-        temp_inds = tf.slice(temp_inds, begin=[0,0], size=[-1,1])
-        new_vals = tf.cast(tf.gather_nd(tf.reshape(y, shape=[-1,num_features]), temp_inds), tf.float32)
-        vals = tf.reshape(x_values, shape=[-1,num_features]) + new_vals
-        vals = tf.reshape(vals, shape=[num_vals])
+def sparse_tensor_broadcast_dense_add(x_values, y, mask_indices, num_features, broadcast_axis=None, plan=None):
+    """Broadcast add y onto the sparse coordinates of x_sp. Produces a sparse tensor with the same shape as x_sp, and non-zero values corresponding to those of x_sp.
 
+    The row (or column) of y belonging to each non-zero is gathered directly on the [nnz, num_features]
+    view of x_values, so no [nnz*num_features, 3] index tensor is ever built.
+    """
+    vals = tf.reshape(x_values, shape=[-1,num_features])
+    y = tf.reshape(y, shape=[-1,num_features])
+    if broadcast_axis in (0, 1):
+        if plan is None:
+            ids = tf.cast(mask_indices[:,1-broadcast_axis], dtype=index_dtype(mask_indices))
+        else:
+            ids = plan.col_ids if broadcast_axis == 0 else plan.row_ids
+        vals = vals + tf.gather(y, ids)
     else:
-        vals = tf.reshape(x_values, shape=[-1,num_features])
-        vals = tf.reshape(tf.add(vals, y), shape=[-1])
-    return vals
+        vals = vals + y
+    return tf.reshape(vals, shape=[-1])
+
+
+def sparse_exchangeable_mean(values, thetas, num_features, units, plan, eps=1e-3):
+    """All four theta terms of a mean-pooling matrix_sparse layer in one op with a hand-written gradient.
+
+    Computes X theta_0 + mean_rows(X) theta_1 + mean_cols(X) theta_2 + mean(X) theta_3 on the non-zeros
+    of X, with the same eps-smoothed means as weighted_mean_reduce. The backward pass only keeps X and
+    the small marginals alive, and reduces the incoming gradient with the same segment sums.
+    """
+    theta_0, theta_1, theta_2, theta_3 = [tf.convert_to_tensor(t) for t in thetas]
+    norm_0 = plan.col_counts + eps # M x 1
+    norm_1 = plan.row_counts + eps # N x 1
+    norm_2 = plan.total_count + eps # 1 x 1
+
+    @tf.custom_gradient
+    def exchangeable(x, t_0, t_1, t_2, t_3):
+        x = tf.reshape(x, shape=[-1,num_features])
+        marg_0 = plan.segment_sum(x, axis=0) / norm_0 # M x K
+        marg_1 = plan.segment_sum(x, axis=1) / norm_1 # N x K
+        marg_2 = tf.reduce_sum(x, axis=0, keep_dims=True) / norm_2 # 1 x K
+        out = tf.add_n([tf.matmul(x, t_0),
+                        tf.gather(tf.matmul(marg_0, t_1), plan.col_ids),
+                        tf.gather(tf.matmul(marg_1, t_2), plan.row_ids)])
+        out = tf.reshape(out + tf.matmul(marg_2, t_3), shape=[-1])
+
+        def grad(dy):
+            dy = tf.reshape(dy, shape=[-1,units])
+            dy_0 = plan.segment_sum(dy, axis=0) # M x units
+            dy_1 = plan.segment_sum(dy, axis=1) # N x units
+            dy_2 = tf.reduce_sum(dy, axis=0, keep_dims=True) # 1 x units
+            dx = tf.add_n([tf.matmul(dy, t_0, transpose_b=True),
+                           tf.gather(tf.matmul(dy_0 / norm_0, t_1, transpose_b=True), plan.col_ids),
+                           tf.gather(tf.matmul(dy_1 / norm_1, t_2, transpose_b=True), plan.row_ids)])
+            dx = dx + tf.matmul(dy_2 / norm_2, t_3, transpose_b=True)
+            return [tf.reshape(dx, shape=[-1]),
+                    tf.matmul(x, dy, transpose_a=True),
+                    tf.matmul(marg_0, dy_0, transpose_a=True),
+                    tf.matmul(marg_1, dy_1, transpose_a=True),
+                    tf.matmul(marg_2, dy_2, transpose_a=True)]
+        return out, grad
+
+    return exchangeable(values, theta_0, theta_1, theta_2, theta_3)
 
 
 def sparse_dropout(values, num_features, rate=0.0, training=True):
@@ -224,29 +460,36 @@ def sparse_dropout(values, num_features, rate=0.0, training=True):
     return vals
 
 
-def sparse_dropout_row_col(values, mask_inds, shape, rate=0.0, training=True):
-    """Apply dropout to rows and columns independently with probability rate."""
-    N,M,K = shape
-    vals = tf.reshape(values, [-1,K])
-    num_vals = tf.shape(vals)[0]
-    
-    row_mask = np.random.choice([0,1], size=N, p=(rate, 1-rate)) # Dropout rows where this mask is 0
-    row_keep = np.arange(N)[row_mask==1]
-    _, row_inds = tf.setdiff1d(mask_inds[:,0], row_keep)
-
-    col_mask = np.random.choice([0,1], size=M, p=(rate, 1-rate)) # Dropout cols where this mask is 0
-    col_keep = np.arange(M)[col_mask==1]
-    _, col_inds = tf.setdiff1d(mask_inds[:,1], col_keep)
-
-    inds, _ = tf.unique(tf.concat([row_inds, col_inds], axis=0))
-
-    drop_mask = tf.scatter_nd(tf.expand_dims(inds, axis=1), tf.ones_like(inds), shape=[num_vals])
-    drop_mask = tf.cast(drop_mask, tf.bool)
-
-    new_vals = tf.where(drop_mask, tf.zeros_like(vals), vals)
-    new_vals = tf.reshape(new_vals, [-1]) / (1 - rate * rate)
-
-    return new_vals
-
-
+def sparse_dropout_row_col(values, mask_inds, shape, rate=0.0, training=True, plan=None):
+    """Apply dropout to rows and columns independently with probability rate.
 
+    Keep flags are drawn in-graph per row and per column on every run and gathered onto the non-zeros,
+    so an entry survives only if both its row and its column are kept.
+    """
+    N,M,K = shape
+    if not training or rate == 0.:
+        return values
+    if plan is None:
+        plan = SparseIndexPlan(mask_inds, [N,M])
+    vals = sparse_dropout_values(tf.reshape(values, [-1,K]), rate, 'row_col', plan, training=training)
+    return tf.reshape(vals, [-1])
+
+
+def sparse_dropout_values(vals, rate, mode, plan, training=True):
+    """Dropout on the [nnz, K] values of a 2D sparse tensor.
+
+    mode 'channel' drops single values, 'entry' drops whole non-zeros (all K channels), and 'row_col'
+    drops rows and columns of the matrix (see sparse_dropout_row_col).
+    """
+    if not training or rate == 0.:
+        return vals
+    if mode == 'channel':
+        return tf.nn.dropout(vals, keep_prob=1. - rate)
+    elif mode == 'entry':
+        return tf.nn.dropout(vals, keep_prob=1. - rate, noise_shape=tf.stack([tf.shape(vals)[0], 1]))
+    elif mode == 'row_col':
+        keep_row = tf.cast(tf.greater_equal(tf.random_uniform(tf.reshape(plan.num_rows, [1])), rate), tf.float32)
+        keep_col = tf.cast(tf.greater_equal(tf.random_uniform(tf.reshape(plan.num_cols, [1])), rate), tf.float32)
+        keep = tf.gather(keep_row, plan.row_ids) * tf.gather(keep_col, plan.col_ids) # nnz
+        return vals * tf.expand_dims(keep, axis=1) / ((1 - rate) * (1 - rate))
+    raise KeyError("Unrecognised dropout mode: %s" % mode)
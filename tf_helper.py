@@ -1,5 +1,10 @@
 from __future__ import print_function
+import re
+import sys
+import hashlib
+from collections import OrderedDict
 import tensorflow as tf
+from tensorflow.python.client import timeline
 from tensorflow.contrib.framework import add_arg_scope, model_variable
 
 
@@ -33,4 +38,205 @@ def variable_summaries(var):
         tf.summary.histogram('histogram', var)
 
 
+class UnkeyableError(ValueError):
+    pass
 
+_PLAIN_TYPES = (type(None), bool, int, float, str, bytes, type(u''))
+
+def structure_key(obj, _seen=None):
+    '''
+    A string that identifies obj by value, for caching things built from configuration dictionaries.
+    Objects are keyed by their configuration: get_config() for keras objects, the code, closure and defaults
+    of functions, and __dict__ otherwise. Raises UnkeyableError if obj holds anything that can only be told
+    apart by identity, in which case callers should not cache.
+    '''
+    _seen = _seen or set()
+    if isinstance(obj, _PLAIN_TYPES):
+        return "%s:%r" % (type(obj).__name__, obj)
+    if id(obj) in _seen:
+        raise UnkeyableError("cyclic reference in %r" % type(obj))
+    _seen = _seen | {id(obj)}
+    if isinstance(obj, dict):
+        return "{" + ",".join("%s:%s" % (structure_key(k, _seen), structure_key(obj[k], _seen)) for k in sorted(obj, key=str)) + "}"
+    if isinstance(obj, (list, tuple)):
+        return type(obj).__name__ + "[" + ",".join(structure_key(x, _seen) for x in obj) + "]"
+    kind = "%s.%s" % (type(obj).__module__, type(obj).__name__)
+    if hasattr(obj, 'co_code'):#code object: bytecode, constants and referenced names
+        return "code(%s;%s;%s)" % (hashlib.md5(obj.co_code).hexdigest(), structure_key(obj.co_consts, _seen), structure_key(obj.co_names, _seen))
+    if hasattr(obj, '__func__') and hasattr(obj, '__self__'):#bound method
+        return "method(%s;%s)" % (structure_key(obj.__self__, _seen), structure_key(obj.__func__, _seen))
+    if hasattr(obj, '__code__'):#python function or lambda
+        closure = [cell.cell_contents for cell in (obj.__closure__ or ())]
+        return "%s.%s(%s;%s;%s)" % (obj.__module__, obj.__name__, structure_key(obj.__code__, _seen),
+                                   structure_key(closure, _seen), structure_key(obj.__defaults__ or (), _seen))
+    if hasattr(obj, 'get_config'):
+        return "%s(%s)" % (kind, structure_key(obj.get_config(), _seen))
+    if hasattr(obj, '__dict__'):
+        return "%s(%s)" % (kind, structure_key(vars(obj), _seen))
+    text = repr(obj)
+    if re.search(r" at 0x[0-9a-fA-F]+", text):
+        raise UnkeyableError("%s can only be identified by its address" % kind)
+    return "%s(%s)" % (kind, text)#e.g. numpy ufuncs
+
+def source_digest(modules):
+    '''md5 of the source files of modules, so that caches keyed on it are invalidated by code edits.'''
+    digest = hashlib.md5()
+    for module in modules:
+        path = re.sub(r"\.py[co]$", ".py", module.__file__)
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def graph_fingerprint(objs, modules=()):
+    '''
+    Key of a graph built from objs with the code of modules, or None if objs can't be keyed by value.
+    The TensorFlow version and the source of modules are part of the key.
+    '''
+    try:
+        key = structure_key(objs)
+    except UnkeyableError as e:
+        print("not caching the graph: %s" % e)
+        return None
+    key += tf.__version__ + source_digest(modules)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def save_graph(path, handles):
+    '''
+    Export the default graph as a MetaGraphDef, remembering the tensors and ops in handles (a dict of
+    tensors, ops or lists of them) so load_graph can give them back without rebuilding the model.
+    '''
+    graph = tf.get_default_graph()
+    for name, handle in handles.items():
+        if isinstance(handle, (list, tuple)):
+            graph.add_to_collection('handle_lists', name)
+            for h in handle:
+                graph.add_to_collection('handle/' + name, h)
+        else:
+            graph.add_to_collection('handle/' + name, handle)
+    tf.train.export_meta_graph(filename=path, clear_devices=True)
+
+def load_graph(path):
+    '''
+    Import a graph saved by save_graph into the default graph and return its handles.
+    '''
+    tf.train.import_meta_graph(path)
+    graph = tf.get_default_graph()
+    lists = set(n.decode('utf-8') if isinstance(n, bytes) else n for n in graph.get_collection('handle_lists'))
+    handles = {name:[] for name in lists}
+    for key in graph.get_all_collection_keys():
+        if key.startswith('handle/'):
+            name = key[len('handle/'):]
+            collection = graph.get_collection(key)
+            handles[name] = collection if name in lists else collection[0]
+    return handles
+
+
+LAYER_SCOPES = 'layer_scopes'
+
+def register_layer_scope(label):
+    '''
+    Record the current name scope under label, so layer_profile can attribute the ops created in it
+    (and their gradients) to that layer. Called by base.Model for every layer it builds.
+    '''
+    graph = tf.get_default_graph()
+    graph.add_to_collection(LAYER_SCOPES, "%s/|%s" % (graph.get_name_scope(), label))
+
+def layer_profile(run_metadata, graph=None):
+    '''
+    Per-layer forward/backward time, bytes allocated and number of executed ops of a traced session run.
+    Ops under the gradients/ scope count as backward; ops outside every layer scope (losses, optimizer
+    and EMA updates) are reported as 'other'.
+    '''
+    graph = graph or tf.get_default_graph()
+    scopes = [entry.decode('utf-8') if isinstance(entry, bytes) else entry for entry in graph.get_collection(LAYER_SCOPES)]
+    scopes = [tuple(entry.split('|', 1)) for entry in scopes]
+    rows = OrderedDict((label, {'layer':label, 'forward_ms':0., 'backward_ms':0., 'bytes':0, 'ops':0}) for _, label in scopes + [('', 'other')])
+    scopes.sort(key=lambda entry: len(entry[0]), reverse=True)#innermost scope first
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:#GPU kernel streams repeat the ops of the device
+            continue
+        for node in dev_stats.node_stats:
+            name = node.node_name.split(':')[0]
+            backward = re.match(r'^gradients(_\d+)?/', name)
+            if backward:
+                name = name[backward.end():]
+            label = next((label for prefix, label in scopes if name.startswith(prefix)), 'other')
+            row = rows[label]
+            row['backward_ms' if backward else 'forward_ms'] += node.all_end_rel_micros / 1000.
+            row['bytes'] += sum(mem.total_bytes for mem in node.memory)
+            row['ops'] += 1
+    return list(rows.values())
+
+def print_layer_profile(rows, prefix="", file=None):
+    file = file or sys.stdout
+    print(prefix + "layer\tforward_ms\tbackward_ms\tMB\tops", file=file)
+    for row in rows:
+        print("%s\t%.2f\t%.2f\t%.1f\t%d" % (row['layer'], row['forward_ms'], row['backward_ms'], row['bytes'] / 2.**20, row['ops']), file=file)
+
+class StepProfiler(object):
+    '''
+    Drop-in for sess.run in training loops: every `every` calls the step is traced with tf.RunMetadata,
+    a per-layer table is printed to log and, with trace_prefix, a Chrome trace (chrome://tracing) is written
+    to trace_prefix_<step>.json. With every=0 it just calls sess.run.
+    '''
+    def __init__(self, every=0, trace_prefix=None, log=None):
+        self._every = every
+        self._trace_prefix = trace_prefix
+        self._log = log
+        self._step = 0
+
+    def run(self, sess, fetches, feed_dict=None):
+        self._step += 1
+        if not self._every or self._step % self._every:
+            return sess.run(fetches, feed_dict=feed_dict)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        out = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        print_layer_profile(layer_profile(run_metadata, sess.graph), prefix="step %d profile:\n" % self._step, file=self._log)
+        if self._trace_prefix is not None:
+            with open("%s_%06d.json" % (self._trace_prefix, self._step), "w") as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True))
+        return out
+
+
+def make_optimizer(opts):
+    optimizer = opts.get("optimizer", "adam")
+    opt_options = opts.get("opt_options", {})
+    print("Optimizing with %s with options: %s" % (optimizer, opt_options))
+    if isinstance(optimizer, str):
+        if optimizer == "adam":
+            return tf.train.AdamOptimizer(opts['lr'], **opt_options)
+        elif optimizer == "lazy_adam":#only updates the moments of the rows with non-zero gradient, e.g. gathered slices
+            return tf.contrib.opt.LazyAdamOptimizer(opts['lr'], **opt_options)
+        elif optimizer == "rmsprop":
+            return tf.train.RMSPropOptimizer(opts['lr'], **opt_options)
+        elif optimizer == "sgd":
+            return tf.train.GradientDescentOptimizer(opts['lr'])
+        else:
+            raise KeyError("Unknown optimizer: %s" % optimizer)
+    return optimizer
+
+
+def get_optimizer(loss, opts):
+    return make_optimizer(opts).minimize(loss)
+
+
+def flat_gradient_ops(loss, optimizer, var_list=None):
+    '''
+    Gradients and parameters as single flat float32 vectors, for averaging them outside of TensorFlow:
+    flat_grad evaluates the gradient of loss, apply_step applies the gradient fed to flat_grad_in with optimizer,
+    flat_params evaluates the parameters and assign_params sets them to flat_params_in.
+    '''
+    var_list = var_list or tf.trainable_variables()
+    sizes = [v.get_shape().num_elements() for v in var_list]
+    grads = tf.gradients(loss, var_list)
+    grads = [tf.zeros_like(v) if g is None else tf.convert_to_tensor(g) for g, v in zip(grads, var_list)]#gathered slices are densified
+    flat_grad = tf.concat([tf.reshape(g, [-1]) for g in grads], axis=0, name='flat_grad')
+    flat_grad_in = tf.placeholder(tf.float32, shape=[sum(sizes)], name='flat_grad_in')
+    grads_in = [tf.reshape(g, v.get_shape()) for g, v in zip(tf.split(flat_grad_in, sizes), var_list)]
+    apply_step = optimizer.apply_gradients(list(zip(grads_in, var_list)))
+    flat_params = tf.concat([tf.reshape(v, [-1]) for v in var_list], axis=0, name='flat_params')
+    flat_params_in = tf.placeholder(tf.float32, shape=[sum(sizes)], name='flat_params_in')
+    assign_params = tf.group(*[v.assign(tf.reshape(p, v.get_shape())) for p, v in zip(tf.split(flat_params_in, sizes), var_list)])
+    return {'flat_grad':flat_grad, 'flat_grad_in':flat_grad_in, 'apply_step':apply_step,
+            'flat_params':flat_params, 'flat_params_in':flat_params_in, 'assign_params':assign_params}
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import numpy as np
 import pandas as pd
 import pdb
@@ -27,7 +28,83 @@ def to_number(mat):
     out[mat.sum(axis=2) > 0] += 1
     return np.array(out, dtype=floatX)
 
-def get_ml100k(valid=0.1, rng=None, dense=False, fold=1):
+DATASET_FILES = {'movielens-100k':'ml-100k/u1.base',
+                 'movielens-1M':'ml-1m/ratings.dat',
+                 'movielens-10M':'ml_10m/ratings.dat',
+                 'netflix/6m':'netflix/6m/ratings.dat',
+                 'netflix/full':'netflix/full/ratings.dat',
+                 }
+
+
+##### columnar dataset cache #####
+# A dataset is cached as one .npy file per column plus a JSON manifest, in a folder per dataset and split:
+#   user, item (int32): 0-based ids of every rating, item as in mask_indices_all
+#   item_split (int32): item index within the rating's own split (tr/val/test), as in mask_indices_tr/val/test
+#   item_tr_val (int32): item index within the train+valid ratings, as in mask_indices_tr_val (-1 for test ratings)
+#   rating (int8): rating * rating_scale
+#   split (int8): 0 train, 1 valid, 2 test, aligned with mask_indices_all
+# The columns are loaded with np.load(mmap_mode='r'), so reopening a dataset only maps the files.
+
+def dataset_cache_folder(dataset, valid, test, seed, fold=1):
+    if 'movielens-100k' in dataset:# ml-100k uses the official test set of the fold
+        name = "%s_fold%d_valid%s_seed%d" % (dataset, fold, valid, seed)
+    else:
+        name = "%s_valid%s_test%s_seed%d" % (dataset.replace('/', '_'), valid, test, seed)
+    return os.path.join(data_folder, "cache", name)
+
+def save_columns(folder, columns, manifest):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name, column in columns.items():
+        np.save(os.path.join(folder, name + ".npy"), column)
+    manifest = dict(manifest, columns={name:str(column.dtype) for name, column in columns.items()})
+    with open(os.path.join(folder, "manifest.json"), "w") as f:#written last: a folder with a manifest is complete
+        json.dump(manifest, f)
+
+def load_columns(folder):
+    with open(os.path.join(folder, "manifest.json")) as f:
+        manifest = json.load(f)
+    columns = {name:np.load(os.path.join(folder, name + ".npy"), mmap_mode='r') for name in manifest['columns']}
+    return manifest, columns
+
+def rating_columns(user_ids, movie_ids, ratings, split):
+    """Columns of the cache from 1-based user ids, raw movie ids, ratings and the split of every rating.
+    Item indices are compacted with np.unique over all ratings, within each split and within train+valid."""
+    user_ids, movie_ids, ratings = np.asarray(user_ids), np.asarray(movie_ids), np.asarray(ratings)
+    _, item = np.unique(movie_ids, return_inverse=True)
+    item_split = np.zeros(item.shape[0], np.int32)
+    for k in range(3):
+        _, item_split[split == k] = np.unique(movie_ids[split == k], return_inverse=True)
+    item_tr_val = -np.ones(item.shape[0], np.int32)
+    _, item_tr_val[split <= 1] = np.unique(movie_ids[split <= 1], return_inverse=True)
+    rating_scale = 1 if np.all(np.mod(ratings, 1) == 0) else 2 # ml-10M has half stars
+    columns = {'user':(user_ids - 1).astype(np.int32),
+               'item':item.astype(np.int32),
+               'item_split':item_split,
+               'item_tr_val':item_tr_val,
+               'rating':np.round(ratings * rating_scale).astype(np.int8),
+               'split':split.astype(np.int8)}
+    manifest = {'mat_shape':[int(np.max(user_ids)), int(np.max(item)) + 1, 1], 'rating_scale':rating_scale}
+    return columns, manifest
+
+def columns_to_data(manifest, columns):
+    """The sparse data dictionary of get_data from cached columns."""
+    user, split = columns['user'], columns['split']
+    rating = columns['rating'].astype(np.int32) if manifest['rating_scale'] == 1 else columns['rating'] / np.float32(manifest['rating_scale'])
+    data = {'mat_values_all':rating,
+            'mask_indices_all':np.stack([user, columns['item']], axis=1),
+            'mat_shape':manifest['mat_shape'],
+            'mask_tr_val_split':split}
+    for name, select, item in [('tr', split == 0, columns['item_split']),
+                               ('val', split == 1, columns['item_split']),
+                               ('test', split == 2, columns['item_split']),
+                               ('tr_val', split <= 1, columns['item_tr_val'])]:
+        data['mat_values_' + name] = rating[select]
+        data['mask_indices_' + name] = np.stack([user[select], item[select]], axis=1)
+    return data
+
+
+def ml100k_columns(valid=0.1, rng=None, fold=1):
     if rng is None:
         rng = np.random.RandomState()
     r_cols = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
@@ -46,314 +123,136 @@ def get_ml100k(valid=0.1, rng=None, dense=False, fold=1):
     ratings_all['tr_val_split'] = tr_val_test_split
     ratings_all = ratings_all.sort_values(by=['user_id', 'movie_id'])
 
-    n_ratings = ratings_all.rating.shape[0]
-
     n_users = np.max(ratings_all.user_id)
-    _, movies = np.unique(ratings_all.movie_id, return_inverse=True)
-    n_movies = np.max(movies) + 1
-
-    mat_values_all = np.array(ratings_all.rating)
-    mat_values_tr = np.array(ratings_all.loc[ratings_all['tr_val_split']==0,:].rating)
-    mat_values_val = np.array(ratings_all.loc[ratings_all['tr_val_split']==1,:].rating)
-    mat_values_test = np.array(ratings_all.loc[ratings_all['tr_val_split']==2,:].rating)
-    mat_values_tr_val = np.array(ratings_all.loc[ratings_all['tr_val_split']<=1,:].rating)
-
-    mask_indices_all = np.array(list(zip(ratings_all.user_id-1, ratings_all.movie_id-1)))
-    mask_indices_tr = np.array(list(zip(ratings_all.loc[ratings_all['tr_val_split']==0,:].user_id-1, 
-                                        ratings_all.loc[ratings_all['tr_val_split']==0,:].movie_id-1)))
-    mask_indices_val = np.array(list(zip(ratings_all.loc[ratings_all['tr_val_split']==1,:].user_id-1, 
-                                        ratings_all.loc[ratings_all['tr_val_split']==1,:].movie_id-1)))
-    mask_indices_test = np.array(list(zip(ratings_all.loc[ratings_all['tr_val_split']==2,:].user_id-1, 
-                                        ratings_all.loc[ratings_all['tr_val_split']==2,:].movie_id-1)))
-    mask_indices_tr_val = np.array(list(zip(ratings_all.loc[ratings_all['tr_val_split']<=1,:].user_id-1, 
-                                        ratings_all.loc[ratings_all['tr_val_split']<=1,:].movie_id-1)))
-
-    tr_val_split = np.array(ratings_all['tr_val_split'])
-
-    # for dense...
-    data = {'mat_values_all':mat_values_all,
-            'mat_values_tr':mat_values_tr,
-            'mat_values_val':mat_values_val,
-            'mat_values_tr_val':mat_values_tr_val,
-            'mat_values_test':mat_values_test,
-            'mask_indices_all':mask_indices_all,
-            'mask_indices_tr':mask_indices_tr,
-            'mask_indices_val':mask_indices_val,
-            'mask_indices_tr_val':mask_indices_tr_val,
-            'mask_indices_test':mask_indices_test,                   
-            'mat_shape':[n_users, n_movies, 1], 
-            'mask_tr_val_split':tr_val_split}
-
-    if dense:
-        mat_tr_val = sparse_array_to_dense(mat_values_tr_val, mask_indices_tr_val, [n_users, n_movies, 1])
-
-        mask_tr_val = np.zeros([n_users, n_movies])
-        mask_tr_val[list(zip(*mask_indices_tr_val))] = 1
-
-        mask_tr = np.zeros([n_users, n_movies])
-        mask_tr[list(zip(*mask_indices_tr))] = 1
-
-        mask_val = np.zeros([n_users, n_movies])
-        mask_val[list(zip(*mask_indices_val))] = 1
-        data.update({'mat_tr_val':mat_tr_val[:,:,None],
-                'mask_tr_val':mask_tr_val[:,:,None],
-                'mask_tr':mask_tr[:,:,None],
-                'mask_val':mask_val[:,:,None]})
-    return data
-
-def get_data(dataset='movielens-small',
-                 mode='sparse',#returned matrix: dense, sparse, table
-                 train=.8,
-                 test=.1,
-                 valid=.1,
-                 seed=1234,
-                 save_data=False,
-                 load_data=False,
-                 **kwargs
-                 ):
-    rng = np.random.RandomState(seed)
-
-    if 'movielens-100k' in dataset:
-        return get_ml100k(valid, rng, mode=="dense", kwargs.get("fold", 1))
-
-    elif 'movielens-1M' in dataset:
-        if load_data:
-            if os.path.exists("data/ml1M.npz"):
-                print("loading saved data")
-                data = np.load("data/ml1M.npz")
-                print("data loaded")
-                return data
-        r_cols = ['user_id', None, 'movie_id', None, 'rating', None, 'unix_timestamp']
-        path = os.path.join(data_folder, 'ml-1m/ratings.dat')
-
-        ratings = pd.read_csv(path, sep=':', names=r_cols, encoding='latin-1')
-        r_cols = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
-
-        n_ratings = ratings.rating.shape[0]
-        n_users = np.max(ratings.user_id)
-
-        _, movies = np.unique(ratings.movie_id, return_inverse=True)
-        n_movies = np.max(movies) + 1
-
-        n_ratings_val = int(n_ratings * valid)
-        n_ratings_ts = int(n_ratings * test)
-        n_ratings_tr = n_ratings - n_ratings_val - n_ratings_ts
-
-        split_tr_val = np.concatenate((np.zeros(n_ratings_tr, np.int32), np.ones(n_ratings_val, np.int32), 2 * np.ones(n_ratings_ts, np.int32)))
-        split_tr_val = rng.permutation(split_tr_val)
-
-        ratings_tr_val = ratings[split_tr_val<=1]
-        ratings_tr = ratings[split_tr_val==0]
-        ratings_val = ratings[split_tr_val==1]
-        ratings_ts = ratings[split_tr_val==2]
-
-        mat_values_all = np.array(ratings.rating)
-        mat_values_tr_val = np.array(ratings_tr_val.rating)
-        mat_values_tr = np.array(ratings_tr.rating)
-        mat_values_val = np.array(ratings_val.rating)
-        mat_values_ts = np.array(ratings_ts.rating)
-
-        _, movies_tr = np.unique(ratings_tr.movie_id, return_inverse=True)
-        _, movies_val = np.unique(ratings_val.movie_id, return_inverse=True)
-        _, movies_ts = np.unique(ratings_ts.movie_id, return_inverse=True)
-        _, movies_tr_val = np.unique(ratings_tr_val.movie_id, return_inverse=True)
-
-        mask_indices_all = np.array(list(zip(ratings.user_id-1, movies)))
-        mask_indices_tr_val = np.array(list(zip(ratings_tr_val.user_id-1, movies_tr_val)))
-        mask_indices_tr = np.array(list(zip(ratings_tr.user_id-1, movies_tr)))
-        mask_indices_val = np.array(list(zip(ratings_val.user_id-1, movies_val)))
-        mask_indices_ts = np.array(list(zip(ratings_ts.user_id-1, movies_ts)))
-
-        n_users_tr_val = np.max(mask_indices_tr_val[:,0]) + 1
-        n_movies_tr_val = np.max(mask_indices_tr_val[:,1]) + 1
-
-        data = {'mat_values_all':mat_values_all,
-                'mask_indices_all':mask_indices_all,
-                'mat_values_tr_val':mat_values_tr_val,
-                'mask_indices_tr_val':mask_indices_tr_val,
-                'mat_values_tr':mat_values_tr,
-                'mask_indices_tr':mask_indices_tr,
-                'mat_values_val':mat_values_val,                        
-                'mask_indices_val':mask_indices_val, 
-                'mat_values_test':mat_values_ts,
-                'mask_indices_test':mask_indices_ts,
-                'mat_shape':[n_users, n_movies, 1], 
-                'mask_tr_val_split':split_tr_val
-                }
-        if save_data:
-            print("Saving data")
-            np.savez_compressed("data/ml1M.npz", **data)
-
-        if mode=='dense':
-            mat_tr_val = sparse_array_to_dense(mat_values_tr_val, mask_indices_tr_val, [n_users_tr_val, n_movies_tr_val, 1])
-        
-            mask_tr_val = np.zeros([n_users, n_movies])
-            mask_tr_val[mask_indices_tr_val] = 1
-        
-            mask_tr = np.zeros([n_users, n_movies])
-            mask_tr[mask_indices_tr] = 1
-       
-            mask_val = np.zeros([n_users, n_movies])
-            mask_val[mask_indices_val] = 1
-            data.update({'mat_tr_val':mat_tr_val,
-                        'mask_tr_val':mask_tr_val,
-                        'mask_tr':mask_tr,
-                        'mask_val':mask_val})
-
-        return data
-
-    elif 'movielens-10M' in dataset:
-        if load_data:
-            if os.path.exists("data/ml10M.npz"):
-                print("loading saved data")
-                data = np.load("data/ml10M.npz")
-                print("data loaded")
-                return data
+    n_movies = np.unique(ratings_all.movie_id).shape[0]
+    item = np.array(ratings_all.movie_id - 1, np.int32) # ml-100k movie ids are used as they are in every split
+    columns = {'user':np.array(ratings_all.user_id - 1, np.int32),
+               'item':item,
+               'item_split':item,
+               'item_tr_val':item,
+               'rating':np.array(ratings_all.rating, np.int8),
+               'split':np.array(ratings_all.tr_val_split, np.int8)}
+    return columns, {'mat_shape':[int(n_users), int(n_movies), 1], 'rating_scale':1}
+
+def read_ratings(dataset):
+    if 'movielens-1M' in dataset or 'movielens-10M' in dataset:
         r_cols = ['user_id', None, 'movie_id', None, 'rating', None, 'unix_timestamp']
-        path = os.path.join(data_folder, 'ml_10m/ratings.dat')
-        print("Loading ML 10M")
+        path = os.path.join(data_folder, DATASET_FILES['movielens-1M' if 'movielens-1M' in dataset else 'movielens-10M'])
+        print("--> reading ", path)
         ratings = pd.read_csv(path, sep=':', names=r_cols, encoding='latin-1')
-        r_cols = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
-        print("Ratings loaded with shape ", ratings.shape)
-
-        n_ratings = ratings.rating.shape[0]
-        n_users = np.max(ratings.user_id)
-
-        _, movies = np.unique(ratings.movie_id, return_inverse=True)
-        n_movies = np.max(movies) + 1
-
-        n_ratings_val = int(n_ratings * valid)
-        n_ratings_ts = int(n_ratings * test)
-        n_ratings_tr = n_ratings - n_ratings_val - n_ratings_ts
-
-        split_tr_val = np.concatenate((np.zeros(n_ratings_tr, np.int32), np.ones(n_ratings_val, np.int32), 2 * np.ones(n_ratings_ts, np.int32)))
-        split_tr_val = rng.permutation(split_tr_val)
-
-        ratings_tr_val = ratings[split_tr_val<=1]
-        ratings_tr = ratings[split_tr_val==0]
-        ratings_val = ratings[split_tr_val==1]
-        ratings_ts = ratings[split_tr_val==2]
-
-        mat_values_all = np.array(ratings.rating)
-        mat_values_tr_val = np.array(ratings_tr_val.rating)
-        mat_values_tr = np.array(ratings_tr.rating)
-        mat_values_val = np.array(ratings_val.rating)
-        mat_values_ts = np.array(ratings_ts.rating)
-
-        _, movies_tr = np.unique(ratings_tr.movie_id, return_inverse=True)
-        _, movies_val = np.unique(ratings_val.movie_id, return_inverse=True)
-        _, movies_ts = np.unique(ratings_ts.movie_id, return_inverse=True)
-        _, movies_tr_val = np.unique(ratings_tr_val.movie_id, return_inverse=True)
-
-        mask_indices_all = np.array(list(zip(ratings.user_id-1, movies)))
-        mask_indices_tr_val = np.array(list(zip(ratings_tr_val.user_id-1, movies_tr_val)))
-        mask_indices_tr = np.array(list(zip(ratings_tr.user_id-1, movies_tr)))
-        mask_indices_val = np.array(list(zip(ratings_val.user_id-1, movies_val)))
-        mask_indices_ts = np.array(list(zip(ratings_ts.user_id-1, movies_ts)))
-
-        n_users_tr_val = np.max(mask_indices_tr_val[:,0]) + 1
-        n_movies_tr_val = np.max(mask_indices_tr_val[:,1]) + 1
-
-        data = {'mat_values_all':mat_values_all,
-                'mask_indices_all':mask_indices_all,
-                'mat_values_tr_val':mat_values_tr_val,
-                'mask_indices_tr_val':mask_indices_tr_val,
-                'mat_values_tr':mat_values_tr,
-                'mask_indices_tr':mask_indices_tr,
-                'mat_values_val':mat_values_val,                        
-                'mask_indices_val':mask_indices_val, 
-                'mat_values_test':mat_values_ts,
-                'mask_indices_test':mask_indices_ts,
-                'mat_shape':[n_users, n_movies, 1], 
-                'mask_tr_val_split':split_tr_val
-                }
-        if save_data:
-            print("Saving data")
-            np.savez_compressed("data/ml10M.npz", **data)
-            print("Done")
-        return data
-
     elif 'netflix' in dataset:
-        if load_data:
-            if os.path.exists("data/netflix.npz"):
-                print("loading saved data")
-                data = np.load("data/netflix.npz")
-                print("data loaded")
-                return data
-        print("--> loading ", dataset, " data")
-
         r_cols = ['user_id', 'movie_id', 'rating', 'date']
         path = os.path.join(data_folder, dataset, 'ratings.dat')
-
-        print("     reading csv...")
-
+        print("--> reading ", path)
         ratings = pd.read_csv(path, sep='\t', names=r_cols, encoding='latin-1')        
         ratings.rating = ratings.rating.astype(int)
+    else:
+        raise Exception("unknown dataset")
+    return ratings
 
-        n_ratings = ratings.rating.shape[0]
-        n_users = np.max(ratings.user_id)
+def get_ml100k(valid=0.1, rng=None, dense=False, fold=1):
+    columns, manifest = ml100k_columns(valid, rng, fold)
+    data = columns_to_data(manifest, columns)
+    if dense:
+        data.update(ml100k_dense(data))
+    return data
 
-        _, movies = np.unique(ratings.movie_id, return_inverse=True)
-        n_movies = np.max(movies) + 1
+def ml100k_dense(data):
+    n_users, n_movies, _ = data['mat_shape']
+    mask_indices_tr_val, mask_indices_tr, mask_indices_val = data['mask_indices_tr_val'], data['mask_indices_tr'], data['mask_indices_val']
+    mat_tr_val = sparse_array_to_dense(data['mat_values_tr_val'], mask_indices_tr_val, [n_users, n_movies, 1])
 
-        print("     loading", n_ratings, "ratings for", n_users, "users on", n_movies, "movies...")
+    mask_tr_val = np.zeros([n_users, n_movies])
+    mask_tr_val[list(zip(*mask_indices_tr_val))] = 1
 
-        n_ratings_val = int(n_ratings * valid)
-        n_ratings_ts = int(n_ratings * test)
-        n_ratings_tr = n_ratings - n_ratings_val - n_ratings_ts
+    mask_tr = np.zeros([n_users, n_movies])
+    mask_tr[list(zip(*mask_indices_tr))] = 1
 
-        split_tr_val = np.concatenate((np.zeros(n_ratings_tr, np.int32), np.ones(n_ratings_val, np.int32), 2 * np.ones(n_ratings_ts, np.int32)))
-        split_tr_val = rng.permutation(split_tr_val)
+    mask_val = np.zeros([n_users, n_movies])
+    mask_val[list(zip(*mask_indices_val))] = 1
+    return {'mat_tr_val':mat_tr_val[:,:,None],
+            'mask_tr_val':mask_tr_val[:,:,None],
+            'mask_tr':mask_tr[:,:,None],
+            'mask_val':mask_val[:,:,None]}
 
-        print("     populating ratings arrays...")
+def ml1m_dense(data):
+    n_users, n_movies, _ = data['mat_shape']
+    mask_indices_tr_val, mask_indices_tr, mask_indices_val = data['mask_indices_tr_val'], data['mask_indices_tr'], data['mask_indices_val']
+    n_users_tr_val = np.max(mask_indices_tr_val[:,0]) + 1
+    n_movies_tr_val = np.max(mask_indices_tr_val[:,1]) + 1
+    mat_tr_val = sparse_array_to_dense(data['mat_values_tr_val'], mask_indices_tr_val, [n_users_tr_val, n_movies_tr_val, 1])
 
-        ratings_tr_val = ratings[split_tr_val<=1]
-        ratings_tr = ratings[split_tr_val==0]
-        ratings_val = ratings[split_tr_val==1]
-        ratings_ts = ratings[split_tr_val==2]
+    mask_tr_val = np.zeros([n_users, n_movies])
+    mask_tr_val[mask_indices_tr_val] = 1
 
-        mat_values_all = np.array(ratings.rating)
-        mat_values_tr_val = np.array(ratings_tr_val.rating)
-        mat_values_tr = np.array(ratings_tr.rating)
-        mat_values_val = np.array(ratings_val.rating)
-        mat_values_ts = np.array(ratings_ts.rating)
+    mask_tr = np.zeros([n_users, n_movies])
+    mask_tr[mask_indices_tr] = 1
 
-        print("     populating index arrays...")
+    mask_val = np.zeros([n_users, n_movies])
+    mask_val[mask_indices_val] = 1
+    return {'mat_tr_val':mat_tr_val,
+            'mask_tr_val':mask_tr_val,
+            'mask_tr':mask_tr,
+            'mask_val':mask_val}
 
-        _, movies_tr_val = np.unique(ratings_tr_val.movie_id, return_inverse=True)
-        _, movies_tr = np.unique(ratings_tr.movie_id, return_inverse=True)
-        _, movies_val = np.unique(ratings_val.movie_id, return_inverse=True)
-        _, movies_ts = np.unique(ratings_ts.movie_id, return_inverse=True)
 
-        mask_indices_all = np.array(list(zip(ratings.user_id-1, movies)))
-        mask_indices_tr_val = np.array(list(zip(ratings_tr_val.user_id-1, movies_tr_val)))
-        mask_indices_tr = np.array(list(zip(ratings_tr.user_id-1, movies_tr)))
-        mask_indices_val = np.array(list(zip(ratings_val.user_id-1, movies_val)))
-        mask_indices_ts = np.array(list(zip(ratings_ts.user_id-1, movies_ts)))
+def get_data(dataset='movielens-small',
+                 mode='sparse',#returned matrix: dense, sparse, table
+                 train=.8,
+                 test=.1,
+                 valid=.1,
+                 seed=1234,
+                 cache=True,#load the columns from (and on first load, save them to) data/cache/
+                 **kwargs
+                 ):
+    rng = np.random.RandomState(seed)
+    folder = dataset_cache_folder(dataset, valid, test, seed, kwargs.get("fold", 1))
 
-        data = {'mat_values_all':mat_values_all,
-                'mask_indices_all':mask_indices_all,
-                'mat_values_tr_val':mat_values_tr_val,
-                'mask_indices_tr_val':mask_indices_tr_val,
-                'mat_values_tr':mat_values_tr,
-                'mask_indices_tr':mask_indices_tr,
-                'mat_values_val':mat_values_val,                        
-                'mask_indices_val':mask_indices_val, 
-                'mat_values_test':mat_values_ts,                        
-                'mask_indices_test':mask_indices_ts, 
-                'mat_shape':[n_users, n_movies, 1], 
-                'mask_tr_val_split':split_tr_val}
-        if save_data:
-            np.savez_compressed("data/netflix.npz", **data)
-        # pdb.set_trace()
+    if cache and os.path.exists(os.path.join(folder, "manifest.json")):
+        manifest, columns = load_columns(folder)
+    else:
+        if 'movielens-100k' in dataset:
+            columns, manifest = ml100k_columns(valid, rng, kwargs.get("fold", 1))
+        else:
+            ratings = read_ratings(dataset)
+            n_ratings = ratings.rating.shape[0]
+            n_ratings_val = int(n_ratings * valid)
+            n_ratings_ts = int(n_ratings * test)
+            n_ratings_tr = n_ratings - n_ratings_val - n_ratings_ts
+
+            split_tr_val = np.concatenate((np.zeros(n_ratings_tr, np.int32), np.ones(n_ratings_val, np.int32), 2 * np.ones(n_ratings_ts, np.int32)))
+            split_tr_val = rng.permutation(split_tr_val)
+            columns, manifest = rating_columns(ratings.user_id, ratings.movie_id, ratings.rating, split_tr_val)
+        manifest['dataset'] = dataset
+        if cache:
+            save_columns(folder, columns, manifest)
+            manifest, columns = load_columns(folder)
+    data = columns_to_data(manifest, columns)
+
+    if mode == 'dense':
+        if 'movielens-100k' in dataset:
+            data.update(ml100k_dense(data))
+        elif 'movielens-1M' in dataset:
+            data.update(ml1m_dense(data))
+    return data
+    
 
-        print("--> netflix data loaded.")
+def sort_row_major(data):
+    """Return a copy of a sparse data dict with every (mat_values_*, mask_indices_*) pair in (row, column) order.
 
+    Every batch that selects an increasing subset of these arrays (e.g. conditional_sample_sparse) is then
+    row-major too, which is what the sorted segment path of SparseIndexPlan relies on.
+    """
+    data = dict(data)
+    for split in ['all', 'tr', 'val', 'tr_val', 'test']:
+        mask_indices = data['mask_indices_' + split]
+        order = np.lexsort((mask_indices[:,1], mask_indices[:,0]))
+        data['mask_indices_' + split] = mask_indices[order]
+        data['mat_values_' + split] = data['mat_values_' + split][order]
+        if split == 'all':
+            data['mask_tr_val_split'] = data['mask_tr_val_split'][order]
+    return data
 
-        return data
-    else:
-        raise Exception("unknown dataset")
-    
 
 def define_scope(function):
     attribute = '_cache_' + function.__name__
@@ -15,6 +15,7 @@ import tensorflow as tf
 from scipy.sparse import csr_matrix
 # Model imports
 from base import Model
+from tf_helper import StepProfiler
 from util import get_data
 from sparse_util import *
 from dataset_transfer import load_matlab_file, eval_dataset
@@ -399,6 +400,7 @@ def main(opts, logfile=None, restore_point=None):
                         'mvec':out_enc_tr['mvec'],
                         'units':out_enc_tr['units'],
                         'mask_indices':mask_indices_tr,
+                        'plan':out_enc_tr['plan'],
                         'shape':out_enc_tr['shape'],
                         }
 
@@ -434,6 +436,7 @@ def main(opts, logfile=None, restore_point=None):
                                                             num_outputs=num_features)
             train_step = get_optimizer(total_loss, opts)
             sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+            profiler = StepProfiler(opts.get('profile_every', 0), "logs/timeline_" + opts.get('model_name', "TEST")) # per-layer profile and Chrome trace every profile_every steps
             sess.run(tf.global_variables_initializer())
 
             if 'by_row_column_density' in opts['sample_mode'] or 'conditional_sample_sparse' in opts['sample_mode']:
@@ -494,7 +497,7 @@ def main(opts, logfile=None, restore_point=None):
                                     mask_split:np.ones_like(mat_values)
                                     }
                         
-                        returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                        returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                         bloss_, brec_loss_ = [i for i in returns[1:3]]
 
                         loss_tr_ += np.sqrt(bloss_)
@@ -511,7 +514,7 @@ def main(opts, logfile=None, restore_point=None):
                                     mask_split:np.ones_like(mat_values)
                                     }
                         
-                        returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                        returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                         bloss_, brec_loss_ = [i for i in returns[1:3]] # ema_op may be empty and we only need these two outputs
 
                         loss_tr_ += bloss_
@@ -532,7 +535,7 @@ def main(opts, logfile=None, restore_point=None):
                                     mask_split:np.ones_like(mat_values[:,0])
                                     }
                         
-                        returns = sess.run([train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
+                        returns = profiler.run(sess, [train_step, total_loss, rec_loss] + ema_op, feed_dict=tr_dict)
                         bloss_, brec_loss_ = [i for i in returns[1:3]] # ema_op may be empty and we only need these two outputs
 
                         loss_tr_ += bloss_
@@ -684,6 +687,7 @@ if __name__ == "__main__":
            'model_name':name,
            'ema_decay':1.,
            'verbose':2,
+           'profile_every':0,#trace a training step every profile_every steps: per-layer timings and logs/timeline_<model_name>_<step>.json
            'loss':lossfn,
            'optimizer':"adam",
            'opt_options':{"epsilon":1e-6},